@@ -12,6 +12,7 @@ import json
 import logging
 import re
 import subprocess
+import threading
 import time
 import urllib
 
@@ -19,11 +20,17 @@ import urllib
 import requests
 from requests.packages.urllib3.exceptions import InsecureRequestWarning
 requests.packages.urllib3.disable_warnings(InsecureRequestWarning)
+try:
+    # The response encodings urllib3 can decode (e.g. "gzip,deflate,br" when brotli is installed)
+    from requests.packages.urllib3.util.request import ACCEPT_ENCODING
+except ImportError:
+    ACCEPT_ENCODING = 'gzip,deflate'
 from bs4 import BeautifulSoup
 
 # Application specific modules
 from timer import timer
 from base_classes import DebugableObject
+from result_encoding import decode_json
 
 # Create the logger
 logger = logging.getLogger('logger')
@@ -39,15 +46,53 @@ class Appliance(DebugableObject):
         name: The logical name.
         port: The port to target API calls to
         credentials: Base64 encoded credentials to use in API calls
+        transfer: Bytes received from the JSON APIs (see execute_json_api):
+            responses, bytes (decompressed), wire_bytes (as transferred)
+            and encodings (the Content-Encoding values seen)
     """
 
     __metaclass__ = ABCMeta
 
+    # Ask the Appliances for compressed responses (see set_http_compression)
+    _http_compression = True
+
+    # Records or replays the responses of the Appliances (see set_recorder)
+    _recorder = None
+
+    # Records the phases of the JSON API requests in the run's timeline (see set_tracer)
+    _tracer = None
+
+    @classmethod
+    def set_http_compression(cls, enabled):
+        cls._http_compression = enabled
+
+    @classmethod
+    def set_recorder(cls, recorder):
+        """Records or replays the responses of the Appliances created afterwards
+        with recorder, a response_recorder.ResponseRecorder (None to stop)"""
+        cls._recorder = recorder
+
+    @classmethod
+    def get_recorder(cls):
+        return cls._recorder
+
+    @classmethod
+    def set_tracer(cls, tracer):
+        """Records the response headers, download and decoding phases of the
+        JSON API requests in tracer, a tracing.RunTracer (None to stop)"""
+        cls._tracer = tracer
+
+    @classmethod
+    def get_tracer(cls):
+        return cls._tracer
+
     def __init__(self, hostname_fqdn, name, port, credentials):
         self._hostname_fqdn = hostname_fqdn
         self._name = name
         self._port = port
         self._credentials = credentials
+        self._transfer_lock = threading.Lock()
+        self._transfer = {'responses': 0, 'bytes': 0, 'wire_bytes': 0, 'encodings': []}
         self._create_session()
 
     @property
@@ -61,17 +106,35 @@ class Appliance(DebugableObject):
     @property
     def port(self):
         return self._port
+
+    @property
+    def transfer(self):
+        with self._transfer_lock:
+            return dict(self._transfer, encodings=list(self._transfer['encodings']))
     
+    def account_transfer(self, nbytes, wire_bytes, encoding):
+        """Adds a JSON API response of nbytes bytes, transferred as wire_bytes
+        bytes with the Content-Encoding encoding, to self.transfer"""
+        with self._transfer_lock:
+            self._transfer['responses'] += 1
+            self._transfer['bytes'] += nbytes
+            self._transfer['wire_bytes'] += wire_bytes
+            if encoding not in self._transfer['encodings']:
+                self._transfer['encodings'].append(encoding)
+
     def get_default_headers(self):
         return {
             'Authorization': 'Basic ' + self._credentials,
-            'Accept': 'application/json'}
+            'Accept': 'application/json',
+            'Accept-Encoding': ACCEPT_ENCODING if self._http_compression else 'identity'}
 
     def _create_session(self):
         """Create reqeusts session object for making API calls to the Appliance
         """
         self._session = requests.Session()
         self._session.headers.update(self.get_default_headers())
+        if self._recorder is not None:
+            self._session.mount('https://', self._recorder.adapter())
 
     def _format_api(self, api):
         """ Formats the API string by adding the protocol, 
@@ -165,11 +228,20 @@ class Appliance(DebugableObject):
             logger.debug("{} - retrieved {} objects in {}".format(func_name, len(results), timer(start_time, end_time)))
         return results
 
-    def execute_json_api(self, api):
+    def execute_json_api(self, api, raw=False, response_info=None, timeout=None):
         """ Executes the specified API against the Appliance and retusns the
             resulting json objecs as a list of dict objects 
 
             api = The api after the fqdn of the Appliance to execute
+            raw = If True, return the undecoded response body (bytes) instead,
+                so that it can be decoded elsewhere (e.g. in a worker process)
+            response_info = Optional dict, updated with the status_code, the
+                number of bytes of the response, the number of bytes that
+                were transferred (wire_bytes) and the content_encoding
+            timeout = Optional seconds to wait for the response
+
+            The response is read as a stream, decompressing it chunk by chunk
+            as it arrives when the Appliance compressed it.
             """
         func_name = self.__class__.__name__ + '.' + inspect.currentframe().f_code.co_name
         results = []
@@ -178,21 +250,68 @@ class Appliance(DebugableObject):
             start_time = time.time()
             logger.debug("{} - api: {}".format(func_name, api))
         # Execute the API
+        request_time = time.time()
         try:
-            api_response = self._session.get(api, stream=False, verify=False)
+            api_response = self._session.get(api, stream=True, verify=False, timeout=timeout)
             if self.debug_mode(): logger.debug('{} - api_response.status_code: {}'.format(func_name, api_response.status_code))
+            headers_time = time.time()
+            content = b''.join(api_response.iter_content(chunk_size=65536))
+        except requests.exceptions.Timeout as e:
+            logger.error("{} - Timed out getting results from Nexthink. {}".format(func_name, e))
+            return None
         except requests.exceptions.ConnectionError as e:
             logger.error("{} - Unable to get results from Nexthink. {}".format(func_name, e))
             return None
+        # Account for the bytes as transferred (compressed) and as decoded
+        encoding = api_response.headers.get('Content-Encoding', 'identity')
+        wire_bytes = api_response.raw.tell() or len(content)
+        self.account_transfer(len(content), wire_bytes, encoding)
+        if self.debug_mode():
+            logger.debug('{} - {} bytes received as {} bytes ({})'.format(func_name, len(content), wire_bytes, encoding))
         # Process and parse the response
+        if response_info is not None:
+            response_info.update({'status_code': api_response.status_code, 'bytes': len(content),
+                'wire_bytes': wire_bytes, 'content_encoding': encoding})
         results = []
+        download_time = time.time()
         if api_response.ok:
-            results = api_response.json()
+            results = content if raw else decode_json(content)
+        elif raw:
+            results = b'[]'
+        if self._tracer is not None:
+            details = {'appliance': self._name, 'status_code': api_response.status_code}
+            self._tracer.add('response headers', 'http', request_time, headers_time, details)
+            self._tracer.add('download', 'http', headers_time, download_time,
+                dict(details, bytes=len(content), wire_bytes=wire_bytes, content_encoding=encoding))
+            if api_response.ok and not raw:
+                self._tracer.add('decode', 'http', download_time, time.time(), dict(details, objects=len(results)))
         if self.debug_mode():
             end_time = time.time()
-            logger.debug("{} - Retrieved {} objects in {}".format(func_name, len(results), timer(start_time, end_time)))
+            logger.debug("{} - Retrieved {} {} in {}".format(func_name, len(results), 'bytes' if raw else 'objects', timer(start_time, end_time)))
         return results
 
+    def probe(self, timeout):
+        """ Checks that the Appliance answers HTTPS requests, and measures the
+            round-trip time of a lightweight request.
+
+            timeout = Seconds to wait for the connection and for the response
+
+            Returns = dict with status ("ok" or "unreachable"), rtt (seconds,
+                or None if unreachable), and error (None if reachable)
+            """
+        func_name = self.__class__.__name__ + '.' + inspect.currentframe().f_code.co_name
+        api = self._format_api('/')
+        start_time = time.time()
+        try:
+            # Any HTTP answer, even an error status, shows that the Appliance is up
+            api_response = self._session.head(api, timeout=timeout, verify=False, allow_redirects=False)
+            result = {'status': 'ok', 'rtt': time.time() - start_time, 'error': None}
+            if self.debug_mode(): logger.debug('{} - api_response.status_code: {}'.format(func_name, api_response.status_code))
+        except requests.exceptions.RequestException as e:
+            result = {'status': 'unreachable', 'rtt': None, 'error': '{}: {}'.format(type(e).__name__, e)}
+        if self.debug_mode(): logger.debug('{} - {} probe result: {}'.format(func_name, self._name, result))
+        return result
+
     def post_json_api(self, api, body):
         """ Posts the specified API against the Appliance and returns the
             resulting json objecs as a list of dict objects 
@@ -218,8 +337,10 @@ class Appliance(DebugableObject):
         # Process and parse the response
         results = []
         if api_response.ok:
-            if api_response.text[1:] == '{':
+            if api_response.text.lstrip()[:1] in ['{', '[']:
                 results = json.loads(api_response.text)
+                if isinstance(results, dict):
+                    results = [results]
             else:
                 # Create faux json response
                 results.append({"text":api_response.text})
@@ -246,6 +367,16 @@ class PortalAppliance(Appliance):
             config.portal_port, config.portal_credentials,
             config.portal_list_engines_api, config.portal_act_api)
 
+    @classmethod
+    def create_all(cls, config):
+        """Returns the [Portal] Portal, followed by the other Portals of the run"""
+        portals = [cls.create(config)]
+        for settings in config.portal_federation:
+            portals.append(cls(settings['portal_server'], settings['portal_name'],
+                settings['portal_port'], settings['portal_credentials'],
+                settings['portal_list_engines_api'], settings['portal_remote_action_api']))
+        return portals
+
     def __init__(self, hostname_fqdn, name, port, credentials,
                  list_engines_api, act_api):
         """Returns an initialized Portal Appliance object."""
@@ -263,6 +394,9 @@ class PortalAppliance(Appliance):
         return "Portal"
 
     def execute_remote_action(self, remote_action_id, device_list):
+        """ Runs the Remote Action on the devices in device_list, which holds
+            either device UID strings or objects with a device_uid attribute.
+            Returns the Portal's response, or None if the call failed. """
         func_name = self.__class__.__name__ + '.' + inspect.currentframe().f_code.co_name
         results = []
         if self.debug_mode():
@@ -271,30 +405,36 @@ class PortalAppliance(Appliance):
         # Construct payload
         payload = {
             "RemoteActionUid": remote_action_id,
-            "DeviceUids": [d.device_uid for d in device_list]
+            "DeviceUids": [d if isinstance(d, str) else d.device_uid for d in device_list]
         }
         if self.debug_mode(): logger.debug('{} - Payload before calling RA: {}'.format(func_name, payload))
         response = self.post_json_api(self._act_api, payload)
-        if len(response) == 0: response = None
+        if not response: response = None
         if self.debug_mode():
             end_time = time.time()
             logger.debug("{} - Executed Remote Action on {} objects in {}. Response:  {}".format(func_name, len(device_list), timer(start_time, end_time), response))
         return response
 
-    def get_engine_list(self, engine_port=1671, only_connected=False):
-        """Retursn a list of EngineAppliance instances from this Portal."""
+    def get_engine_list(self, engine_port=1671, only_connected=False, qualify_names=False):
+        """Retursn a list of EngineAppliance instances from this Portal, tagged
+        with its name (prefixing the Engine names with it if qualify_names),
+        or None if the Portal could not be reached."""
         func_name = self.__class__.__name__ + '.' + inspect.currentframe().f_code.co_name
         results = []
         if self.debug_mode():
             start_time = time.time()
             logger.debug('{} - Start.'.format(func_name))
         response = self.execute_json_api(self._list_engines_api)
+        if response is None:
+            logger.error('{} - Unable to retrieve the list of Engines from Portal "{}".'.format(func_name, self._name))
+            return None
         # Create an EngineAppliance instance for each result
         for resp in response:
             if self.debug_mode(): logger.debug('{0} - Processing resp: {1!r}'.format(func_name, resp))
             # If only_active, make sure the engine is active before creating
             if ((not only_connected) or (only_connected and (resp['status'] == 'CONNECTED'))):
-                eng = EngineAppliance(resp['address'], resp['name'], engine_port, self._credentials)
+                name = '{}.{}'.format(self._name, resp['name']) if qualify_names else resp['name']
+                eng = EngineAppliance(resp['address'], name, engine_port, self._credentials, portal=self._name)
                 results.append(eng)
             else:
                 if self.debug_mode(): logger.debug('{} - Skipping disconnected Engine: {}'.format(func_name, resp['name']))
@@ -312,6 +452,7 @@ class EngineAppliance(Appliance):
         name: The logical name.
         port: The port to target API calls to
         credentials: Base64 encoded credentials to use in API calls
+        portal: The name of the Portal the Engine was listed by (if known)
     """
 
     @classmethod
@@ -319,13 +460,18 @@ class EngineAppliance(Appliance):
         return cls(source_object.address, source_object.name,
             source_object.port, source_object.credentials)
 
-    def __init__(self, hostname_fqdn, name, port, credentials):
+    def __init__(self, hostname_fqdn, name, port, credentials, portal=None):
         """Returns an initialized Engine Appliance object."""
         super(EngineAppliance, self).__init__(hostname_fqdn, name, port, credentials)
+        self._portal = portal
     
     def __repr__(self):
-        return 'EngineAppliance(hostname_fqdn={!r}, name={!r}, credentials=None, port={!r})'.format(
-            self._hostname_fqdn, self._name, self._port)
+        return 'EngineAppliance(hostname_fqdn={!r}, name={!r}, credentials=None, port={!r}, portal={!r})'.format(
+            self._hostname_fqdn, self._name, self._port, self._portal)
+
+    @property
+    def portal(self):
+        return self._portal
 
     def appliance_type(self):
         """Retursn a string representing the type of Appliance this is."""
@@ -137,22 +137,69 @@ def handle_args():
     # Define the arguments
     parser.add_argument('--version', action='version', 
         version='%(prog)s '+__VERSION)
-    parser.add_argument('-t', dest='query_type', required=True,
+    parser.add_argument('-t', dest='query_type',
         choices=['s','g'],
-        help=('Determines the type of query to look for. '
+        help=('Required unless --worker is given. '
+              'Determines the type of query to look for. '
               'An "s" specifies a Single Named Query will be '
               'in the -n (name) argument. '
               'A "g" specifies that a Named Query Group will be '
               'in the -n (name) argument. In that case, all queries '
               'in that Named Group file will be executed.'),
         action='store')
-    parser.add_argument('-n', dest='name', required=True,
-        help=('The case-sensitive name of the Single named Query, '
+    parser.add_argument('-n', dest='name',
+        help=('Required unless --worker is given. '
+              'The case-sensitive name of the Single named Query, '
               'or the Named Query Group to be executed.'),
         action='store')
     parser.add_argument('-i', dest='info',
         help='Include additional runtime information in the log',
         action='store_true')
+    parser.add_argument('--report', dest='report', nargs='?', type=int,
+        const=7, default=None, metavar='DAYS',
+        help=('Instead of running the query, report on the recorded run '
+              'statistics of the query (or queries of the group) over the '
+              'last DAYS days (default 7): per Engine latency percentiles, '
+              'rows, failures, and regressions compared with the previous '
+              'DAYS days.'))
+    parser.add_argument('--resume', dest='resume', nargs='?',
+        const='latest', default=None, metavar='RUNDATE',
+        help=('Resume the interrupted run of the query (or group) started '
+              'at RUNDATE (e.g. 20201231-235959), or the latest one if '
+              'RUNDATE is not specified: only the Engines that did not '
+              'answer each query are queried again, and the outputs are '
+              'completed. Starts a new run if there is nothing to resume.'))
+    parser.add_argument('--preview', dest='preview', nargs='?', type=int,
+        const=0, default=None, metavar='ENGINES',
+        help=('Instead of running the query, preview it: run the query (or '
+              'queries of the group) on a sample of ENGINES Engines (default: '
+              '[Queries] preview_engines), the one returning the most rows and '
+              'the fastest ones according to the run statistics, with at most '
+              '[Queries] preview_rows rows per Engine, and estimate the size '
+              'and duration of a full run. The results are saved next to the '
+              'log file.'))
+    parser.add_argument('--worker', dest='worker', nargs='?',
+        const='', default=None, metavar='[HOST:]PORT',
+        help=('Instead of running the query, run as a worker instance of '
+              'a coordinator ([Distributed] workers): listen on [HOST:]PORT '
+              '(default: [Distributed] worker_address) and run the Engine '
+              'queries the coordinator sends, until interrupted. A worker '
+              'runs no queries of its own, so -t and -n are not needed, e.g. '
+              '"%(prog)s --worker 0.0.0.0:17171".'))
+    recording = parser.add_mutually_exclusive_group()
+    recording.add_argument('--record', dest='record', default=None, metavar='DIR',
+        help=('Save the responses of the Portals and Engines to the folder '
+              'DIR (compressed, one file per request), with the time they '
+              'took, to replay them later with --replay.'))
+    recording.add_argument('--replay', dest='replay', default=None, metavar='DIR',
+        help=('Answer the requests to the Portals and Engines with the '
+              'responses recorded in the folder DIR by --record, instead of '
+              'sending them. A request that was not recorded fails as if '
+              'the Appliance could not be reached. A replayed run records '
+              'no run statistics, and leaves the Engine health cache as it was.'))
+    parser.add_argument('--replay-latency', dest='replay_latency', action='store_true',
+        help=('With --replay, answer every request after the time its '
+              'response originally took, instead of at once.'))
     parser.add_argument('-d', dest='options', nargs='*',
         metavar=('[OPTIONS]'),
         default=_debug_default, action=SplitDebugArgsAction)
@@ -160,5 +207,9 @@ def handle_args():
         metavar=('[OPTIONS]'),
         default=_exclude_default, action=SplitExcludeArgsAction)
     
-    return parser.parse_args()
+    args = parser.parse_args()
+    # A worker runs the queries the coordinator sends, so it needs no query of its own
+    if args.worker is None and (args.query_type is None or args.name is None):
+        parser.error('the following arguments are required unless --worker is given: -t, -n')
+    return args
 
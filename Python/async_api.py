@@ -0,0 +1,205 @@
+"""asyncio API of multi_engine_query, for running NXQL queries against the
+Engines from an asyncio application, and consuming the results as they arrive
+
+Example:
+
+    engines = await loop.run_in_executor(None, portal.get_engine_list)
+    results = query_all_engines(engines, query, max_concurrency=16)
+    try:
+        async for engine, batch in results:
+            if batch is None:
+                ...  # The Engine could not be queried
+            for row in batch:
+                ...
+    finally:
+        await results.aclose()
+
+The Engines are queried concurrently on the running event loop, with aiohttp
+when it is installed; otherwise (or while the responses are recorded or
+replayed, see response_recorder) each request runs in a worker thread. The
+responses are decoded and post-processed in worker threads, so that large
+responses do not hold up the event loop.
+"""
+
+# Native modules
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import functools
+import inspect
+import logging
+import time
+
+# Optional 3rd-party modules
+try:
+    import aiohttp
+    from yarl import URL
+except ImportError:
+    aiohttp = None
+
+# Application specific modules
+from timer import timer
+from appliance_classes import Appliance
+from helpers import build_query_api
+from post_processing import PostProcessor
+from result_encoding import decode_json
+
+# Create the logger
+logger = logging.getLogger('logger')
+
+# Marks the end of the batches of an Engine in the queue
+_DONE = object()
+
+def _chunks(values, size):
+    return [values[i:i + size] for i in range(0, len(values), size)]
+
+def _batches(objects, batch_rows):
+    """Splits the rows of an Engine into batches of at most batch_rows rows (a single empty batch if none)"""
+    if not objects or not batch_rows:
+        return [objects]
+    return _chunks(objects, batch_rows)
+
+def _decode(content, ok, post):
+    """Decodes a response body and post-processes its rows; run in a worker thread"""
+    objects = decode_json(content) if ok else []
+    return post.apply(objects) if post is not None else objects
+
+async def _fetch_aiohttp(session, engine, api):
+    """ Sends the API request to the Engine without blocking the event loop
+
+    Returns:
+        bytes: the (decompressed) response body
+        dict: the status_code, bytes, wire_bytes and content_encoding of the response
+    """
+    headers = engine.get_default_headers()
+    if headers['Accept-Encoding'] != 'identity':
+        # The encodings aiohttp decodes
+        headers['Accept-Encoding'] = 'gzip,deflate'
+    async with session.get(URL(engine._format_api(api), encoded=True), headers=headers, ssl=False) as response:
+        chunks = []
+        async for chunk in response.content.iter_chunked(65536):
+            chunks.append(chunk)
+        content = b''.join(chunks)
+        encoding = response.headers.get('Content-Encoding', 'identity')
+        wire_bytes = int(response.headers.get('Content-Length') or 0) or len(content)
+        engine.account_transfer(len(content), wire_bytes, encoding)
+        return content, {'status_code': response.status, 'bytes': len(content), 'wire_bytes': wire_bytes,
+            'content_encoding': encoding}
+
+async def _fetch_thread(executor, engine, api, timeout):
+    """Same as _fetch_aiohttp, running Appliance.execute_json_api in a worker thread"""
+    info = {}
+    content = await asyncio.get_event_loop().run_in_executor(executor,
+        functools.partial(engine.execute_json_api, api, raw=True, response_info=info, timeout=timeout))
+    if content is None:
+        raise IOError('Unable to get results from Nexthink')
+    return content, info
+
+async def query_all_engines(engines, query, config=None, max_concurrency=None, timeout=None, batch_rows=1000,
+                            max_batches=16, values=None):
+    """ Runs query against every Engine at once, and yields the results of each
+        Engine, in batches, as soon as they arrive: an asynchronous generator of
+        (EngineAppliance, list of dict objects).
+
+        An Engine returning no rows yields a single empty batch, and an Engine
+        that could not be queried a single None batch. The rows are
+        post-processed as the command line does (post_derive, post_filter,
+        post_columns).
+
+        At most max_batches batches wait for the consumer: once they are
+        queued, the Engines whose results are ready wait for the consumer,
+        and no more Engines are queried until they have handed over their
+        results. Closing the generator (aclose, in a finally clause of the
+        consumer so that it is also closed when the consumer is cancelled)
+        cancels the requests in progress; a request running in a worker
+        thread runs on until it completes or times out, and its results are
+        dropped.
+
+    Arguments:
+        engines: list of EngineAppliance
+        query: Initialized NXQLQuery instance
+        config: Optional MultiEngineQueryConfig instance, providing the default
+            max_concurrency (engine_max_workers) and timeout (engine_request_timeout)
+        max_concurrency: The most Engines queried at once (default 8)
+        timeout: Optional seconds to wait for the response of an Engine
+        batch_rows: The most rows in a batch (0 for all the rows of the Engine)
+        max_batches: The most batches waiting for the consumer
+        values: For a query depending on another query (depends_on), dict of
+            Engine name: values of the depends_field returned by that query
+            (see NXQLQuery.bind); an Engine missing from it, or with None
+            values, yields None
+    """
+    func_name = inspect.currentframe().f_code.co_name
+    if max_concurrency is None:
+        max_concurrency = config.engine_max_workers if config is not None else 8
+    if timeout is None and config is not None:
+        timeout = config.engine_request_timeout or None
+    max_concurrency = max(1, max_concurrency)
+    post = PostProcessor.from_query(logger, query)
+    queue = asyncio.Queue(maxsize=max(1, max_batches))
+    semaphore = asyncio.Semaphore(max_concurrency)
+    executor = ThreadPoolExecutor(max_workers=max_concurrency)
+    # The recorder works at the requests level, so record and replay in worker threads
+    session = None
+    if aiohttp is not None and Appliance.get_recorder() is None:
+        session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=timeout),
+            connector=aiohttp.TCPConnector(limit=max_concurrency))
+
+    async def run_engine(engine):
+        if not query.depends_on:
+            requests = [query]
+        elif (values or {}).get(engine.name) is not None:
+            requests = [query.bind(chunk) for chunk in _chunks(values[engine.name], query.depends_chunk_size)]
+        else:
+            logger.error('{0} - Query "{1}" it depends on returned no results from Engine "{2}", Query "{3}" is not run.'.format(
+                func_name, query.depends_on, engine.name, query.name))
+            return None
+        objects = []
+        for request in requests:
+            start_time = time.time()
+            api = build_query_api(request)
+            if session is not None:
+                content, info = await _fetch_aiohttp(session, engine, api)
+            else:
+                content, info = await _fetch_thread(executor, engine, api, timeout)
+            if info['status_code'] >= 400:
+                logger.warning('{0} - Engine "{1}" answered Query "{2}" with HTTP status {3}.'.format(
+                    func_name, engine.name, query.name, info['status_code']))
+            decoded = await asyncio.get_event_loop().run_in_executor(executor,
+                _decode, content, info['status_code'] < 400, post)
+            objects.extend(decoded)
+            if config is not None and config.verbose:
+                logger.info('{0} - {1} result rows retrived from Engine at {2} in {3}'.format(
+                    func_name, len(decoded), engine.hostname_fqdn, timer(start_time, time.time())))
+        return objects
+
+    async def produce(engine):
+        async with semaphore:
+            try:
+                objects = await run_engine(engine)
+            except asyncio.CancelledError:
+                raise
+            except Exception as exc:
+                logger.error('{0} - Unable to retrieve results from Engine "{1}" for Query "{2}": {3!r}'.format(
+                    func_name, engine.name, query.name, exc))
+                objects = None
+            # Hold the semaphore until the consumer takes the results
+            for batch in _batches(objects, batch_rows):
+                await queue.put((engine, batch))
+        await queue.put(_DONE)
+
+    tasks = [asyncio.ensure_future(produce(engine)) for engine in engines]
+    try:
+        remaining = len(tasks)
+        while remaining:
+            item = await queue.get()
+            if item is _DONE:
+                remaining -= 1
+                continue
+            yield item
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        if session is not None:
+            await session.close()
+        executor.shutdown(wait=False)
@@ -0,0 +1,209 @@
+"""Checkpoint and resume support for multi_engine_query"""
+
+# Native modules
+import inspect
+import json
+import logging
+import os
+import re
+import shutil
+import threading
+import time
+
+# Application specific modules
+from appliance_classes import EngineAppliance
+from result_encoding import decode_json
+
+# Create the logger
+logger = logging.getLogger('logger')
+
+class RunCheckpoint(object):
+    """Records which (query, Engine) pairs of a run are done, along with the
+    results retrieved for them, so that an interrupted run can be resumed
+    without querying those Engines again.
+
+    A checkpoint is a "<query_output_path>/.checkpoints/<name>-<rundate>"
+    folder holding a state.json file and, for every Engine that answered a
+    query, a "<query>/<engine>.json" file with its results. The results are
+    removed once every query of the run has completed without failures.
+
+    Attributes:
+        path: The checkpoint folder
+        rundate: The rundate of the run the checkpoint belongs to
+        resumed: True if an existing checkpoint was loaded
+    """
+
+    _FOLDER = '.checkpoints'
+
+    @classmethod
+    def latest(cls, logger, config):
+        """Returns the rundate of the latest uncompleted run of the query (or
+        group), or None if there is none"""
+        folder = os.path.join(config.query_output_path, cls._FOLDER)
+        prefix = config.query_name + '-'
+        rundates = []
+        if os.path.isdir(folder):
+            for name in os.listdir(folder):
+                if not name.startswith(prefix) or not re.match(r'^\d{8}-\d{6}$', name[len(prefix):]):
+                    continue
+                try:
+                    with open(os.path.join(folder, name, 'state.json')) as f:
+                        state = json.load(f)
+                except (IOError, OSError, ValueError):
+                    continue
+                if state.get('status') != 'completed':
+                    rundates.append(name[len(prefix):])
+        return max(rundates) if rundates else None
+
+    def __init__(self, logger, config):
+        self._logger = logger
+        self._config = config
+        self._rundate = config.rundate
+        self._path = os.path.join(config.query_output_path, self._FOLDER,
+            '{}-{}'.format(config.query_name, config.rundate))
+        self._lock = threading.Lock()
+        self._resumed = False
+        self._state = {
+            'name': config.query_name,
+            'is_group': config.query_is_group,
+            'rundate': config.rundate,
+            'status': 'running',
+            'queries': {}}
+
+    def __repr__(self):
+        return 'RunCheckpoint(path={!r}, resumed={!r})'.format(self._path, self._resumed)
+
+    @property
+    def path(self):
+        return self._path
+
+    @property
+    def rundate(self):
+        return self._rundate
+
+    @property
+    def resumed(self):
+        return self._resumed
+
+    @staticmethod
+    def _safe_name(name):
+        return re.sub(r'[^\w.-]', '_', name)
+
+    def _results_fname(self, query, engine_name):
+        return os.path.join(self._path, self._safe_name(query.name), self._safe_name(engine_name) + '.json')
+
+    def _query_state(self, query):
+        return self._state['queries'].setdefault(query.name, {'status': 'running', 'engines': {}})
+
+    def _save(self):
+        """Writes the state file; called with self._lock held"""
+        func_name = self.__class__.__name__ + '.' + inspect.currentframe().f_code.co_name
+        state_fname = os.path.join(self._path, 'state.json')
+        try:
+            with open(state_fname + '.part', 'w') as f:
+                json.dump(self._state, f, indent=2)
+            os.replace(state_fname + '.part', state_fname)
+        except (IOError, OSError) as e:
+            self._logger.error('{0} - Unable to save the checkpoint "{1}": {2}'.format(func_name, state_fname, e))
+
+    def start(self):
+        """Loads the checkpoint if it exists, or creates it. Returns True if successful."""
+        func_name = self.__class__.__name__ + '.' + inspect.currentframe().f_code.co_name
+        state_fname = os.path.join(self._path, 'state.json')
+        try:
+            if os.path.exists(state_fname):
+                with open(state_fname) as f:
+                    self._state = json.load(f)
+                self._state['status'] = 'running'
+                self._resumed = True
+            elif not os.path.exists(self._path):
+                os.makedirs(self._path)
+        except (IOError, OSError, ValueError) as e:
+            self._logger.error('{0} - Unable to load the checkpoint "{1}": {2}'.format(func_name, state_fname, e))
+            return False
+        with self._lock:
+            self._save()
+        return True
+
+    def query_done(self, query):
+        """Returns True if the query completed, without failures, in the checkpointed run"""
+        return self._state['queries'].get(query.name, {}).get('status') == 'completed'
+
+    def done_engines(self, query):
+        """Returns an EngineAppliance for each Engine whose results for query are saved"""
+        engines = self._state['queries'].get(query.name, {}).get('engines', {})
+        return [EngineAppliance(entry['hostname'], name, self._config.engine_port, self._config.engine_credentials)
+                for name, entry in sorted(engines.items()) if entry['status'] == 'ok']
+
+    def load_results(self, query, engine):
+        """Returns the saved results of engine for query, or None if they can not be read"""
+        func_name = self.__class__.__name__ + '.' + inspect.currentframe().f_code.co_name
+        results_fname = self._results_fname(query, engine.name)
+        try:
+            with open(results_fname, 'rb') as f:
+                return decode_json(f.read())
+        except (IOError, OSError, ValueError) as e:
+            self._logger.error('{0} - Unable to read the saved results "{1}": {2}'.format(func_name, results_fname, e))
+            return None
+
+    def save_results(self, query, engine, results, rows):
+        """Saves the results of engine for query, and marks the pair as done.
+
+        Arguments:
+            query: The NXQLQuery instance
+            engine: The EngineAppliance instance
+            results: The list of dict objects, or the raw JSON response (bytes)
+            rows: The number of rows in results
+        """
+        func_name = self.__class__.__name__ + '.' + inspect.currentframe().f_code.co_name
+        results_fname = self._results_fname(query, engine.name)
+        try:
+            # Several Engines of the same query may create the folder at once
+            os.makedirs(os.path.dirname(results_fname), exist_ok=True)
+            with open(results_fname + '.part', 'wb') as f:
+                f.write(results if isinstance(results, bytes) else json.dumps(results).encode('utf-8'))
+            os.replace(results_fname + '.part', results_fname)
+        except (IOError, OSError) as e:
+            self._logger.error('{0} - Unable to save the results "{1}": {2}'.format(func_name, results_fname, e))
+            self.mark(query, engine, 'failed')
+            return
+        self.mark(query, engine, 'ok', rows)
+
+    def mark(self, query, engine, status, rows=0):
+        """Records the status (ok, failed or unreachable) of engine for query"""
+        with self._lock:
+            self._query_state(query)['engines'][engine.name] = {
+                'hostname': engine.hostname_fqdn,
+                'status': status,
+                'rows': rows,
+                'time': time.time()}
+            self._save()
+
+    def finish_query(self, query, finalized):
+        """Records that the output of query was completed (finalized is True)
+        or not. The query is only considered done if no Engine failed."""
+        with self._lock:
+            state = self._query_state(query)
+            failed = [e for e in state['engines'].values() if e['status'] != 'ok']
+            state['status'] = 'completed' if finalized and not failed else 'incomplete'
+            self._save()
+
+    def finish(self, queries):
+        """Marks the run as completed, and removes the saved results, if every
+        one of the queries completed. Returns True if the run completed."""
+        func_name = self.__class__.__name__ + '.' + inspect.currentframe().f_code.co_name
+        with self._lock:
+            if not all(self.query_done(query) for query in queries):
+                self._state['status'] = 'incomplete'
+                self._save()
+                return False
+            self._state['status'] = 'completed'
+            self._save()
+        for name in os.listdir(self._path):
+            if os.path.isdir(os.path.join(self._path, name)):
+                try:
+                    shutil.rmtree(os.path.join(self._path, name))
+                except OSError as e:
+                    self._logger.warning('{0} - Unable to remove the saved results in "{1}": {2}'.format(
+                        func_name, os.path.join(self._path, name), e))
+        return True
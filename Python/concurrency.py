@@ -0,0 +1,127 @@
+"""Adaptive Engine concurrency control for multi_engine_query"""
+
+# Native modules
+import inspect
+import logging
+import threading
+
+# Create the logger
+logger = logging.getLogger('logger')
+
+class ConcurrencyGovernor(object):
+    """Limits how many requests run against each Engine at once, adapting the
+    limit of every Engine to how it copes (additive increase, multiplicative
+    decrease):
+    - a request that succeeds without a latency spike raises the Engine's
+      limit by 1 / limit, i.e. by about one request per round of requests
+    - a failed request (no answer, a timeout, or a 5xx status), or a latency
+      spike (more than config.engine_latency_spike_factor times the Engine's
+      usual latency), multiplies it by config.engine_backoff_factor
+    The limit of an Engine stays between 1 and
+    config.engine_max_requests_per_engine, and no more than
+    config.engine_max_workers requests run at once across all Engines.
+    The scheduler takes a slot (try_acquire) before it submits the query of
+    an Engine, and keeps the query until a slot frees up (release), so the
+    worker threads never wait for one; the worker threads record the outcome
+    of every request (record).
+
+    Attributes:
+        max_per_engine: The hard limit of requests per Engine
+        max_total: The hard limit of requests across all Engines
+    """
+
+    # Weight of the latest latency in an Engine's usual latency
+    _LATENCY_WEIGHT = 0.2
+
+    def __init__(self, logger, config):
+        self._logger = logger
+        self._config = config
+        self._max_per_engine = config.engine_max_requests_per_engine
+        self._max_total = config.engine_max_workers
+        self._spike_factor = config.engine_latency_spike_factor
+        self._backoff_factor = config.engine_backoff_factor
+        self._lock = threading.Lock()
+        self._engines = {}
+        self._in_flight = 0
+
+    def __repr__(self):
+        return 'ConcurrencyGovernor(max_per_engine={!r}, max_total={!r})'.format(
+            self._max_per_engine, self._max_total)
+
+    @property
+    def max_per_engine(self):
+        return self._max_per_engine
+
+    @property
+    def max_total(self):
+        return self._max_total
+
+    def _state(self, engine):
+        """Returns the state of engine; called with self._lock held"""
+        return self._engines.setdefault(engine.hostname_fqdn, {
+            'name': engine.name,
+            'limit': 1.0,
+            'in_flight': 0,
+            'latency': None,
+            'requests': 0,
+            'errors': 0,
+            'backoffs': 0,
+            'peak': 0})
+
+    def try_acquire(self, engine):
+        """Takes a slot for a query to engine, without waiting.
+        Returns True if the query may be sent now, False if engine (or all
+        Engines) already run as many queries as allowed."""
+        with self._lock:
+            state = self._state(engine)
+            if state['in_flight'] >= int(state['limit']) or self._in_flight >= self._max_total:
+                return False
+            state['in_flight'] += 1
+            state['peak'] = max(state['peak'], state['in_flight'])
+            self._in_flight += 1
+            return True
+
+    def release(self, engine):
+        """Frees the slot taken by try_acquire once the query to engine is done"""
+        with self._lock:
+            self._state(engine)['in_flight'] -= 1
+            self._in_flight -= 1
+
+    def record(self, engine, latency, failed):
+        """Records the outcome of a request to engine, and adapts its limit
+
+        Arguments:
+            engine: The EngineAppliance the request was sent to
+            latency: Seconds the request took
+            failed: True if the request failed (no answer, timeout or 5xx)
+        """
+        func_name = self.__class__.__name__ + '.' + inspect.currentframe().f_code.co_name
+        with self._lock:
+            state = self._state(engine)
+            state['requests'] += 1
+            spike = not failed and state['latency'] is not None and latency > self._spike_factor * state['latency']
+            previous = state['limit']
+            if failed or spike:
+                state['errors'] += 1 if failed else 0
+                state['backoffs'] += 1
+                state['limit'] = max(1.0, state['limit'] * self._backoff_factor)
+            else:
+                state['limit'] = min(float(self._max_per_engine), state['limit'] + 1.0 / state['limit'])
+            # Spikes are not part of the usual latency, so that a slow Engine keeps backing off
+            if not failed and not spike:
+                state['latency'] = latency if state['latency'] is None else \
+                    state['latency'] + self._LATENCY_WEIGHT * (latency - state['latency'])
+        if self._config.verbose and int(previous) != int(state['limit']):
+            self._logger.info('{0} - Engine "{1}": {2} requests at once ({3}).'.format(
+                func_name, engine.name, int(state['limit']),
+                'failed request' if failed else 'latency spike' if spike else 'stable latency'))
+
+    def summary(self):
+        """Returns {Engine name: {'limit', 'peak', 'requests', 'errors', 'backoffs'}}"""
+        with self._lock:
+            return dict((state['name'], {
+                'limit': int(state['limit']),
+                'peak': state['peak'],
+                'requests': state['requests'],
+                'errors': state['errors'],
+                'backoffs': state['backoffs']}) for state in self._engines.values())
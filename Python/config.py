@@ -4,14 +4,19 @@
 # Native modules
 import configparser
 from configparser import ExtendedInterpolation
+import copy
 import datetime
 import glob
 import logging
 from logging.handlers import RotatingFileHandler
 import os
+import re
 import socket
 import sys
 
+# Application specific modules
+from post_processing import Expression, parse_derive
+
 # Create the logger
 logger = logging.getLogger('logger')
 
@@ -26,6 +31,30 @@ class NXQLQuery(object):
         filename - The pattern to use to generate the file name (may include {query} and {rundate})
         delimiter - The delimiter to use between fields
         platforms - The platform qualifiers
+        output_mode - How engine results are written: "single" appends every
+            engine to one file, "sharded" writes one shard file per engine and
+            assembles them into the output file once all engines finish,
+            "delta" only writes the rows added, changed or removed since the
+            previous run
+        output_format - The format of the output file: "csv", "parquet" or "sqlite"
+        compression - How the output file is compressed: "none", "gzip" or "zstd"
+        sqlite_partition - For sqlite output, how the query's table is partitioned
+            by rundate: "none", "year", "month", "day" or "run"
+        sqlite_indexes - For sqlite output, the indexes to build after loading;
+            a ";" separated list of "," separated column names
+        remote_action_id - Optional UID of a Remote Action to trigger on the
+            devices found in the query results
+        remote_action_uid_field - The result field holding the device UID
+        delta_key - For delta output, the "," separated fields identifying a row
+        depends_on - Optional name of the query whose results parameterize this one
+        depends_field - The field of the depends_on query's results whose values
+            replace {depends} in the query
+        depends_chunk_size - The most values to put in a single query; more
+            values are sent as several queries
+        post_derive - Optional derived fields to add to the results, one
+            "name = expression" per line
+        post_filter - Optional expression the rows of the results must match
+        post_columns - Optional "," separated fields to keep, in order
     """
     
     @classmethod
@@ -46,6 +75,15 @@ class NXQLQuery(object):
         filename = primary_config.query_output_filename
         delimiter = primary_config.query_delimiter
         platforms = primary_config.query_platforms
+        output_mode = primary_config.query_output_mode
+        output_format = primary_config.query_output_format
+        compression = primary_config.query_compression
+        sqlite_partition = primary_config.query_sqlite_partition
+        sqlite_indexes = primary_config.query_sqlite_indexes
+        remote_action_id = None
+        remote_action_uid_field = 'uid'
+        delta_key = primary_config.query_delta_key
+        depends_chunk_size = primary_config.query_depends_chunk_size
 
         # Look for any configuration-file specific overrides
         if 'Overrides' in nxql_config.sections():
@@ -59,6 +97,24 @@ class NXQLQuery(object):
                 delimiter = nxql_config.get('Overrides', 'delimiter', raw=True)
             if 'platforms' in nxql_config['Overrides']:
                 platforms = nxql_config.get('Overrides', 'platforms', raw=True)
+            if 'output_mode' in nxql_config['Overrides']:
+                output_mode = nxql_config.get('Overrides', 'output_mode', raw=True)
+            if 'output_format' in nxql_config['Overrides']:
+                output_format = nxql_config.get('Overrides', 'output_format', raw=True)
+            if 'compression' in nxql_config['Overrides']:
+                compression = nxql_config.get('Overrides', 'compression', raw=True)
+            if 'sqlite_partition' in nxql_config['Overrides']:
+                sqlite_partition = nxql_config.get('Overrides', 'sqlite_partition', raw=True)
+            if 'sqlite_indexes' in nxql_config['Overrides']:
+                sqlite_indexes = nxql_config.get('Overrides', 'sqlite_indexes', raw=True)
+            if 'remote_action_id' in nxql_config['Overrides']:
+                remote_action_id = nxql_config.get('Overrides', 'remote_action_id', raw=True)
+            if 'remote_action_uid_field' in nxql_config['Overrides']:
+                remote_action_uid_field = nxql_config.get('Overrides', 'remote_action_uid_field', raw=True)
+            if 'delta_key' in nxql_config['Overrides']:
+                delta_key = nxql_config.get('Overrides', 'delta_key', raw=True)
+            if 'depends_chunk_size' in nxql_config['Overrides']:
+                depends_chunk_size = nxql_config.get('Overrides', 'depends_chunk_size', raw=True)
 
         # Look for any query/section specific overrides
         if 'query_output_path' in nxql_config[section_name]:
@@ -71,13 +127,120 @@ class NXQLQuery(object):
             delimiter = nxql_config.get(section_name, 'delimiter', raw=True)
         if 'platforms' in nxql_config[section_name]:
             platforms = nxql_config.get(section_name, 'platforms', raw=True)
+        if 'output_mode' in nxql_config[section_name]:
+            output_mode = nxql_config.get(section_name, 'output_mode', raw=True)
+        if 'output_format' in nxql_config[section_name]:
+            output_format = nxql_config.get(section_name, 'output_format', raw=True)
+        if 'compression' in nxql_config[section_name]:
+            compression = nxql_config.get(section_name, 'compression', raw=True)
+        if 'sqlite_partition' in nxql_config[section_name]:
+            sqlite_partition = nxql_config.get(section_name, 'sqlite_partition', raw=True)
+        if 'sqlite_indexes' in nxql_config[section_name]:
+            sqlite_indexes = nxql_config.get(section_name, 'sqlite_indexes', raw=True)
+        if 'remote_action_id' in nxql_config[section_name]:
+            remote_action_id = nxql_config.get(section_name, 'remote_action_id', raw=True)
+        if 'remote_action_uid_field' in nxql_config[section_name]:
+            remote_action_uid_field = nxql_config.get(section_name, 'remote_action_uid_field', raw=True)
+        if 'delta_key' in nxql_config[section_name]:
+            delta_key = nxql_config.get(section_name, 'delta_key', raw=True)
+        if 'depends_chunk_size' in nxql_config[section_name]:
+            depends_chunk_size = nxql_config.get(section_name, 'depends_chunk_size', raw=True)
+        # Dependencies are specific to a query section
+        depends_on = nxql_config.get(section_name, 'depends_on', raw=True, fallback=None) or None
+        depends_field = nxql_config.get(section_name, 'depends_field', raw=True, fallback=None) or None
+        # So is the post-processing of the results
+        post_derive = nxql_config.get(section_name, 'post_derive', raw=True, fallback=None) or ''
+        post_filter = nxql_config.get(section_name, 'post_filter', raw=True, fallback=None) or ''
+        post_columns = nxql_config.get(section_name, 'post_columns', raw=True, fallback=None) or ''
+
+        # Validate the values that are limited to a set of choices
+        if output_mode not in ['single', 'sharded', 'delta']:
+            msg = 'ERROR: Query "{0}" ("{1}") has an invalid output_mode "{2}"; expected "single", "sharded" or "delta".'.format(
+                section_name, primary_config.query_file, output_mode)
+            logger.error('NXQLQuery.create - {}'.format(msg))
+            print(msg)
+            return None
+        if output_format not in ['csv', 'parquet', 'sqlite']:
+            msg = 'ERROR: Query "{0}" ("{1}") has an invalid output_format "{2}"; expected "csv", "parquet" or "sqlite".'.format(
+                section_name, primary_config.query_file, output_format)
+            logger.error('NXQLQuery.create - {}'.format(msg))
+            print(msg)
+            return None
+        if output_format != 'csv' and output_mode in ['sharded', 'delta']:
+            msg = 'ERROR: Query "{0}" ("{1}") uses output_mode "{2}", which is only available with output_format "csv".'.format(
+                section_name, primary_config.query_file, output_mode)
+            logger.error('NXQLQuery.create - {}'.format(msg))
+            print(msg)
+            return None
+        if output_mode == 'delta' and not (delta_key or '').strip():
+            msg = 'ERROR: Query "{0}" ("{1}") uses output_mode "delta", which requires a delta_key.'.format(
+                section_name, primary_config.query_file)
+            logger.error('NXQLQuery.create - {}'.format(msg))
+            print(msg)
+            return None
+        if depends_on and not depends_field:
+            msg = 'ERROR: Query "{0}" ("{1}") depends on Query "{2}", which requires a depends_field.'.format(
+                section_name, primary_config.query_file, depends_on)
+            logger.error('NXQLQuery.create - {}'.format(msg))
+            print(msg)
+            return None
+        if depends_on and '{depends}' not in query:
+            msg = 'ERROR: Query "{0}" ("{1}") depends on Query "{2}", but does not use its values ({{depends}}).'.format(
+                section_name, primary_config.query_file, depends_on)
+            logger.error('NXQLQuery.create - {}'.format(msg))
+            print(msg)
+            return None
+        try:
+            parse_derive(post_derive)
+            if post_filter.strip():
+                Expression(post_filter)
+        except ValueError as e:
+            msg = 'ERROR: Query "{0}" ("{1}") has an invalid post-processing: {2}.'.format(
+                section_name, primary_config.query_file, e)
+            logger.error('NXQLQuery.create - {}'.format(msg))
+            print(msg)
+            return None
+        try:
+            depends_chunk_size = int(depends_chunk_size)
+        except ValueError:
+            depends_chunk_size = 0
+        if depends_chunk_size < 1:
+            msg = 'ERROR: Query "{0}" ("{1}") has an invalid depends_chunk_size; expected a positive number.'.format(
+                section_name, primary_config.query_file)
+            logger.error('NXQLQuery.create - {}'.format(msg))
+            print(msg)
+            return None
+        if compression not in ['none', 'gzip', 'zstd']:
+            msg = 'ERROR: Query "{0}" ("{1}") has an invalid compression "{2}"; expected "none", "gzip" or "zstd".'.format(
+                section_name, primary_config.query_file, compression)
+            logger.error('NXQLQuery.create - {}'.format(msg))
+            print(msg)
+            return None
+        if sqlite_partition not in ['none', 'year', 'month', 'day', 'run']:
+            msg = 'ERROR: Query "{0}" ("{1}") has an invalid sqlite_partition "{2}"; expected "none", "year", "month", "day" or "run".'.format(
+                section_name, primary_config.query_file, sqlite_partition)
+            logger.error('NXQLQuery.create - {}'.format(msg))
+            print(msg)
+            return None
+
+        # Compressed csv files get the matching extension (Parquet compresses internally)
+        extension = {'gzip': '.gz', 'zstd': '.zst'}.get(compression)
+        if extension and output_format == 'csv' and not filename.endswith(extension):
+            filename += extension
 
         # Create and return the object
         return cls(
             section_name, query, output_path, sub_folder, filename, delimiter,
-            platforms)
+            platforms, output_mode, output_format, compression, sqlite_partition,
+            sqlite_indexes, remote_action_id or None, remote_action_uid_field, delta_key,
+            depends_on, depends_field, depends_chunk_size, post_derive, post_filter, post_columns)
 
-    def __init__(self, name, query, output_path, sub_folder, filename, delimiter, platforms):
+    def __init__(self, name, query, output_path, sub_folder, filename, delimiter, platforms,
+                 output_mode='single', output_format='csv', compression='none',
+                 sqlite_partition='none', sqlite_indexes='', remote_action_id=None,
+                 remote_action_uid_field='uid', delta_key='', depends_on=None,
+                 depends_field=None, depends_chunk_size=200, post_derive='', post_filter='',
+                 post_columns=''):
         self._name = name
         self._query = query
         self._output_path = output_path
@@ -85,6 +248,20 @@ class NXQLQuery(object):
         self._filename = filename
         self._delimiter = delimiter
         self._platforms = platforms
+        self._output_mode = output_mode
+        self._output_format = output_format
+        self._compression = compression
+        self._sqlite_partition = sqlite_partition
+        self._sqlite_indexes = sqlite_indexes
+        self._remote_action_id = remote_action_id
+        self._remote_action_uid_field = remote_action_uid_field
+        self._delta_key = delta_key
+        self._depends_on = depends_on
+        self._depends_field = depends_field
+        self._depends_chunk_size = depends_chunk_size
+        self._post_derive = post_derive
+        self._post_filter = post_filter
+        self._post_columns = post_columns
 
     def __str__(self):
         return "%s(%r)" % (self.__class__, self.__dict__)
@@ -92,9 +269,17 @@ class NXQLQuery(object):
     def __repr__(self):
         return ('NXQLQuery(name={!r}, query={!r}, output_path={!r}, '
                 'sub_folder={!r}, filename={!r}, delimiter={!r}, '
-                'platforms={!r})'.format(
+                'platforms={!r}, output_mode={!r}, output_format={!r}, '
+                'compression={!r}, sqlite_partition={!r}, sqlite_indexes={!r}, '
+                'remote_action_id={!r}, remote_action_uid_field={!r}, delta_key={!r}, '
+                'depends_on={!r}, depends_field={!r}, depends_chunk_size={!r}, '
+                'post_derive={!r}, post_filter={!r}, post_columns={!r})'.format(
             self._name, self._query, self._output_path, self._sub_folder, 
-            self._filename, self._delimiter, self._platforms))
+            self._filename, self._delimiter, self._platforms, self._output_mode,
+            self._output_format, self._compression, self._sqlite_partition,
+            self._sqlite_indexes, self._remote_action_id, self._remote_action_uid_field,
+            self._delta_key, self._depends_on, self._depends_field, self._depends_chunk_size,
+            self._post_derive, self._post_filter, self._post_columns))
 
     def get(self, property):
         return self.__getattribute__("_"+property)
@@ -127,6 +312,126 @@ class NXQLQuery(object):
     def platforms(self):
         return self._platforms.split(',')
 
+    @property
+    def output_mode(self):
+        return self._output_mode
+
+    @property
+    def output_format(self):
+        return self._output_format
+
+    @property
+    def compression(self):
+        return self._compression
+
+    @property
+    def sqlite_partition(self):
+        return self._sqlite_partition
+
+    @property
+    def sqlite_indexes(self):
+        """ List of indexes, each a list of column names """
+        indexes = []
+        for index in (self._sqlite_indexes or '').split(';'):
+            columns = [c.strip() for c in index.split(',') if c.strip()]
+            if columns:
+                indexes.append(columns)
+        return indexes
+
+    @property
+    def remote_action_id(self):
+        return self._remote_action_id
+
+    @property
+    def remote_action_uid_field(self):
+        return self._remote_action_uid_field
+
+    @property
+    def delta_key(self):
+        """ List of the fields identifying a row, for delta output """
+        return [f.strip() for f in (self._delta_key or '').split(',') if f.strip()]
+
+    @property
+    def depends_on(self):
+        return self._depends_on
+
+    @property
+    def depends_field(self):
+        return self._depends_field
+
+    @property
+    def depends_chunk_size(self):
+        return self._depends_chunk_size
+
+    @property
+    def post_derive(self):
+        return self._post_derive
+
+    @property
+    def post_filter(self):
+        return self._post_filter
+
+    @property
+    def post_columns(self):
+        """ List of the fields to keep after post-processing, in order """
+        return [c.strip().strip('`') for c in (self._post_columns or '').split(',') if c.strip()]
+
+    def bind(self, values):
+        """ Returns a copy of the query with {depends} replaced by values:
+            strings double quoted, numbers as they are, separated by spaces,
+            e.g. (where device (eq name (string {depends}))) """
+        literals = []
+        for value in values:
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                literals.append(str(value))
+            else:
+                literals.append('"{}"'.format(str(value).replace('\\', '\\\\').replace('"', '\\"')))
+        bound = copy.copy(self)
+        bound._query = self._query.replace('{depends}', ' '.join(literals))
+        return bound
+
+    def limited(self, rows):
+        """ Returns a copy of the query returning at most rows rows per Engine:
+            its (limit ...) clause lowered to rows, or added if it has none """
+        limited = copy.copy(self)
+        match = re.search(r'\(\s*limit\s+(\d+)\s*\)', self._query, re.IGNORECASE)
+        if match:
+            limited._query = '{}(limit {}){}'.format(self._query[:match.start()],
+                min(rows, int(match.group(1))), self._query[match.end():])
+        else:
+            end = self._query.rstrip().rfind(')')
+            limited._query = '{} (limit {}){}'.format(self._query[:end].rstrip(), rows, self._query[end:])
+        return limited
+
+    @property
+    def fields(self):
+        """ The field names of the (select ...) clause of the query, in order,
+            with any double quotes removed (e.g. #"OS Name" becomes #OS Name).
+            Returns an empty list if the field list can not be determined
+            (e.g. the query selects from several tables). """
+        match = re.search(r'\(\s*select\s*\(', self._query, re.IGNORECASE)
+        if not match:
+            return []
+        fields = []
+        token = ''
+        in_quotes = False
+        for ch in self._query[match.end():]:
+            if ch == '"':
+                in_quotes = not in_quotes
+            elif in_quotes:
+                token += ch
+            elif ch == '(':
+                return []
+            elif ch == ')' or ch.isspace():
+                if token:
+                    fields.append(token)
+                    token = ''
+                if ch == ')':
+                    break
+            else:
+                token += ch
+        return fields
+
 
 class MultiEngineQueryConfig(object):
 
@@ -146,10 +451,16 @@ class MultiEngineQueryConfig(object):
         # Check for and process exclude (-x) flag
         # Set based on the presence of the -x flag and the f option
         self._exclude_device = True if args.exclude['file'] else False
+        # Run as a worker instance of a coordinator, which loads no queries
+        self._worker = args.worker is not None
         # Get the type of name being supplied: s)single, or g)group
         self._query_is_group = True if args.query_type == 'g' else False
-        # Capture the query group or section name
-        self._query_name = args.name
+        # Capture the query group or section name (a worker's log is named "worker")
+        self._query_name = args.name if args.name is not None else 'worker'
+        # Record the responses of the Appliances to a folder, or replay them from one
+        self._record_path = args.record
+        self._replay_path = args.replay
+        self._replay_latency = args.replay_latency
 
     def _load_config(self):
         # Get the environment infor (base name, path,etc.)
@@ -177,6 +488,8 @@ class MultiEngineQueryConfig(object):
     def _configure_logger(self):
         # Retrieve the environment string
         self._env = self._conf.get('General', 'environment')
+        # Ask the Portal and Engines for compressed (e.g. gzip) responses
+        self._http_compression = (self._conf.getint('General', 'http_compression', fallback=1) == 1)
         # Get Logging configuration information
         self._rundate = datetime.datetime.now().strftime('%Y%m%d-%H%M%S')
         log_name = '{}.{}.{}.{}.{}.log'.format(
@@ -186,6 +499,14 @@ class MultiEngineQueryConfig(object):
         print('Log file: {0}'.format(self._log_path))
         log_max_bytes = self._conf.getint('Logging', 'log_max_bytes') # Max size of a single log file
         log_backup_count = self._conf.getint('Logging', 'log_max_bytes') # Max number of log files before the files rollover
+        # Per run, per Engine, per query statistics database
+        self._run_stats = (self._conf.getint('Logging', 'run_stats', fallback=0) == 1)
+        self._stats_database = self._conf.get('Logging', 'stats_database', fallback='') or \
+            os.path.join(self._conf.get('Logging', 'log_path'), 'run_stats.db')
+        # Resources used by the run (CPU, memory, bytes, rows/s), in the email and next to the log file
+        self._resource_summary = (self._conf.getint('Logging', 'resource_summary', fallback=1) == 1)
+        # Timeline of the run (Chrome trace-event JSON), next to the log
+        self._run_trace = (self._conf.getint('Logging', 'run_trace', fallback=1) == 1)
         # Create the logger (Used by 'helpers' module too)
         logger = logging.getLogger('logger')
         handler = RotatingFileHandler(self._log_path, maxBytes=log_max_bytes, backupCount=log_backup_count)
@@ -214,6 +535,17 @@ class MultiEngineQueryConfig(object):
         self._email_remove_zip_log = (self._conf.getint('Email', 'email_remove_zip_log') == 1)
         self._email_include_unsuccessful = (self._conf.getint('Email', 'email_include_unsuccessful') == 1)
         self._email_include_deferred = (self._conf.getint('Email', 'email_include_deferred') == 1)
+        # Send the email from a background process, so that the run does not wait for it
+        self._email_async = (self._conf.getint('Email', 'email_async', fallback=1) == 1)
+        # Compression of the attached log, the most bytes of it to attach (its end), and the largest attachment
+        self._email_log_codec = self._conf.get('Email', 'email_log_codec', fallback='lzma').strip().lower()
+        if self._email_log_codec not in ['lzma', 'bzip2', 'deflate', 'gzip', 'zstd']:
+            print('WARNING: Unknown email_log_codec "{0}", using lzma.'.format(self._email_log_codec))
+            self._email_log_codec = 'lzma'
+        self._email_log_max_bytes = max(0, self._conf.getint('Email', 'email_log_max_bytes', fallback=0))
+        self._email_max_attachment_bytes = max(0, self._conf.getint('Email', 'email_max_attachment_bytes', fallback=0))
+        # Verify the recipients with VRFY before sending (otherwise the server checks them when sending)
+        self._email_verify_recipients = (self._conf.getint('Email', 'email_verify_recipients', fallback=1) == 1)
         self._email_body = []
         # Portal related
         self._portal_server = self._conf.get('Portal', 'portal_server')
@@ -222,9 +554,59 @@ class MultiEngineQueryConfig(object):
         self._portal_credentials = self._conf.get('Portal', 'portal_credentials', raw=True)
         self._portal_list_engines_api = self._conf.get('Portal', 'portal_list_engines_api')
         self._portal_remote_action_api = self._conf.get('Portal', 'portal_remote_action_api')
+        # Other Portals queried in the same run, one [Portal:<label>] section
+        # each, with the [Portal] settings as defaults (but for the name,
+        # which defaults to the label)
+        self._portal_federation = []
+        for section in self._conf.sections():
+            if section.startswith('Portal:'):
+                settings = dict(
+                    (key, self._conf.get(section, key, raw=True, fallback=self._conf.get('Portal', key, raw=True)))
+                    for key in ['portal_server', 'portal_port', 'portal_credentials',
+                                'portal_list_engines_api', 'portal_remote_action_api'])
+                settings['portal_name'] = self._conf.get(section, 'portal_name', fallback=section[len('Portal:'):].strip())
+                self._portal_federation.append(settings)
+        # The Portal names prefix the Engine names and route the Remote Actions, so they must differ
+        portal_names = [self._portal_name] + [settings['portal_name'] for settings in self._portal_federation]
+        duplicates = sorted(set(name for name in portal_names if portal_names.count(name) > 1))
+        if duplicates:
+            print('ERROR: Several Portals are named {0}; set a different portal_name in each [Portal:<label>] section.'.format(
+                ', '.join('"{0}"'.format(name) for name in duplicates)))
+            exit(1)
+        # Remote Actions triggered from query results: devices per call,
+        # concurrent calls, and calls started per second (burst allowed)
+        self._portal_remote_action_batch_size = max(1, self._conf.getint('Portal', 'portal_remote_action_batch_size', fallback=1000))
+        self._portal_remote_action_max_workers = max(1, self._conf.getint('Portal', 'portal_remote_action_max_workers', fallback=2))
+        self._portal_remote_action_rate = self._conf.getfloat('Portal', 'portal_remote_action_rate', fallback=1.0)
+        self._portal_remote_action_burst = max(1, self._conf.getint('Portal', 'portal_remote_action_burst', fallback=2))
         # Engine related
         self._engine_port = self._conf.get('Engine', 'engine_port')
         self._engine_credentials = self._conf.get('Engine', 'engine_credentials')
+        # Number of Engines to query at the same time (1 queries them one after the other)
+        self._engine_max_workers = max(1, self._conf.getint('Engine', 'engine_max_workers', fallback=1))
+        # Number of processes decoding and encoding csv results (0 does it in the Engine's thread)
+        self._engine_decode_processes = max(0, self._conf.getint('Engine', 'engine_decode_processes', fallback=0))
+        # Probe the Engines before querying them, skip the unreachable ones, and start the slowest first
+        self._engine_probe = (self._conf.getint('Engine', 'engine_probe', fallback=0) == 1)
+        self._engine_probe_timeout = self._conf.getfloat('Engine', 'engine_probe_timeout', fallback=3.0)
+        self._engine_probe_cache_seconds = self._conf.getint('Engine', 'engine_probe_cache_seconds', fallback=300)
+        # Seconds to wait for an Engine to answer a query (0 waits as long as it takes)
+        self._engine_request_timeout = max(0.0, self._conf.getfloat('Engine', 'engine_request_timeout', fallback=0.0))
+        # Adaptive number of queries sent to an Engine at once (1 runs the queries one after the other)
+        self._engine_max_requests_per_engine = max(1, self._conf.getint('Engine', 'engine_max_requests_per_engine', fallback=1))
+        self._engine_latency_spike_factor = max(1.0, self._conf.getfloat('Engine', 'engine_latency_spike_factor', fallback=2.0))
+        self._engine_backoff_factor = min(0.9, max(0.1, self._conf.getfloat('Engine', 'engine_backoff_factor', fallback=0.5)))
+        # Limit of the queries sent to an Engine at once by all the instances on this host (0 does not coordinate them)
+        self._engine_host_max_requests = max(0, self._conf.getint('Engine', 'engine_host_max_requests', fallback=0))
+        self._engine_lock_path = self._conf.get('Engine', 'engine_lock_path', fallback='') or \
+            os.path.join(self._conf.get('Logging', 'log_path'), '.engine-locks')
+        self._engine_share_requests = self._conf.getboolean('Engine', 'engine_share_requests', fallback=True)
+        # Worker instances querying the Engines (see distributed.WorkerCoordinator)
+        self._workers = [w.strip() for w in self._conf.get('Distributed', 'workers', fallback='').split(',') if w.strip()]
+        self._worker_authkey = self._conf.get('Distributed', 'worker_authkey', raw=True, fallback='')
+        self._worker_address = self._conf.get('Distributed', 'worker_address', fallback='127.0.0.1:17171')
+        self._worker_chunk_size = max(4096, self._conf.getint('Distributed', 'worker_chunk_size', fallback=1048576))
+        self._worker_connect_timeout = self._conf.getfloat('Distributed', 'worker_connect_timeout', fallback=10.0)
         # Query location items
         self._query_path = self._conf.get('Queries', 'query_path', raw=True)
         self._query_pattern = self._conf.get('Queries', 'query_pattern', raw=True)
@@ -240,6 +622,30 @@ class MultiEngineQueryConfig(object):
         # The default platform specifier.
         # May be overridden in the individual query file.
         self._query_platforms = self._conf.get('Queries', 'platforms', raw=True)
+        # The default output mode (single, sharded or delta).
+        # May be overridden in the individual query file.
+        self._query_output_mode = self._conf.get('Queries', 'output_mode', raw=True, fallback='single')
+        # The default output format (csv, parquet or sqlite).
+        # May be overridden in the individual query file.
+        self._query_output_format = self._conf.get('Queries', 'output_format', raw=True, fallback='csv')
+        # The default output compression (none, gzip or zstd).
+        # May be overridden in the individual query file.
+        self._query_compression = self._conf.get('Queries', 'compression', raw=True, fallback='none')
+        # The default table partitioning and indexes for sqlite output.
+        # May be overridden in the individual query file.
+        self._query_sqlite_partition = self._conf.get('Queries', 'sqlite_partition', raw=True, fallback='none')
+        self._query_sqlite_indexes = self._conf.get('Queries', 'sqlite_indexes', raw=True, fallback='')
+        # The default fields identifying a row, for delta output.
+        # May be overridden in the individual query file.
+        self._query_delta_key = self._conf.get('Queries', 'delta_key', raw=True, fallback='')
+        self._query_depends_chunk_size = self._conf.get('Queries', 'depends_chunk_size', raw=True, fallback='200')
+        # Run the queries of a group that only differ by their fields as a single query
+        self._merge_queries = (self._conf.getint('Queries', 'merge_queries', fallback=0) == 1)
+        # Save the progress and results of every run, so that it can be resumed (--resume)
+        self._checkpoint = (self._conf.getint('Queries', 'checkpoint', fallback=0) == 1)
+        # Engines sampled, and rows per Engine, when previewing the queries (--preview)
+        self._preview_engines = max(1, self._conf.getint('Queries', 'preview_engines', fallback=3))
+        self._preview_rows = max(1, self._conf.getint('Queries', 'preview_rows', fallback=100))
 
     def _load_queries(self):
         # Get the list of qury files
@@ -288,6 +694,8 @@ class MultiEngineQueryConfig(object):
             query = NXQLQuery.create(self, query_conf, self._query_name)
             if query:
                 self._queries.append(query)
+        # Run every query after the query it depends on
+        self._queries = self._order_queries(self._queries)
         # If no valid queries were able to be created, than exit
         if len(self._queries) == 0:
             msg = 'ERROR: No valid queries were able to be found for the specified Query Group, or Named Query ("{0}") in "{1}".'.format(
@@ -296,12 +704,57 @@ class MultiEngineQueryConfig(object):
             print(msg)
             exit(3)
     
+    def _order_queries(self, queries):
+        """ Returns the queries sorted so that each query comes after the query
+            it depends on, leaving out (with an error) the queries whose
+            dependency is not part of the run, is circular, or is left out """
+        by_name = dict((query.name, query) for query in queries)
+        ordered = []
+        valid = {}
+
+        def visit(query, path):
+            if query.name in valid:
+                return valid[query.name]
+            if query in path:
+                msg = 'ERROR: Query "{0}" ("{1}") is part of a circular dependency ({2}).'.format(
+                    query.name, self._qf, ' -> '.join(q.name for q in path[path.index(query):] + [query]))
+                logger.error('_order_queries - {}'.format(msg))
+                print(msg)
+                return False
+            ok = True
+            if query.depends_on:
+                dependency = by_name.get(query.depends_on)
+                if dependency is None:
+                    msg = 'ERROR: Query "{0}" ("{1}") depends on Query "{2}", which is not part of this run.'.format(
+                        query.name, self._qf, query.depends_on)
+                    logger.error('_order_queries - {}'.format(msg))
+                    print(msg)
+                    ok = False
+                elif not visit(dependency, path + [query]):
+                    msg = 'ERROR: Query "{0}" ("{1}") is skipped, as Query "{2}" it depends on is not valid.'.format(
+                        query.name, self._qf, query.depends_on)
+                    logger.error('_order_queries - {}'.format(msg))
+                    print(msg)
+                    ok = False
+            valid[query.name] = ok
+            if ok:
+                ordered.append(query)
+            return ok
+
+        for query in queries:
+            visit(query, [])
+        return ordered
+
     def __init__(self, args):
         self._configure_args(args)
         self._load_config()
         self._configure_logger()
         self._load_items()
-        self._load_queries()
+        if self._worker:
+            self._qf = None
+            self._queries = []
+        else:
+            self._load_queries()
         logger.debug('config: {}'.format(self))
 
     def __str__(self):
@@ -314,10 +767,59 @@ class MultiEngineQueryConfig(object):
     def rundate(self):
         return self._rundate
 
+    @rundate.setter
+    def rundate(self, rundate):
+        """Set when resuming the run started at rundate"""
+        self._rundate = rundate
+
     @property
     def log_path(self):
         return self._log_path
 
+    @property
+    def http_compression(self):
+        return self._http_compression
+
+    @property
+    def merge_queries(self):
+        return self._merge_queries
+
+    @property
+    def checkpoint(self):
+        return self._checkpoint
+
+    @property
+    def preview_engines(self):
+        return self._preview_engines
+
+    @property
+    def preview_rows(self):
+        return self._preview_rows
+
+    @property
+    def run_stats(self):
+        return self._run_stats
+
+    @property
+    def stats_database(self):
+        return self._stats_database
+
+    @property
+    def resource_summary(self):
+        return self._resource_summary
+
+    @property
+    def resource_summary_path(self):
+        return os.path.splitext(self._log_path)[0] + '.resources.json'
+
+    @property
+    def run_trace(self):
+        return self._run_trace
+
+    @property
+    def run_trace_path(self):
+        return os.path.splitext(self._log_path)[0] + '.trace.json'
+
     @property
     def verbose(self):
         return self._info
@@ -398,6 +900,26 @@ class MultiEngineQueryConfig(object):
     def email_include_deferred(self):
         return self._email_include_deferred
 
+    @property
+    def email_async(self):
+        return self._email_async
+
+    @property
+    def email_log_codec(self):
+        return self._email_log_codec
+
+    @property
+    def email_log_max_bytes(self):
+        return self._email_log_max_bytes
+
+    @property
+    def email_max_attachment_bytes(self):
+        return self._email_max_attachment_bytes
+
+    @property
+    def email_verify_recipients(self):
+        return self._email_verify_recipients
+
     @property
     def email_body(self):
         return self._email_body
@@ -427,10 +949,33 @@ class MultiEngineQueryConfig(object):
     def portal_act_api(self):
         return self._portal_remote_action_api
         
+    @property
+    def portal_federation(self):
+        """ List of dicts holding the settings of the other Portals (portal_server,
+            portal_name, portal_port, portal_credentials, portal_list_engines_api
+            and portal_remote_action_api) """
+        return self._portal_federation
+
     @property
     def portal_list_engines_api(self):
         return self._portal_list_engines_api
 
+    @property
+    def portal_remote_action_batch_size(self):
+        return self._portal_remote_action_batch_size
+
+    @property
+    def portal_remote_action_max_workers(self):
+        return self._portal_remote_action_max_workers
+
+    @property
+    def portal_remote_action_rate(self):
+        return self._portal_remote_action_rate
+
+    @property
+    def portal_remote_action_burst(self):
+        return self._portal_remote_action_burst
+
     @property
     def engine_port(self):
         return self._engine_port
@@ -439,11 +984,95 @@ class MultiEngineQueryConfig(object):
     def engine_credentials(self):
         """ Base-64 encoded username:password for Basic Auth """
         return self._engine_credentials
+
+    @property
+    def engine_max_workers(self):
+        return self._engine_max_workers
+
+    @property
+    def engine_decode_processes(self):
+        return self._engine_decode_processes
+
+    @property
+    def engine_probe(self):
+        return self._engine_probe
+
+    @property
+    def engine_probe_timeout(self):
+        return self._engine_probe_timeout
+
+    @property
+    def engine_probe_cache_seconds(self):
+        return self._engine_probe_cache_seconds
+
+    @property
+    def engine_health_path(self):
+        return os.path.join(os.path.dirname(self._log_path), '.engine_health.json')
+
+    @property
+    def engine_request_timeout(self):
+        return self._engine_request_timeout
+
+    @property
+    def engine_max_requests_per_engine(self):
+        return self._engine_max_requests_per_engine
+
+    @property
+    def engine_latency_spike_factor(self):
+        return self._engine_latency_spike_factor
+
+    @property
+    def engine_backoff_factor(self):
+        return self._engine_backoff_factor
+
+    @property
+    def engine_host_max_requests(self):
+        return self._engine_host_max_requests
+
+    @property
+    def engine_lock_path(self):
+        return self._engine_lock_path
+
+    @property
+    def engine_share_requests(self):
+        return self._engine_share_requests
+
+    @property
+    def workers(self):
+        return self._workers
+
+    @property
+    def worker_authkey(self):
+        return self._worker_authkey
+
+    @property
+    def worker_address(self):
+        return self._worker_address
+
+    @property
+    def worker_chunk_size(self):
+        return self._worker_chunk_size
+
+    @property
+    def worker_connect_timeout(self):
+        return self._worker_connect_timeout
     
     @property
     def query_is_group(self):
         return self._query_is_group
     
+    @property
+    def record_path(self):
+        return self._record_path
+
+    @property
+    def replay_path(self):
+        return self._replay_path
+
+    @property
+    def replay_latency(self):
+        return self._replay_latency
+
     @property
     def query_name(self):
         return self._query_name
@@ -472,3 +1101,31 @@ class MultiEngineQueryConfig(object):
     def query_platforms(self):
         return self._query_platforms
 
+    @property
+    def query_output_mode(self):
+        return self._query_output_mode
+
+    @property
+    def query_output_format(self):
+        return self._query_output_format
+
+    @property
+    def query_compression(self):
+        return self._query_compression
+
+    @property
+    def query_sqlite_partition(self):
+        return self._query_sqlite_partition
+
+    @property
+    def query_sqlite_indexes(self):
+        return self._query_sqlite_indexes
+
+    @property
+    def query_delta_key(self):
+        return self._query_delta_key
+
+    @property
+    def query_depends_chunk_size(self):
+        return self._query_depends_chunk_size
+
@@ -0,0 +1,145 @@
+"""Row hash index for the delta output of multi_engine_query"""
+
+# Native modules
+from array import array
+import bisect
+import hashlib
+import inspect
+import json
+import logging
+import mmap
+import os
+import struct
+import sys
+
+# Create the logger
+logger = logging.getLogger('logger')
+
+def row_hash(value):
+    """ Returns a 64 bit hash of a JSON serializable value
+
+    Arguments:
+        value: The value to hash (e.g. the list of key field values of a row)
+    Returns:
+        int: the hash
+    """
+    data = json.dumps(value, sort_keys=True, separators=(',', ':'), default=str).encode('utf-8')
+    return int.from_bytes(hashlib.blake2b(data, digest_size=8).digest(), 'little')
+
+class DeltaIndex(object):
+    """The rows of a query's previous run, as a memory-mapped file of hashes.
+
+    The file holds a header, the sorted key hashes of the rows, their
+    content hashes in the same order, and, for every row, the JSON list
+    [engine name, key field values...] so that removed rows can be reported.
+    The arrays are stored in the machine's native byte order, and read in
+    place: looking a row up is a binary search in the mapped file, so the
+    index is not loaded in memory.
+
+    Attributes:
+        path: The index file name
+        count: The number of rows in the index
+    """
+
+    _MAGIC = b'MEQDIDX' + (b'L' if sys.byteorder == 'little' else b'B')
+    _HEADER = struct.Struct('<8sQ')
+
+    def __init__(self, logger, path):
+        self._logger = logger
+        self._path = path
+        self._file = None
+        self._mmap = None
+        self._keys = []
+        self._contents = []
+        self._offsets = []
+        self._entries = 0
+
+    def __repr__(self):
+        return 'DeltaIndex(path={!r}, count={!r})'.format(self._path, self.count)
+
+    @property
+    def path(self):
+        return self._path
+
+    @property
+    def count(self):
+        return len(self._keys)
+
+    def open(self):
+        """Maps the index file, if it exists. Returns True if the previous run's
+        rows are available."""
+        func_name = self.__class__.__name__ + '.' + inspect.currentframe().f_code.co_name
+        if not os.path.exists(self._path):
+            return False
+        try:
+            self._file = open(self._path, 'rb')
+            self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+            magic, count = self._HEADER.unpack_from(self._mmap, 0)
+            if magic != self._MAGIC:
+                raise ValueError('not a delta index for this machine')
+            view = memoryview(self._mmap)
+            start = self._HEADER.size
+            self._keys = view[start:start + 8 * count].cast('Q')
+            start += 8 * count
+            self._contents = view[start:start + 8 * count].cast('Q')
+            start += 8 * count
+            self._offsets = view[start:start + 8 * (count + 1)].cast('Q')
+            self._entries = start + 8 * (count + 1)
+        except (IOError, OSError, ValueError, struct.error) as e:
+            self._logger.error('{0} - Unable to read the delta index "{1}", all rows are reported as added: {2}'.format(
+                func_name, self._path, e))
+            self.close()
+            return False
+        return True
+
+    def lookup(self, key_hash):
+        """Returns the content hash of the row with key_hash, or None if it is not in the index"""
+        position = bisect.bisect_left(self._keys, key_hash)
+        if position < len(self._keys) and self._keys[position] == key_hash:
+            return self._contents[position]
+        return None
+
+    def rows(self):
+        """Yields (key hash, content hash, [engine name, key field values...]) for every row"""
+        for position in range(len(self._keys)):
+            entry = self._mmap[self._entries + self._offsets[position]:self._entries + self._offsets[position + 1]]
+            yield self._keys[position], self._contents[position], json.loads(entry.decode('utf-8'))
+
+    def close(self):
+        """Unmaps the index file"""
+        for view in (self._keys, self._contents, self._offsets):
+            if isinstance(view, memoryview):
+                view.release()
+        self._keys, self._contents, self._offsets = [], [], []
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    @classmethod
+    def write(cls, path, rows):
+        """ Writes a new index file, replacing path once it is complete
+
+        Arguments:
+            path: The index file name
+            rows: dict of key hash: (content hash, [engine name, key field values...])
+        """
+        keys = array('Q', sorted(rows))
+        contents = array('Q')
+        offsets = array('Q', [0])
+        entries = []
+        for key_hash in keys:
+            content_hash, entry = rows[key_hash]
+            contents.append(content_hash)
+            entries.append(json.dumps(entry, separators=(',', ':'), default=str).encode('utf-8'))
+            offsets.append(offsets[-1] + len(entries[-1]))
+        with open(path + '.part', 'wb') as f:
+            f.write(cls._HEADER.pack(cls._MAGIC, len(keys)))
+            keys.tofile(f)
+            contents.tofile(f)
+            offsets.tofile(f)
+            for entry in entries:
+                f.write(entry)
+        os.replace(path + '.part', path)
@@ -0,0 +1,412 @@
+"""Coordinator and worker instances of multi_engine_query"""
+
+# Native modules
+from concurrent.futures import ThreadPoolExecutor
+import inspect
+import json
+import logging
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Client, Listener
+import threading
+import time
+import zlib
+
+# Application specific modules
+from appliance_classes import EngineAppliance
+from host_locks import HostEngineLocks
+from result_encoding import decode_json
+from timer import timer
+
+# Create the logger
+logger = logging.getLogger('logger')
+
+def parse_address(address, default_host='127.0.0.1'):
+    """ Returns the (host, port) of a "host:port" or "port" address """
+    host, _, port = address.strip().rpartition(':')
+    return (host or default_host, int(port))
+
+class WorkerLink(object):
+    """A connection from the coordinator to a worker instance.
+
+    Requests and responses are framed by multiprocessing.connection, which
+    also authenticates both ends with the shared worker_authkey. Every
+    message is a JSON header; a response body follows its "chunk" headers as
+    zlib compressed frames, so that several requests can be in flight on the
+    same connection.
+
+    Attributes:
+        address: The (host, port) of the worker
+        alive: False once the connection failed
+        requests: Number of requests answered
+        link_bytes: Bytes of results received over the connection
+    """
+
+    def __init__(self, logger, address, authkey, connect_timeout=None):
+        self._logger = logger
+        self._address = address
+        self._authkey = authkey
+        self._connect_timeout = connect_timeout
+        self._conn = None
+        self._send_lock = threading.Lock()
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._next_id = 0
+        self._alive = False
+        self._requests = 0
+        self._link_bytes = 0
+        self._reader = None
+
+    def __repr__(self):
+        return 'WorkerLink(address={!r}, alive={!r})'.format(self._address, self._alive)
+
+    @property
+    def address(self):
+        return self._address
+
+    @property
+    def alive(self):
+        return self._alive
+
+    @property
+    def requests(self):
+        return self._requests
+
+    @property
+    def link_bytes(self):
+        return self._link_bytes
+
+    def connect(self):
+        """Connects to the worker, waiting at most connect_timeout seconds for
+        it to accept the connection and authenticate it. Returns True if successful."""
+        func_name = self.__class__.__name__ + '.' + inspect.currentframe().f_code.co_name
+        # Client has no timeout, so it connects in a thread of its own
+        outcome = {'conn': None, 'error': None, 'abandoned': False}
+        outcome_lock = threading.Lock()
+
+        def connect_client():
+            try:
+                conn = Client(self._address, authkey=self._authkey)
+            except (OSError, EOFError, AuthenticationError) as e:
+                outcome['error'] = e
+                return
+            with outcome_lock:
+                if outcome['abandoned']:
+                    conn.close()
+                else:
+                    outcome['conn'] = conn
+
+        connecting = threading.Thread(target=connect_client, name='connect-{}:{}'.format(*self._address), daemon=True)
+        connecting.start()
+        connecting.join(self._connect_timeout)
+        with outcome_lock:
+            outcome['abandoned'] = outcome['conn'] is None
+            self._conn = outcome['conn']
+        if self._conn is None:
+            self._logger.error('{0} - Unable to connect to the worker at {1}:{2}: {3}'.format(
+                func_name, self._address[0], self._address[1],
+                repr(outcome['error']) if outcome['error'] is not None else
+                'it did not answer within {} seconds'.format(self._connect_timeout)))
+            return False
+        self._alive = True
+        self._reader = threading.Thread(target=self._read, name='worker-{}:{}'.format(*self._address), daemon=True)
+        self._reader.start()
+        return True
+
+    def _read(self):
+        """Dispatches the responses of the worker to the pending requests"""
+        func_name = self.__class__.__name__ + '.' + inspect.currentframe().f_code.co_name
+        try:
+            while True:
+                header = json.loads(self._conn.recv_bytes().decode('utf-8'))
+                with self._lock:
+                    pending = self._pending.get(header['id'])
+                if header['type'] == 'chunk':
+                    data = self._conn.recv_bytes()
+                    self._link_bytes += len(data)
+                    if pending is not None:
+                        pending['chunks'].append(pending['decompressor'].decompress(data))
+                elif pending is not None:
+                    pending['header'] = header
+                    pending['event'].set()
+        except (EOFError, OSError, ValueError, zlib.error) as e:
+            if self._alive:
+                self._logger.error('{0} - Lost the connection to the worker at {1}:{2}: {3!r}'.format(
+                    func_name, self._address[0], self._address[1], e))
+        self._alive = False
+        with self._lock:
+            for pending in self._pending.values():
+                pending['event'].set()
+
+    def request(self, message, timeout=None):
+        """ Sends a request and waits for its response
+
+        Arguments:
+            message: dict holding the request
+            timeout: Optional seconds to wait for the response
+        Returns:
+            dict: the response header, or None if the worker did not answer
+            bytes: the response body
+        """
+        pending = {'event': threading.Event(), 'chunks': [], 'header': None,
+                   'decompressor': zlib.decompressobj()}
+        with self._lock:
+            self._next_id += 1
+            request_id = self._next_id
+            self._pending[request_id] = pending
+        try:
+            with self._send_lock:
+                self._conn.send_bytes(json.dumps(dict(message, id=request_id)).encode('utf-8'))
+        except (OSError, ValueError):
+            self._alive = False
+        if self._alive:
+            pending['event'].wait(timeout)
+        with self._lock:
+            del self._pending[request_id]
+        if pending['header'] is None:
+            return None, b''
+        self._requests += 1
+        return pending['header'], b''.join(pending['chunks']) + pending['decompressor'].flush()
+
+    def close(self):
+        """Tells the worker that the coordinator is done, and disconnects"""
+        if self._conn is None:
+            return
+        if self._alive:
+            # Not alive anymore, so that the worker closing the connection is not reported
+            self._alive = False
+            try:
+                with self._send_lock:
+                    self._conn.send_bytes(json.dumps({'op': 'close'}).encode('utf-8'))
+            except (OSError, ValueError):
+                pass
+        self._conn.close()
+
+class RemoteEngineAppliance(EngineAppliance):
+    """An Engine queried through a worker instance: its API calls are sent
+    to the worker the Engine is assigned to, which runs them and streams the
+    results back.
+
+    Attributes:
+        link: The WorkerLink of the worker the Engine is assigned to
+    """
+
+    def __init__(self, engine, coordinator):
+        super(RemoteEngineAppliance, self).__init__(engine.hostname_fqdn, engine.name, engine.port,
+            engine._credentials, portal=engine.portal)
+        self._coordinator = coordinator
+        self._link = None
+
+    def __repr__(self):
+        return 'RemoteEngineAppliance(hostname_fqdn={!r}, name={!r}, port={!r}, portal={!r}, link={!r})'.format(
+            self._hostname_fqdn, self._name, self._port, self._portal, self._link)
+
+    @property
+    def link(self):
+        return self._link
+
+    @link.setter
+    def link(self, link):
+        self._link = link
+
+    def execute_json_api(self, api, raw=False, response_info=None, timeout=None):
+        """Runs the API call on the Engine's worker; see Appliance.execute_json_api"""
+        func_name = self.__class__.__name__ + '.' + inspect.currentframe().f_code.co_name
+        header, body = None, b''
+        while header is None:
+            link = self._coordinator.link_for(self)
+            if link is None:
+                self._coordinator.logger.error('{0} - No worker is available to query Engine "{1}".'.format(
+                    func_name, self._name))
+                return None
+            header, body = link.request({
+                'op': 'query',
+                'hostname': self._hostname_fqdn,
+                'name': self._name,
+                'port': self._port,
+                'portal': self._portal,
+                'api': api,
+                'timeout': timeout}, timeout=(timeout + 30) if timeout else None)
+            if header is None and link.alive:
+                # The worker is up, but did not answer in time
+                return None
+        if not header['ok']:
+            return None
+        info = header['info']
+        with self._transfer_lock:
+            self._transfer['responses'] += 1
+            self._transfer['bytes'] += info.get('bytes', len(body))
+            self._transfer['wire_bytes'] += info.get('wire_bytes', len(body))
+            encoding = info.get('content_encoding', 'identity')
+            if encoding not in self._transfer['encodings']:
+                self._transfer['encodings'].append(encoding)
+        if response_info is not None:
+            response_info.update(info)
+        return body if raw else decode_json(body)
+
+class WorkerCoordinator(object):
+    """Splits the Engines into shards, one per worker instance
+    ([Distributed] workers), and sends the queries of every Engine to the
+    worker of its shard. The outputs are assembled by the coordinator, as
+    the workers stream the results back. The Engines of a worker whose
+    connection fails are moved to the other workers.
+
+    Attributes:
+        links: The WorkerLink of every worker
+        logger: Initialized logger instance
+    """
+
+    def __init__(self, logger, config):
+        self._logger = logger
+        self._config = config
+        self._links = [WorkerLink(logger, parse_address(address), config.worker_authkey.encode('utf-8'),
+                                  config.worker_connect_timeout) for address in config.workers]
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return 'WorkerCoordinator(links={!r})'.format(self._links)
+
+    @property
+    def links(self):
+        return self._links
+
+    @property
+    def logger(self):
+        return self._logger
+
+    def connect(self):
+        """Connects to the workers. Returns True if at least one is available."""
+        connected = [link for link in self._links if link.connect()]
+        return len(connected) > 0
+
+    def assign(self, engine_list):
+        """ Returns the Engines of engine_list as RemoteEngineAppliance
+        instances, dealt to the available workers in order (engine_list is
+        sorted slowest first by the health schedule, so the slow Engines are
+        spread over the workers). """
+        live = [link for link in self._links if link.alive]
+        engines = []
+        for position, engine in enumerate(engine_list):
+            remote = RemoteEngineAppliance(engine, self)
+            remote.link = live[position % len(live)]
+            engines.append(remote)
+        return engines
+
+    def link_for(self, engine):
+        """Returns the link of engine's worker, moving the Engine to another
+        worker if its worker is down; None if no worker is available"""
+        func_name = self.__class__.__name__ + '.' + inspect.currentframe().f_code.co_name
+        with self._lock:
+            if engine.link is not None and engine.link.alive:
+                return engine.link
+            live = [link for link in self._links if link.alive]
+            if not live:
+                return None
+            link = min(live, key=lambda l: l.requests)
+            self._logger.warning('{0} - Moving Engine "{1}" to the worker at {2}:{3}.'.format(
+                func_name, engine.name, link.address[0], link.address[1]))
+            engine.link = link
+            return link
+
+    def close(self):
+        for link in self._links:
+            link.close()
+
+def serve_worker(logger, config, address):
+    """ Runs a worker instance: listens on address for a coordinator, and
+    runs the API calls it sends against its Engines (with the credentials
+    of this instance's configuration), config.engine_max_workers at a time,
+    streaming the results back in zlib compressed chunks of
+    config.worker_chunk_size bytes. Serves every coordinator that connects
+    in a thread of its own, so that a coordinator never waits for another
+    one to be done, until interrupted. Coordinates the Engine queries with the other
+    instances on the worker's host, if config.engine_host_max_requests.
+
+    Arguments:
+        logger: Initialized logger instance
+        config: Initialized MultiEngineQueryConfig object
+        address: The (host, port) to listen on
+    """
+    func_name = inspect.currentframe().f_code.co_name
+    credentials = {config.portal_name: config.portal_credentials}
+    for settings in config.portal_federation:
+        credentials[settings['portal_name']] = settings['portal_credentials']
+    engines = {}
+    engines_lock = threading.Lock()
+    # Coordinate the queries with the other instances on this host, if configured
+    locks = None
+    if config.engine_host_max_requests > 0 and HostEngineLocks.available():
+        locks = HostEngineLocks(logger, config)
+        if not locks.open():
+            locks = None
+
+    def get_engine(message):
+        key = (message['hostname'], message['port'], message['portal'])
+        with engines_lock:
+            if key not in engines:
+                engines[key] = EngineAppliance(message['hostname'], message['name'], message['port'],
+                    credentials.get(message['portal'], config.portal_credentials), portal=message['portal'])
+            return engines[key]
+
+    def answer(conn, send_lock, message):
+        engine = get_engine(message)
+        info = {}
+        try:
+            if locks is not None:
+                body = locks.execute(engine, message['api'], lambda fetch_info: engine.execute_json_api(
+                    message['api'], raw=True, response_info=fetch_info, timeout=message['timeout']), info)
+            else:
+                body = engine.execute_json_api(message['api'], raw=True, response_info=info, timeout=message['timeout'])
+        except Exception as exc:
+            logger.error('{0} - Unexpected error querying Engine "{1}": {2!r}'.format(func_name, engine.name, exc))
+            body = None
+        try:
+            if body is not None:
+                compressor = zlib.compressobj(1)
+                for position in range(0, len(body), config.worker_chunk_size):
+                    data = compressor.compress(body[position:position + config.worker_chunk_size])
+                    if data:
+                        with send_lock:
+                            conn.send_bytes(json.dumps({'id': message['id'], 'type': 'chunk'}).encode('utf-8'))
+                            conn.send_bytes(data)
+                with send_lock:
+                    conn.send_bytes(json.dumps({'id': message['id'], 'type': 'chunk'}).encode('utf-8'))
+                    conn.send_bytes(compressor.flush())
+            with send_lock:
+                conn.send_bytes(json.dumps({'id': message['id'], 'type': 'done', 'ok': body is not None,
+                    'info': info}).encode('utf-8'))
+        except (OSError, ValueError) as e:
+            logger.error('{0} - Unable to send the results of Engine "{1}" to the coordinator: {2!r}'.format(
+                func_name, engine.name, e))
+
+    def serve(conn, peer):
+        start_time = time.time()
+        requests = 0
+        send_lock = threading.Lock()
+        with ThreadPoolExecutor(max_workers=config.engine_max_workers) as executor:
+            try:
+                while True:
+                    message = json.loads(conn.recv_bytes().decode('utf-8'))
+                    if message['op'] == 'close':
+                        break
+                    requests += 1
+                    executor.submit(answer, conn, send_lock, message)
+            except (EOFError, OSError, ValueError) as e:
+                logger.error('{0} - Lost the connection to the coordinator {1}: {2!r}'.format(func_name, peer, e))
+        conn.close()
+        logger.info('{0} - Coordinator {1} done: {2} request{3} in {4}.'.format(
+            func_name, peer, requests, 's' if requests != 1 else '', timer(start_time, time.time())))
+
+    with Listener(address, authkey=config.worker_authkey.encode('utf-8')) as listener:
+        msg = 'Worker listening on {0}:{1}.'.format(*listener.address)
+        print(msg, flush=True)
+        logger.info('{0} - {1}'.format(func_name, msg))
+        while True:
+            try:
+                conn = listener.accept()
+            except Exception as e:
+                # e.g. a client with the wrong authkey
+                logger.error('{0} - Rejected a connection: {1!r}'.format(func_name, e))
+                continue
+            logger.info('{0} - Coordinator connected from {1}.'.format(func_name, listener.last_accepted))
+            threading.Thread(target=serve, args=(conn, listener.last_accepted),
+                name='coordinator-{}:{}'.format(*listener.last_accepted), daemon=True).start()
@@ -0,0 +1,149 @@
+"""Engine health probing and scheduling for multi_engine_query"""
+
+# Native modules
+from concurrent.futures import ThreadPoolExecutor
+import inspect
+import json
+import logging
+import os
+import threading
+import time
+
+# Application specific modules
+from timer import timer
+
+# Create the logger
+logger = logging.getLogger('logger')
+
+class EngineHealth(object):
+    """Probes the Engines before a run, and orders them for scheduling.
+
+    Probe results are cached in a ".engine_health.json" file next to the
+    log files (config.engine_health_path) for
+    config.engine_probe_cache_seconds, along
+    with a moving average of how long each Engine took to answer a query in
+    previous runs (its history). When a RunStatsStore is given, the history
+    is instead the median latency recorded in it over the last
+    _STATS_DAYS days. A replayed run (config.replay_path) neither reads nor
+    writes the cache, so that it does not change the health of the real
+    Engines; a recorded run (config.record_path) probes every Engine, so
+    that the recording holds the probes the replay needs.
+
+    Attributes:
+        path: The cache file name
+        probes: Probe results of the current run, by Engine hostname
+    """
+
+    # Weight of the latest duration in the moving average of the history
+    _HISTORY_WEIGHT = 0.3
+    # Number of days of run statistics used as history
+    _STATS_DAYS = 14
+
+    def __init__(self, logger, config, stats=None):
+        self._logger = logger
+        self._config = config
+        self._path = config.engine_health_path
+        self._lock = threading.Lock()
+        self._probes = {}
+        self._cache = {}
+        self._persist = config.replay_path is None
+        if self._persist:
+            try:
+                with open(self._path) as f:
+                    self._cache = json.load(f)
+            except (IOError, OSError, ValueError):
+                self._cache = {}
+        self._latencies = stats.engine_latencies(self._STATS_DAYS) if stats is not None else {}
+
+    def __repr__(self):
+        return 'EngineHealth(path={!r})'.format(self._path)
+
+    @property
+    def path(self):
+        return self._path
+
+    @property
+    def probes(self):
+        return self._probes
+
+    def _entry(self, engine):
+        return self._cache.setdefault(engine.hostname_fqdn, {})
+
+    def history(self, engine):
+        """Returns the average seconds engine took to answer a query, or None if unknown"""
+        if engine.hostname_fqdn in self._latencies:
+            return self._latencies[engine.hostname_fqdn]
+        return self._cache.get(engine.hostname_fqdn, {}).get('duration')
+
+    def _probe(self, engine):
+        """Probes a single Engine, unless a recent enough result is cached"""
+        cached = self._cache.get(engine.hostname_fqdn, {}).get('probe')
+        if cached and self._config.record_path is None and \
+                time.time() - cached['time'] < self._config.engine_probe_cache_seconds:
+            return dict(cached, cached=True)
+        result = engine.probe(self._config.engine_probe_timeout)
+        result['time'] = time.time()
+        with self._lock:
+            self._entry(engine)['probe'] = result
+        return dict(result, cached=False)
+
+    def probe(self, engines):
+        """Probes all of the engines concurrently. Returns the results by hostname."""
+        func_name = self.__class__.__name__ + '.' + inspect.currentframe().f_code.co_name
+        start_time = time.time()
+        if len(engines) == 0:
+            return self._probes
+        with ThreadPoolExecutor(max_workers=min(32, len(engines))) as executor:
+            results = list(executor.map(self._probe, engines))
+        for engine, result in zip(engines, results):
+            self._probes[engine.hostname_fqdn] = result
+            if self._config.verbose:
+                self._logger.info('{0} - Engine "{1}" ({2}): {3}, rtt {4}{5}'.format(
+                    func_name, engine.name, engine.hostname_fqdn, result['status'],
+                    '{:.3f} sec'.format(result['rtt']) if result['rtt'] is not None else 'n/a',
+                    ' (cached)' if result['cached'] else ''))
+        if self._config.verbose:
+            self._logger.info('{0} - Probed {1} Engines in {2}'.format(func_name, len(engines), timer(start_time, time.time())))
+        return self._probes
+
+    def schedule(self, engines):
+        """Probes the engines, and splits them into the reachable ones, ordered
+        slowest first (by history, then round-trip time; Engines without
+        history first), and the unreachable ones.
+
+        Returns:
+            list of reachable EngineAppliance
+            list of (EngineAppliance, probe result) that are unreachable
+        """
+        probes = self.probe(engines)
+        alive = [e for e in engines if probes[e.hostname_fqdn]['status'] == 'ok']
+        dead = [(e, probes[e.hostname_fqdn]) for e in engines if probes[e.hostname_fqdn]['status'] != 'ok']
+        def slowest_first(engine):
+            history = self.history(engine)
+            return (-(history if history is not None else float('inf')),
+                    -(probes[engine.hostname_fqdn]['rtt'] or 0))
+        alive.sort(key=slowest_first)
+        return alive, dead
+
+    def record_duration(self, engine, seconds):
+        """Adds the time engine took to answer a query to its history"""
+        with self._lock:
+            entry = self._entry(engine)
+            previous = entry.get('duration')
+            entry['duration'] = seconds if previous is None else \
+                previous + self._HISTORY_WEIGHT * (seconds - previous)
+
+    def save(self):
+        """Writes the probe results and history to the cache file"""
+        func_name = self.__class__.__name__ + '.' + inspect.currentframe().f_code.co_name
+        if not self._persist:
+            return
+        try:
+            if not os.path.exists(os.path.dirname(self._path)):
+                os.makedirs(os.path.dirname(self._path))
+            with self._lock:
+                with open(self._path + '.part', 'w') as f:
+                    json.dump(self._cache, f, indent=2)
+            os.replace(self._path + '.part', self._path)
+        except (IOError, OSError) as e:
+            self._logger.error('{0} - Unable to save the Engine health cache "{1}": {2}'.format(func_name, self._path, e))
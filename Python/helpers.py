@@ -3,21 +3,19 @@
 # Native moduels
 import csv
 from datetime import datetime
-from email.mime.application import MIMEApplication
-from email.mime.multipart import MIMEMultipart
-from email.mime.text import MIMEText
 import inspect
 import logging
 import os
-from os.path import basename
-import smtplib
+import sys
 import time
-import zipfile
 
 # Applicaiton specific modules
 import config
 from timer import timer
-from appliance_classes import PortalAppliance, EngineAppliance
+from appliance_classes import Appliance, PortalAppliance, EngineAppliance
+import mail_reporter
+from response_recorder import ResponseRecorder
+from result_encoding import decode_json
 
 def init(config):
     """ Create the logger, and enable Class-level debugging 
@@ -30,10 +28,29 @@ def init(config):
     logger = logging.getLogger('logger')
     EngineAppliance.set_debug_mode(config.debug_engine)
     PortalAppliance.set_debug_mode(config.debug_portal)
+    EngineAppliance.set_http_compression(config.http_compression)
+    PortalAppliance.set_http_compression(config.http_compression)
+    # Record or replay the responses of the Appliances, if requested
+    Appliance.set_recorder(ResponseRecorder.create(logger, config))
     return logger
 
-def create_output_file(logger, config, query):
-    """ Create the output file based on the specified configuration 
+def format_size(nbytes):
+    """ Formats a number of bytes for people to read (e.g. 1.5 MB)
+
+    Arguments:
+        nbytes: The number of bytes
+    Returns:
+        string: the formatted size
+    """
+    size = float(nbytes)
+    for unit in ['bytes', 'KB', 'MB', 'GB']:
+        if size < 1024 or unit == 'GB':
+            return '{:.0f} {}'.format(size, unit) if unit == 'bytes' else '{:.1f} {}'.format(size, unit)
+        size /= 1024
+
+def get_output_file_name(logger, config, query):
+    """ Construct the output file name based on the specified configuration,
+        creating its folder if it does not exist yet
 
     Arguments:
         logger: Initialized logger instance
@@ -41,7 +58,6 @@ def create_output_file(logger, config, query):
         query: Initialized NXQLQuery instance
     Returns:
         string: output file name
-        bool: True if successful
     """
     func_name = inspect.currentframe().f_code.co_name
 
@@ -53,11 +69,27 @@ def create_output_file(logger, config, query):
             logger.info('{0} - Created output folder: "{1}".'.format(func_name, fpath))
 
     # Construct the output filename (including path)
-    fname = os.path.join(fpath,
+    return os.path.join(fpath,
         query.filename.format(
             query=query.name,
             rundate=config.rundate))
 
+def create_output_file(logger, config, query):
+    """ Create the output file based on the specified configuration 
+
+    Arguments:
+        logger: Initialized logger instance
+        config: Initialized MultiEngineQueryConfig instance
+        query: Initialized NXQLQuery instance
+    Returns:
+        string: output file name
+        bool: True if successful
+    """
+    func_name = inspect.currentframe().f_code.co_name
+
+    # Construct the output filename (including path)
+    fname = get_output_file_name(logger, config, query)
+
     # Attempt to create the file
     try:
         f = open(fname, "w")
@@ -70,7 +102,26 @@ def create_output_file(logger, config, query):
         return fname, False
     return fname, True
 
-def run_query_on_engine(logger, config, engine, query):
+def build_query_api(query):
+    """ Builds the Engine API call running the NXQL of query
+
+        Arguments:
+        query: Initialized NXQLQuery instance
+
+        Returns:
+        string: the API, to pass to engine.execute_json_api()
+    """
+    get_query = ['/2/query?']
+    # Add platforms
+    for platform in query.platforms:
+        get_query.append('platform='+platform+'&')    
+    # Add query
+    get_query.append('query='+query.query+'&')
+    # Bring back objects as dict of json objects
+    get_query.append('format=json')
+    return ''.join(get_query)
+
+def run_query_on_engine(logger, config, engine, query, raw=False, response_info=None, locks=None):
     """ Runs the NXQL for the named query section and returns the results
         as a list of dictionaries
 
@@ -79,27 +130,41 @@ def run_query_on_engine(logger, config, engine, query):
         config: Initialized MultiEngineQueryConfig instance
         engine: Initialized Engine instance
         query: Initialized NXQLQuery instance
+        raw: If True, return the undecoded JSON response body (bytes) instead
+        response_info: Optional dict, updated with the status_code and bytes of the response
+        locks: Optional HostEngineLocks coordinating the query with the other instances on the host
 
         Returns:
-        list of dict representint results
+        list of dict representint results (or bytes if raw), or None if the Engine could not be queried
     """
     func_name = inspect.currentframe().f_code.co_name
     start_time = time.time()
     if config.debug_general:
         logger.debug("{} - Starting".format(func_name))
-    # Build the query to get the desired objects
-    get_query = ['/2/query?']
-    # Add platforms
-    for platform in query.platforms:
-        get_query.append('platform='+platform+'&')    
-    # Add query
-    get_query.append('query='+query.query+'&')
-    # Bring back objects as dict of json objects
-    get_query.append('format=json')
     # Retrieve the requested objects
-    engine_objects = engine.execute_json_api(''.join(get_query))
-    if config.debug_general: logger.debug('{} - engine.execute_json_api() returned {} Engine objects.\n\t{!r}'.format(func_name, len(engine_objects), engine_objects))
+    api = build_query_api(query)
+    timeout = config.engine_request_timeout or None
+    if locks is not None:
+        engine_objects = locks.execute(engine, api,
+            lambda info: engine.execute_json_api(api, raw=True, response_info=info, timeout=timeout), response_info)
+        if engine_objects is not None and not raw:
+            decode_start_time = time.time()
+            engine_objects = decode_json(engine_objects)
+            tracer = Appliance.get_tracer()
+            if tracer is not None:
+                tracer.add('decode', 'http', decode_start_time, time.time(),
+                    {'appliance': engine.name, 'objects': len(engine_objects)})
+    else:
+        engine_objects = engine.execute_json_api(api, raw=raw, response_info=response_info, timeout=timeout)
+    if engine_objects is None:
+        logger.error('{} - Unable to retrieve results from Engine at {}'.format(func_name, engine.hostname_fqdn))
+        return None
     end_time = time.time()
+    if raw:
+        if config.verbose:
+            logger.info('{} - {} bytes of results retrived from Engine at {} in {}'.format(func_name, len(engine_objects), engine.hostname_fqdn, timer(start_time, end_time)))
+        return engine_objects
+    if config.debug_general: logger.debug('{} - engine.execute_json_api() returned {} Engine objects.\n\t{!r}'.format(func_name, len(engine_objects), engine_objects))
     if config.verbose:
         logger.info('{} - {} result rows retrived from Engine at {} in {}'.format(func_name, len(engine_objects), engine.hostname_fqdn, timer(start_time, end_time)))
     return engine_objects
@@ -150,6 +215,8 @@ def send_mail(logger, config):
     Works only if no authentication is needed on the SMTP server
     The subject, body of the email message, and server details are in the config object.
     If there are no recipients, than just return.
+    Unless config.email_async is False, the email is sent by a background
+    process (see mail_reporter), so that the run does not wait for it.
 
     Arguments:
         logger: Initialized logger instance
@@ -164,7 +231,7 @@ def send_mail(logger, config):
     logger.debug('{0} - Preparing email to be sent ...'.format(func_name))
 
     # Parse the recipients to see if we even have any to send the email to
-    parsed_recipients = config.email_recipients.split(',')
+    parsed_recipients = [r for r in config.email_recipients.split(',') if r]
     if (len(parsed_recipients) == 0):
         logger.warning('{0} - No Email recipeints specified, skipping outbound email.'.format(func_name))
         return
@@ -180,58 +247,6 @@ def send_mail(logger, config):
             message = template.format(func_name, config.email_server, config.email_port, config.email_from, config.email_recipients)
             logger.debug(message)
 
-        # Construct the outbound message header
-        msg = MIMEMultipart()
-        msg['From'] = config.email_from
-        msg['Subject'] = config.email_subject.format(env=config.env, query=config.query_name, rundate=config.rundate)
-        msg['To'] = config.email_recipients
-
-        # Construct and attach the email body
-        body = msg['Subject'] + ':\r\n'
-        body += '\r\n'.join(config.email_body)
-        msg.attach(MIMEText(body))
-
-        # Attempt to send the message
-        try:
-            # Open a connection with the SMTP server
-            with smtplib.SMTP(config.email_server, config.email_port, None, config.email_timeout) as smtp:
-                # Verify the recipient addresses in advance
-                recipients = []
-                for recip in parsed_recipients:
-                    vresp = smtp.verify(recip)
-                    if (vresp[0] == 250):
-                        recipients.append(recip)
-                    elif (vresp[0] == 252):
-                        recipients.append(recip)
-                        if config.debug: logger.debug('{0} - Could not verify email address "{1}"; server does not support email address verification, but will still attempt to send to this recipient.'.format(func_name, recip))
-                    else:
-                        logger.error('{0} - Error while attempting to verify email address "{1}": {2!r}.  Will not attempt to send to this recipient.'.format(func_name, recip, vresp))
-                if (len(recipients) == 0):
-                    logger.error('Unable to send Email results, no valid recipients.')
-                else:
-                    # If an attachment is specified, get it and attach it to the message
-                    log_path = config.log_path
-                    if config.email_include_log:
-                        # See if we need to zip first
-                        if config.email_zip_log:
-                            with zipfile.ZipFile(log_path+'.zip', mode='w', compression=zipfile.ZIP_LZMA) as zf:
-                                zf.write(log_path)
-                            log_path += '.zip'
-                        with open(log_path, "rb") as f:
-                            part = MIMEApplication(f.read(), Name=basename(log_path))
-                            part['Content-Disposition'] = 'attachment; filename=' + basename(log_path) + ''
-                        msg.attach(part)
-                    # Attempt to send the email message
-                    smtp.sendmail(config.email_from, recipients, msg.as_string())
-                    # Remove .zip file if created
-                    if config.email_include_log and config.email_zip_log and config.email_remove_zip_log:
-                        os.remove(log_path)
-
-        # If an exception occurred, put it's information in the log
-        except Exception as ex:
-            template = '{0} - An exception of type {1} occurred. Arguments: {2!r}. Exception: {3!r}'
-            message = template.format(func_name, type(ex).__name__, ex.args, ex)
-            logger.error(message)
-
-        else:
-            logger.info('{0} - Email sent successfully to {1}'.format(func_name, config.email_recipients))
+        job = mail_reporter.build_job(config)
+        if not config.email_async or not mail_reporter.spool_job(logger, job):
+            mail_reporter.send_report(logger, job)
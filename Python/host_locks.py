@@ -0,0 +1,241 @@
+"""Coordination of the multi_engine_query instances running on the same host"""
+
+# Native modules
+import hashlib
+import inspect
+import json
+import logging
+import os
+import re
+import time
+try:
+    import fcntl
+except ImportError:
+    # Not available on Windows
+    fcntl = None
+
+# Create the logger
+logger = logging.getLogger('logger')
+
+class HostEngineLocks(object):
+    """Limits the requests sent to each Engine by all of the instances of
+    multi_engine_query running on the host (e.g. overlapping cron runs), and
+    lets an instance share the response of an identical request another
+    instance is already waiting for, instead of sending it again.
+
+    Both rely on file locks in config.engine_lock_path, which the operating
+    system releases if an instance dies:
+    - every Engine has config.engine_host_max_requests slot files; a request
+      is only sent while holding the lock of one of them
+    - a request in flight holds the lock of a file named after a hash of the
+      Engine and the request. Another instance finding it locked waits for
+      it to be released, then reuses the response saved next to it, if
+      config.engine_share_requests. The waiting instances hold a shared lock
+      of a ".waiters" file, so that the last of them to read the response
+      (or the instance that saved it, if none waits) removes it.
+    The responses hold query results, so the folder must belong to the user
+    running the instance, and is only accessible to it (0700, files 0600).
+
+    Attributes:
+        path: The folder holding the lock files
+        max_requests: The number of requests an Engine gets at once from the host
+        shared: The number of responses this instance reused
+    """
+
+    # Seconds between attempts to take a lock held by another instance
+    _POLL_INTERVAL = 0.05
+    _MAX_POLL_INTERVAL = 0.5
+    # Seconds after which a response left behind (e.g. by an instance that died) is removed
+    _RESPONSE_SECONDS = 600
+
+    @staticmethod
+    def available():
+        """Returns True if file locks are supported on this platform"""
+        return fcntl is not None
+
+    def __init__(self, logger, config):
+        self._logger = logger
+        self._config = config
+        self._path = config.engine_lock_path
+        self._max_requests = config.engine_host_max_requests
+        self._share = config.engine_share_requests
+        self._shared = 0
+
+    def __repr__(self):
+        return 'HostEngineLocks(path={!r}, max_requests={!r}, share={!r})'.format(
+            self._path, self._max_requests, self._share)
+
+    @property
+    def path(self):
+        return self._path
+
+    @property
+    def max_requests(self):
+        return self._max_requests
+
+    @property
+    def shared(self):
+        return self._shared
+
+    def open(self):
+        """Creates the lock folder (checking that it belongs to this user), and
+        removes the expired responses. Returns True if successful."""
+        func_name = self.__class__.__name__ + '.' + inspect.currentframe().f_code.co_name
+        try:
+            os.makedirs(os.path.join(self._path, 'requests'), mode=0o700, exist_ok=True)
+            for folder in (self._path, os.path.join(self._path, 'requests')):
+                status = os.stat(folder)
+                if status.st_uid != os.getuid():
+                    self._logger.error('{0} - The lock folder "{1}" belongs to another user, so not using it.'.format(
+                        func_name, folder))
+                    return False
+                if status.st_mode & 0o077:
+                    os.chmod(folder, 0o700)
+            now = time.time()
+            for name in os.listdir(os.path.join(self._path, 'requests')):
+                fname = os.path.join(self._path, 'requests', name)
+                if name.endswith('.response') and now - os.path.getmtime(fname) > self._RESPONSE_SECONDS:
+                    os.remove(fname)
+        except (IOError, OSError) as e:
+            self._logger.error('{0} - Unable to prepare the lock folder "{1}": {2}'.format(func_name, self._path, e))
+            return False
+        return True
+
+    @staticmethod
+    def _open_private(fname, flags):
+        """Opens fname, creating it readable and writable by this user only"""
+        return os.fdopen(os.open(fname, flags | os.O_CREAT, 0o600), 'r+b' if flags & os.O_RDWR else 'wb')
+
+    def _try_lock(self, fname):
+        """Returns the open lock file if its lock was taken, None if another instance holds it"""
+        f = self._open_private(fname, os.O_RDWR)
+        try:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except (IOError, OSError):
+            f.close()
+            return None
+        return f
+
+    @staticmethod
+    def _unlock(f):
+        fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+        f.close()
+
+    def _acquire_slot(self, engine):
+        """Waits for one of the Engine's slots, and returns its open lock file"""
+        prefix = os.path.join(self._path, re.sub(r'[^\w.-]', '_', engine.hostname_fqdn))
+        interval = self._POLL_INTERVAL
+        while True:
+            for slot in range(self._max_requests):
+                f = self._try_lock('{}.{}.lock'.format(prefix, slot))
+                if f is not None:
+                    return f
+            time.sleep(interval)
+            interval = min(self._MAX_POLL_INTERVAL, interval * 2)
+
+    def _read_response(self, fname, since):
+        """Returns (body, response_info) saved at fname after since, or None"""
+        try:
+            if os.path.getmtime(fname) < since:
+                return None
+            with open(fname, 'rb') as f:
+                data = f.read()
+            header, _, body = data.partition(b'\n')
+            return body, json.loads(header.decode('utf-8'))
+        except (IOError, OSError, ValueError):
+            return None
+
+    def _write_response(self, fname, body, response_info):
+        func_name = self.__class__.__name__ + '.' + inspect.currentframe().f_code.co_name
+        try:
+            with self._open_private(fname + '.part', os.O_WRONLY | os.O_TRUNC) as f:
+                f.write(json.dumps(response_info).encode('utf-8') + b'\n')
+                f.write(body)
+            os.replace(fname + '.part', fname)
+        except (IOError, OSError) as e:
+            self._logger.warning('{0} - Unable to save the response for the other instances "{1}": {2}'.format(
+                func_name, fname, e))
+            return False
+        return True
+
+    def _remove_read_response(self, request_fname):
+        """Removes the saved response of a request once no instance waits for it"""
+        waiters = self._try_lock(request_fname + '.waiters')
+        if waiters is None:
+            return
+        try:
+            os.remove(request_fname + '.response')
+        except OSError:
+            pass
+        finally:
+            self._unlock(waiters)
+
+    def execute(self, engine, api, fetch, response_info=None):
+        """ Runs a request against engine, within the limits of the host
+
+        Arguments:
+            engine: The EngineAppliance the request is for
+            api: The API of the request, identifying it
+            fetch: function sending the request, returning the response body
+                (bytes), or None if it failed, and filling the dict it gets
+                with the response information (see Appliance.execute_json_api)
+            response_info: Optional dict, updated with the response information,
+                and with shared set to True if the response was reused
+        Returns:
+            bytes: the response body, or None if the request failed
+        """
+        func_name = self.__class__.__name__ + '.' + inspect.currentframe().f_code.co_name
+        key = hashlib.blake2b('{}\n{}\n{}'.format(engine.hostname_fqdn, engine.port, api).encode('utf-8'),
+            digest_size=16).hexdigest()
+        request_fname = os.path.join(self._path, 'requests', key)
+        info = {}
+
+        # Wait for an identical request in flight in another instance, and reuse its response
+        request_lock = None
+        if self._share:
+            since = time.time()
+            request_lock = self._try_lock(request_fname + '.lock')
+            if request_lock is None:
+                if self._config.verbose:
+                    self._logger.info('{0} - Waiting for the identical request of another instance to Engine "{1}".'.format(
+                        func_name, engine.name))
+                waiters = self._open_private(request_fname + '.waiters', os.O_RDWR)
+                fcntl.flock(waiters.fileno(), fcntl.LOCK_SH)
+                interval = self._POLL_INTERVAL
+                while request_lock is None:
+                    time.sleep(interval)
+                    interval = min(self._MAX_POLL_INTERVAL, interval * 2)
+                    request_lock = self._try_lock(request_fname + '.lock')
+                saved = self._read_response(request_fname + '.response', since)
+                self._unlock(waiters)
+                if saved is not None:
+                    self._unlock(request_lock)
+                    self._remove_read_response(request_fname)
+                    self._shared += 1
+                    body, info = saved
+                    info['shared'] = True
+                    if response_info is not None:
+                        response_info.update(info)
+                    if self._config.verbose:
+                        self._logger.info('{0} - Reused the response of another instance from Engine "{1}".'.format(
+                            func_name, engine.name))
+                    return body
+
+        # Send the request once one of the Engine's slots is free
+        saved = False
+        try:
+            slot_lock = self._acquire_slot(engine)
+            try:
+                body = fetch(info)
+            finally:
+                self._unlock(slot_lock)
+            if request_lock is not None and body is not None and info.get('status_code', 200) < 400:
+                saved = self._write_response(request_fname + '.response', body, info)
+        finally:
+            if request_lock is not None:
+                self._unlock(request_lock)
+        if saved:
+            self._remove_read_response(request_fname)
+        if response_info is not None:
+            response_info.update(info)
+        return body
@@ -0,0 +1,271 @@
+"""Email reporting of the multi_engine_query runs, off the run's critical path
+
+Run as a script by helpers.send_mail, with the name of the file describing
+the email to send (see build_job), so that the run can exit, and the next
+scheduled run start, while the log is compressed and the email sent.
+"""
+
+# Native modules
+from email.mime.application import MIMEApplication
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+import gzip
+import inspect
+import json
+import logging
+import os
+from os.path import basename
+import smtplib
+import socket
+import subprocess
+import sys
+import threading
+import time
+import zipfile
+
+# Optional 3rd-party modules
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Create the logger
+logger = logging.getLogger('logger')
+
+# Extension of the compressed log, and zip compression method, of every codec
+LOG_CODECS = {
+    'lzma': ('.zip', zipfile.ZIP_LZMA),
+    'bzip2': ('.zip', zipfile.ZIP_BZIP2),
+    'deflate': ('.zip', zipfile.ZIP_DEFLATED),
+    'gzip': ('.gz', None),
+    'zstd': ('.zst', None)}
+
+# Seconds between NOOP commands keeping the SMTP connection open while the log is compressed
+_KEEPALIVE_SECONDS = 30
+
+def build_job(config):
+    """ Returns the email of the run as a dict (JSON serializable): the SMTP
+        settings, the subject and body, and how to attach the log.
+
+    Arguments:
+        config: Initialized MultiEngineQueryConfig instance
+    """
+    subject = config.email_subject.format(env=config.env, query=config.query_name, rundate=config.rundate)
+    return {
+        'server': config.email_server,
+        'port': config.email_port,
+        'timeout': config.email_timeout,
+        'from': config.email_from,
+        'recipients': config.email_recipients,
+        'subject': subject,
+        'body': subject + ':\r\n' + '\r\n'.join(config.email_body),
+        'log_path': config.log_path,
+        'include_log': config.email_include_log,
+        'zip_log': config.email_zip_log,
+        'remove_zip_log': config.email_remove_zip_log,
+        'log_codec': config.email_log_codec,
+        'log_max_bytes': config.email_log_max_bytes,
+        'max_attachment_bytes': config.email_max_attachment_bytes,
+        'verify_recipients': config.email_verify_recipients,
+        'debug': config.debug}
+
+def spool_job(logger, job):
+    """ Hands the email to a background process sending it, which outlives
+        the run. Returns True if it was started, False if the email should be
+        sent by the caller instead.
+    """
+    func_name = inspect.currentframe().f_code.co_name
+    fname = os.path.splitext(job['log_path'])[0] + '.mail.json'
+    try:
+        with open(fname, 'w') as f:
+            json.dump(job, f)
+        process = subprocess.Popen([sys.executable, os.path.abspath(__file__), fname],
+            stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+            close_fds=True, start_new_session=True)
+    except (IOError, OSError) as e:
+        logger.error('{0} - Unable to send the email in the background, sending it now: {1}'.format(func_name, e))
+        return False
+    logger.info('{0} - Sending the email in the background (process {1}).'.format(func_name, process.pid))
+    return True
+
+def compress_log(log_path, codec, max_bytes=0):
+    """ Compresses the log for the email, keeping only its last max_bytes bytes
+        if it is larger (0 keeps all of it).
+
+    Arguments:
+        log_path: The log file name
+        codec: One of LOG_CODECS, or 'none'
+        max_bytes: The most bytes of the log to keep
+    Returns:
+        string: the compressed file name (log_path if neither compressed nor truncated)
+        bytes: the truncated log, if it was truncated and not compressed (None otherwise)
+        int: the number of bytes of the log left out
+    """
+    size = os.path.getsize(log_path)
+    offset = max(0, size - max_bytes) if max_bytes else 0
+    if codec == 'none':
+        if offset == 0:
+            return log_path, None, 0
+        with open(log_path, 'rb') as src:
+            src.seek(offset)
+            return log_path, _truncation_note(offset) + src.read(), offset
+    extension, method = LOG_CODECS[codec]
+    fname = log_path + extension
+    with open(log_path, 'rb') as src:
+        src.seek(offset)
+        if method is not None:
+            with zipfile.ZipFile(fname, mode='w', compression=method) as zf:
+                with zf.open(basename(log_path), mode='w', force_zip64=True) as dst:
+                    _copy(src, dst, offset)
+        elif codec == 'gzip':
+            with gzip.open(fname, 'wb', compresslevel=1) as dst:
+                _copy(src, dst, offset)
+        else:
+            with open(fname, 'wb') as f:
+                with zstandard.ZstdCompressor(level=3, threads=-1).stream_writer(f) as dst:
+                    _copy(src, dst, offset)
+    return fname, None, offset
+
+def _truncation_note(offset):
+    return '[... the first {} bytes of the log were left out ...]\n'.format(offset).encode('utf-8')
+
+def _copy(src, dst, offset):
+    if offset:
+        dst.write(_truncation_note(offset))
+    while True:
+        chunk = src.read(1024 * 1024)
+        if not chunk:
+            break
+        dst.write(chunk)
+
+def verify_recipients(logger, smtp, recipients, debug=False):
+    """Returns the recipients the SMTP server accepts (or can not verify)"""
+    func_name = inspect.currentframe().f_code.co_name
+    verified = []
+    for recip in recipients:
+        vresp = smtp.verify(recip)
+        if (vresp[0] == 250):
+            verified.append(recip)
+        elif (vresp[0] == 252):
+            verified.append(recip)
+            if debug: logger.debug('{0} - Could not verify email address "{1}"; server does not support email address verification, but will still attempt to send to this recipient.'.format(func_name, recip))
+        else:
+            logger.error('{0} - Error while attempting to verify email address "{1}": {2!r}.  Will not attempt to send to this recipient.'.format(func_name, recip, vresp))
+    return verified
+
+def send_report(logger, job):
+    """ Sends the email of a run (see build_job). The log is compressed while
+        the SMTP connection is opened and the recipients verified.
+
+    Arguments:
+        logger: Initialized logger instance
+        job: dict returned by build_job
+    """
+    func_name = inspect.currentframe().f_code.co_name
+    recipients = [r for r in job['recipients'].split(',') if r]
+    if len(recipients) == 0:
+        logger.warning('{0} - No Email recipeints specified, skipping outbound email.'.format(func_name))
+        return
+    codec = job['log_codec'] if job['zip_log'] else 'none'
+    if codec == 'zstd' and zstandard is None:
+        logger.warning('{0} - zstandard is not installed, compressing the log with gzip instead.'.format(func_name))
+        codec = 'gzip'
+
+    # Compress the log in the background
+    compressed = {}
+    def compress():
+        start_time = time.time()
+        try:
+            compressed['result'] = compress_log(job['log_path'], codec, job['log_max_bytes'])
+            compressed['seconds'] = time.time() - start_time
+        except Exception as exc:
+            compressed['error'] = exc
+    compressor = None
+    if job['include_log']:
+        compressor = threading.Thread(target=compress, name='compress_log')
+        compressor.start()
+
+    msg = MIMEMultipart()
+    msg['From'] = job['from']
+    msg['Subject'] = job['subject']
+    msg['To'] = job['recipients']
+    body = job['body']
+    attachment = None
+    try:
+        # Open a connection with the SMTP server
+        with smtplib.SMTP(job['server'], job['port'], None, job['timeout']) as smtp:
+            # Verify the recipient addresses in advance, unless the server checks them when sending
+            if job['verify_recipients']:
+                recipients = verify_recipients(logger, smtp, recipients, job['debug'])
+            if (len(recipients) == 0):
+                logger.error('Unable to send Email results, no valid recipients.')
+                return
+            if compressor is not None:
+                compressor.join(_KEEPALIVE_SECONDS)
+                while compressor.is_alive():
+                    smtp.noop()
+                    compressor.join(_KEEPALIVE_SECONDS)
+                if 'error' in compressed:
+                    logger.error('{0} - Unable to compress the log "{1}": {2!r}'.format(
+                        func_name, job['log_path'], compressed['error']))
+                    body += '\r\nThe log could not be attached: {}'.format(compressed['error'])
+                else:
+                    fname, data, left_out = compressed['result']
+                    if data is None:
+                        with open(fname, 'rb') as f:
+                            data = f.read()
+                    if job['debug']:
+                        logger.debug('{0} - Prepared the log attachment ({1} bytes, {2}) in {3:.2f} sec.'.format(
+                            func_name, len(data), codec, compressed['seconds']))
+                    if job['max_attachment_bytes'] and len(data) > job['max_attachment_bytes']:
+                        body += '\r\nThe log ({0} bytes) is larger than the attachment limit; it is "{1}" on {2}.'.format(
+                            len(data), job['log_path'], socket.gethostname())
+                    else:
+                        if left_out:
+                            body += '\r\nThe attached log leaves out its first {} bytes.'.format(left_out)
+                        attachment = MIMEApplication(data, Name=basename(fname))
+                        attachment['Content-Disposition'] = 'attachment; filename=' + basename(fname) + ''
+            msg.attach(MIMEText(body))
+            if attachment is not None:
+                msg.attach(attachment)
+            # Attempt to send the email message
+            refused = smtp.sendmail(job['from'], recipients, msg.as_string())
+            for recip, response in refused.items():
+                logger.error('{0} - The SMTP server refused the email address "{1}": {2!r}.'.format(func_name, recip, response))
+            recipients = [r for r in recipients if r not in refused]
+
+    # If an exception occurred, put it's information in the log
+    except Exception as ex:
+        template = '{0} - An exception of type {1} occurred. Arguments: {2!r}. Exception: {3!r}'
+        message = template.format(func_name, type(ex).__name__, ex.args, ex)
+        logger.error(message)
+
+    else:
+        logger.info('{0} - Email sent successfully to {1}'.format(func_name, ', '.join(recipients)))
+
+    finally:
+        if compressor is not None:
+            compressor.join()
+        # Remove the compressed log if created
+        if 'result' in compressed and compressed['result'][0] != job['log_path'] and job['remove_zip_log']:
+            try:
+                os.remove(compressed['result'][0])
+            except OSError:
+                pass
+
+def main():
+    """Sends the email described by the file named on the command line, logging to the run's log"""
+    fname = sys.argv[1]
+    with open(fname) as f:
+        job = json.load(f)
+    handler = logging.FileHandler(job['log_path'])
+    handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)-8s %(message)s', '%Y-%m-%d %H:%M:%S'))
+    logger.addHandler(handler)
+    logger.setLevel(logging.DEBUG if job['debug'] else logging.INFO)
+    try:
+        send_report(logger, job)
+    finally:
+        os.remove(fname)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,331 @@
+"""Microbenchmarks of the multi_engine_query code that scales with the number of rows
+
+Runs each benchmark on generated data of the requested size, and reports the
+best and the median time of several repeats. The results can be saved to a
+JSON file (e.g. on the commit to compare with), and compared with a saved
+file: a benchmark taking more than --threshold times its saved best time is
+flagged as slower, and the exit status is 1.
+
+    python3 microbench.py --rows 100000 --save baseline.json
+    python3 microbench.py --rows 100000 --compare baseline.json
+
+Benchmarks:
+    process_html              Appliance._process_html on a table of ROWS rows
+    decode_json               result_encoding.decode_json of ROWS NXQL result rows
+    execute_json_api          Appliance.execute_json_api of ROWS rows (a replayed
+                              response, see response_recorder)
+    write_csv.W.D             helpers.write_to_output_file (QUOTE_NONNUMERIC) of
+                              ROWS rows of W fields, delimited by D
+    format_api                Appliance._format_api of ROWS NXQL API calls
+    load_config               MultiEngineQueryConfig, with a group of QUERIES queries
+"""
+
+# Native modules
+import argparse
+import configparser
+import contextlib
+import fnmatch
+import gc
+import io
+import json
+import logging
+import os
+import platform
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+# 3rd-party modules
+import requests
+
+# Application specific modules
+from appliance_classes import Appliance, EngineAppliance
+from config import MultiEngineQueryConfig, NXQLQuery
+from helpers import write_to_output_file
+from response_recorder import ResponseRecorder, normalize_url
+from result_encoding import decode_json
+
+# Create the logger
+logger = logging.getLogger('logger')
+
+# Widths (number of fields) and delimiters of the write_csv benchmarks
+CSV_WIDTHS = [5, 20, 50]
+CSV_DELIMITERS = [(',', 'comma'), (';', 'semicolon'), ('\t', 'tab')]
+
+def generate_rows(rows, width, seed=0):
+    """ Returns rows dict objects of width fields shaped like NXQL results:
+        ids, names (some with quotes and delimiters), numbers, dates and
+        empty values. The same arguments always return the same rows.
+
+    Arguments:
+        rows: The number of rows
+        width: The number of fields of every row
+        seed: The seed of the random values
+    Returns:
+        list of dict objects
+    """
+    rnd = random.Random(seed)
+    names = ['DEV-{:06d}', 'Dell Inc. "Latitude {}"', 'Microsoft Windows 10 Enterprise; build {}',
+             'Apple, Inc. MacBook Pro {}', 'C:\\Program Files\\App {}\\app.exe']
+    objects = []
+    for row in range(rows):
+        obj = {}
+        for field in range(width):
+            kind = field % 5
+            if kind == 0:
+                value = row * width + field
+            elif kind == 1:
+                value = rnd.choice(names).format(rnd.randint(0, 999999))
+            elif kind == 2:
+                value = round(rnd.uniform(0, 10000), 3)
+            elif kind == 3:
+                value = '2020-{:02d}-{:02d}T{:02d}:{:02d}:00'.format(
+                    rnd.randint(1, 12), rnd.randint(1, 28), rnd.randint(0, 23), rnd.randint(0, 59))
+            else:
+                value = None if rnd.random() < 0.5 else ''
+            obj['field{}'.format(field)] = value
+        objects.append(obj)
+    return objects
+
+def generate_html(rows, seed=0):
+    """Returns an HTML page holding a table of rows rows, like the Portal's HTML APIs"""
+    rnd = random.Random(seed)
+    lines = ['<html><head><title>Engines</title></head><body><table>',
+             '<tr><th>Name</th><th>Address</th><th>Status</th><th>Version</th><th>Devices</th></tr>']
+    for row in range(rows):
+        lines.append('<tr><td><a href="/engines/{0}">engine-{0}</a></td><td>10.{1}.{2}.{3}</td>'
+            '<td>{4}</td><td>6.{5}.0</td><td>{6}</td></tr>'.format(
+            row, rnd.randint(0, 255), rnd.randint(0, 255), rnd.randint(0, 255),
+            rnd.choice(['CONNECTED', 'DISCONNECTED']), rnd.randint(20, 30), rnd.randint(0, 20000)))
+    lines.append('</table></body></html>')
+    return '\n'.join(lines)
+
+def generate_query_file(fname, queries):
+    """Writes a query file holding a group (named bench) of queries queries"""
+    lines = ['[DEFAULT]', 'hash = #', '', '[General]', 'group_name = bench', '']
+    for position in range(queries):
+        lines += ['[query{}]'.format(position),
+                  'query = (select (id name entity ${{hash}}Model #"OS Name" field{0})'.format(position),
+                  '    (from device (where device (eq name (string "DEV-{:06d}"))))'.format(position),
+                  '    (limit 1000))',
+                  'platforms = windows,mac_os',
+                  '']
+    with open(fname, 'w') as f:
+        f.write('\n'.join(lines))
+
+def config_args():
+    """Returns the command line arguments MultiEngineQueryConfig expects, for the bench group"""
+    return argparse.Namespace(options={'engine': False, 'general': False, 'portal': False},
+        exclude={'file': False}, info=False, query_type='g', name='bench',
+        record=None, replay=None, replay_latency=False, worker=None)
+
+def load_config():
+    """Returns a MultiEngineQueryConfig, without its output or log handler"""
+    handlers = list(logger.handlers)
+    with contextlib.redirect_stdout(io.StringIO()):
+        config = MultiEngineQueryConfig(config_args())
+    for handler in logger.handlers:
+        if handler not in handlers:
+            logger.removeHandler(handler)
+            handler.close()
+    return config
+
+@contextlib.contextmanager
+def bench_environment(tmp, queries):
+    """ Prepares the configuration the benchmarks use: the configuration file
+        of this script (the template, writing to tmp) and a query file of
+        queries queries in tmp, removed afterwards.
+    """
+    script_path = os.path.dirname(os.path.abspath(__file__))
+    conf_name = os.path.join(script_path,
+        '.' + os.path.splitext(os.path.basename(sys.argv[0]))[0] + '.conf')
+    conf = configparser.RawConfigParser(allow_no_value=True)
+    conf.read(os.path.join(script_path, '.multi-engine-query-p3.template.conf'))
+    conf.set('General', 'environment', 'BENCH')
+    conf.set('Logging', 'log_path', tmp)
+    conf.set('Logging', 'run_stats', '0')
+    conf.set('Email', 'email_results', '0')
+    conf.set('Queries', 'query_path', os.path.join(tmp, 'queries'))
+    conf.set('Queries', 'query_pattern', 'nxql*.conf')
+    conf.set('Queries', 'query_output_path', os.path.join(tmp, 'output'))
+    os.makedirs(os.path.join(tmp, 'queries'))
+    generate_query_file(os.path.join(tmp, 'queries', 'nxql-bench.conf'), queries)
+    with open(conf_name, 'w') as f:
+        conf.write(f)
+    try:
+        yield
+    finally:
+        os.remove(conf_name)
+
+def bench_process_html(context, rows):
+    html = generate_html(rows)
+    engine = context['engine']
+    return None, lambda: engine._process_html(html, 0)
+
+def bench_decode_json(context, rows):
+    body = json.dumps(generate_rows(rows, 10)).encode('utf-8')
+    return None, lambda: decode_json(body)
+
+def bench_execute_json_api(context, rows):
+    # Record a generated response, and replay it through an Engine session
+    path = os.path.join(context['tmp'], 'recording')
+    api = '/2/query?platform=windows&query=(select (id name) (from device))&format=json'
+    response = requests.Response()
+    response.status_code = 200
+    response.reason = 'OK'
+    response.headers['Content-Type'] = 'application/json'
+    response._content = json.dumps(generate_rows(rows, 10)).encode('utf-8')
+    recorder = ResponseRecorder(logger, 'replay', path)
+    engine = EngineAppliance('engine.bench', 'bench', '1671', 'YmVuY2g6YmVuY2g=')
+    recorder.save(normalize_url('GET', engine._format_api(api)), response, 0.0)
+    Appliance.set_recorder(recorder)
+    try:
+        engine = EngineAppliance('engine.bench', 'bench', '1671', 'YmVuY2g6YmVuY2g=')
+    finally:
+        Appliance.set_recorder(None)
+    def run():
+        if engine.execute_json_api(api) is None:
+            raise RuntimeError('The replayed response is missing')
+    return None, run
+
+def bench_write_csv(context, rows, width, delimiter):
+    objects = generate_rows(rows, width)
+    field_names = list(objects[0].keys())
+    fname = os.path.join(context['tmp'], 'write_csv.csv')
+    query = NXQLQuery('bench', '(select (id) (from device))', context['tmp'], None,
+        'write_csv.csv', delimiter, 'windows')
+    def before():
+        if os.path.exists(fname):
+            os.remove(fname)
+    def run():
+        if not write_to_output_file(logger, context['config'], query, fname, objects, field_names, True):
+            raise RuntimeError('Unable to write "{}"'.format(fname))
+    return before, run
+
+def bench_format_api(context, rows):
+    apis = ['/2/query?platform=windows&platform=mac_os&query=(select (id name #"OS Name" '
+            'device_type)\n    (from device (where device (eq name (string "DEV-{:06d}"))))\n'
+            '    (limit 1000))&format=json'.format(row) for row in range(rows)]
+    engine = context['engine']
+    def run():
+        for api in apis:
+            engine._format_api(api)
+    return None, run
+
+def bench_load_config(context, rows):
+    return None, load_config
+
+def benchmarks(rows, queries):
+    """Returns a list of (name, number of rows or queries, function returning (before, run))"""
+    result = [
+        ('process_html', rows, lambda context: bench_process_html(context, rows)),
+        ('decode_json', rows, lambda context: bench_decode_json(context, rows)),
+        ('execute_json_api', rows, lambda context: bench_execute_json_api(context, rows))]
+    for width in CSV_WIDTHS:
+        for delimiter, delimiter_name in CSV_DELIMITERS:
+            result.append(('write_csv.{}.{}'.format(width, delimiter_name), rows,
+                lambda context, width=width, delimiter=delimiter: bench_write_csv(context, rows, width, delimiter)))
+    result.append(('format_api', rows, lambda context: bench_format_api(context, rows)))
+    result.append(('load_config', queries, lambda context: bench_load_config(context, queries)))
+    return result
+
+def measure(before, run, repeat):
+    """Returns the seconds run took in each of repeat runs, after a warm up run"""
+    times = []
+    for position in range(repeat + 1):
+        if before is not None:
+            before()
+        gc.collect()
+        start_time = time.perf_counter()
+        run()
+        if position > 0:
+            times.append(time.perf_counter() - start_time)
+    return times
+
+def git_commit():
+    """Returns the commit of the code being measured, or None if unknown"""
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)), stderr=subprocess.DEVNULL)
+        dirty = subprocess.check_output(['git', 'status', '--porcelain', '--untracked-files=no'],
+            cwd=os.path.dirname(os.path.abspath(__file__)), stderr=subprocess.DEVNULL)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return commit.decode('utf-8').strip() + ('+' if dirty.strip() else '')
+
+def handle_args():
+    parser = argparse.ArgumentParser(prog='microbench',
+        description='Microbenchmarks of the multi_engine_query code that scales with the number of rows.')
+    parser.add_argument('--rows', type=int, default=10000,
+        help='Rows of the generated datasets (default 10000)')
+    parser.add_argument('--queries', type=int, default=100,
+        help='Queries of the generated query group of load_config (default 100)')
+    parser.add_argument('--repeat', type=int, default=5,
+        help='Timed runs of each benchmark, after a warm up run (default 5)')
+    parser.add_argument('--only', nargs='*', default=None, metavar='PATTERN',
+        help='Only run the benchmarks matching one of the patterns (e.g. "write_csv.*")')
+    parser.add_argument('--save', default=None, metavar='FILE',
+        help='Save the results to FILE (JSON)')
+    parser.add_argument('--compare', default=None, metavar='FILE',
+        help='Compare the results with those saved in FILE; exit with status 1 if any is slower')
+    parser.add_argument('--threshold', type=float, default=1.25,
+        help='With --compare, flag the benchmarks taking more than THRESHOLD times '
+             'their saved best time (default 1.25)')
+    return parser.parse_args()
+
+def main():
+    args = handle_args()
+    # MultiEngineQueryConfig changes the current folder to the script's
+    save = os.path.abspath(args.save) if args.save else None
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        print('Comparing with commit {0} ({1} rows, Python {2}).'.format(
+            baseline.get('commit'), baseline.get('rows'), baseline.get('python')))
+    results = {}
+    slower = []
+    tmp = tempfile.mkdtemp(prefix='microbench-')
+    try:
+        with bench_environment(tmp, args.queries):
+            context = {'tmp': tmp, 'config': load_config(),
+                'engine': EngineAppliance('engine.bench', 'bench', '1671', 'YmVuY2g6YmVuY2g=')}
+            print('{:<24} {:>8} {:>10} {:>10} {:>12} {:>10} {:>7}'.format(
+                'Benchmark', 'Rows', 'Best', 'Median', 'Rows/s', 'Saved', 'Ratio'))
+            for name, count, setup in benchmarks(args.rows, args.queries):
+                if args.only and not any(fnmatch.fnmatch(name, pattern) for pattern in args.only):
+                    continue
+                before, run = setup(context)
+                times = measure(before, run, args.repeat)
+                results[name] = {'rows': count, 'best': min(times), 'median': statistics.median(times)}
+                line = '{:<24} {:>8} {:>8.4f} s {:>8.4f} s {:>12,.0f}'.format(
+                    name, count, min(times), statistics.median(times), count / max(min(times), 1e-9))
+                saved = (baseline or {}).get('results', {}).get(name)
+                if saved is not None and saved['rows'] == count:
+                    ratio = min(times) / max(saved['best'], 1e-9)
+                    line += ' {:>8.4f} s {:>7.2f}'.format(saved['best'], ratio)
+                    if ratio > args.threshold:
+                        slower.append(name)
+                        line += '  SLOWER'
+                elif saved is not None:
+                    line += '   (saved for {} rows)'.format(saved['rows'])
+                print(line, flush=True)
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+    if save:
+        with open(save, 'w') as f:
+            json.dump({'commit': git_commit(), 'python': platform.python_version(), 'rows': args.rows,
+                'queries': args.queries, 'repeat': args.repeat, 'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+                'results': results}, f, indent=2, sort_keys=True)
+        print('Saved the results to "{}".'.format(save))
+    if slower:
+        print('{0} benchmark{1} more than {2} times slower than in "{3}": {4}'.format(
+            len(slower), 's' if len(slower) != 1 else '', args.threshold, args.compare, ', '.join(slower)))
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -8,6 +8,7 @@
 #
 
 # Native imports
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
 from datetime import datetime
 import inspect
 import logging
@@ -18,8 +19,22 @@ import time
 from arg_processor import handle_args
 from config import MultiEngineQueryConfig
 from timer import timer
-from appliance_classes import PortalAppliance, EngineAppliance
-from helpers import init, create_output_file, run_query_on_engine, write_to_output_file, send_mail
+from appliance_classes import Appliance, PortalAppliance
+from helpers import format_size, get_output_file_name, init, run_query_on_engine, send_mail, write_to_output_file
+from checkpoint import RunCheckpoint
+from concurrency import ConcurrencyGovernor
+from distributed import WorkerCoordinator, parse_address, serve_worker
+from engine_health import EngineHealth
+from host_locks import HostEngineLocks
+from output_classes import OutputSink
+from post_processing import PostProcessor
+from preview import HISTORY_DAYS, estimate_run, sample_engines
+from query_optimizer import merge_queries, project_rows
+from remote_actions import RemoteActionDispatcher
+from resource_usage import ResourceAccounting, thread_cpu
+from run_stats import RunStatsStore
+from tracing import RunTracer
+from result_encoding import encode_csv_batch
 
 def finish_process(func_name, logger, config, start_time, finished=True):
     if config.verbose:
@@ -27,43 +42,747 @@ def finish_process(func_name, logger, config, start_time, finished=True):
         logger.info("{} - Completed in {}".format(func_name, timer(start_time, end_time)))
     return finished
 
-def run_multi_engine_query(config):
+def process_engine(logger, config, engine, query, targets, decoder_pool=None, health=None, stats=None,
+                   checkpoint=None, governor=None, values=None, keep_results=False, locks=None,
+                   accounting=None, tracer=None):
+    """ Runs the query against a single engine and saves the results to the sink.
+    Called from a worker thread, config.engine_max_workers engines at a time.
+
+    Arguments:
+    logger: Initialized logger instance
+    config: Initialized MultiEngineQueryConfig object
+    engine: Initialized Engine instance
+    query: Initialized NXQLQuery instance to run: a query, or the combined
+        query of several queries (see query_optimizer.merge_queries)
+    targets: list of dicts returned by open_query (query, sink, dispatcher)
+        for the queries answered by query; each gets its own fields of the results
+    decoder_pool: Optional ProcessPoolExecutor decoding and encoding the
+        results, used when the sink accepts encoded batches
+    health: Optional EngineHealth recording how long the Engine took
+    stats: Optional RunStatsStore recording the Engine's latency, rows and bytes
+    checkpoint: Optional RunCheckpoint saving the Engine's results
+    governor: Optional ConcurrencyGovernor recording the outcome of every
+        request (run_wave takes the Engine's slot before calling process_engine)
+    values: For a query depending on another query, the values of that query's
+        depends_field returned by the Engine (None if it failed)
+    keep_results: If True, return the results of every target, for the
+        queries depending on them
+    locks: Optional HostEngineLocks coordinating the queries with the other
+        instances running on the host
+    accounting: Optional ResourceAccounting accounting for the CPU time,
+        bytes and rows of each target
+    tracer: Optional RunTracer recording the phases of the query in the run's timeline
+
+    Returns:
+    dict of target query name: list of dict objects (None if the Engine
+    failed), with the results of every target if keep_results is True
+    """
+    func_name = inspect.currentframe().f_code.co_name
+    eng_name = '[{0} ({1})]'.format(engine.name, engine.hostname_fqdn)
+    cpu_start = thread_cpu()
+    process_start_time = time.time()
+
+    def account(target_query, rows, target_cpu_start=None):
+        # The CPU time and bytes of querying the Engine (measured once, in
+        # query_cpu) are shared by the targets of a merged query; each target
+        # is also charged the CPU time of its own projection and writes
+        if accounting is not None:
+            own = (0.0, 0.0)
+            if target_cpu_start is not None:
+                cpu = thread_cpu()
+                own = (cpu[0] - target_cpu_start[0], cpu[1] - target_cpu_start[1])
+            accounting.add_engine(target_query,
+                ((query_cpu[0] - cpu_start[0]) / len(targets) + own[0], (query_cpu[1] - cpu_start[1]) / len(targets) + own[1]),
+                (response_info.get('bytes') or 0) // len(targets), rows)
+
+    def trace(name, start_time, **details):
+        if tracer is not None:
+            tracer.add(name, 'engine', start_time, time.time(), dict(details, engine=engine.name, query=query.name))
+
+    # 4. Run the query.
+    # A query depending on another query runs once per chunk of its values
+    if not query.depends_on:
+        requests = [query]
+    elif values is not None:
+        size = query.depends_chunk_size
+        requests = [query.bind(values[i:i + size]) for i in range(0, len(values), size)]
+    else:
+        logger.error('{0} - {1} Query "{2}" it depends on returned no results, Query "{3}" is not run.'.format(
+            func_name, eng_name, query.depends_on, query.name))
+        requests = None
+    # The Remote Action needs the decoded rows, and merged queries need to
+    # project them, so both disable the encoded path (as do query dependencies
+    # and post-processing)
+    encoded = decoder_pool is not None and len(targets) == 1 and targets[0]['query'] is query and \
+        targets[0]['sink'].accepts_encoded and targets[0]['dispatcher'] is None and \
+        targets[0]['post'] is None and not query.depends_on and not keep_results
+    response_info = {}
+    engine_start_time = time.time()
+    engine_latency = 0.0
+    engine_objects = None if requests is None else []
+    try:
+        for request in requests or []:
+            request_start_time = time.time()
+            request_info = {}
+            objects = None
+            try:
+                objects = run_query_on_engine(logger, config, engine, request, raw=encoded, response_info=request_info,
+                    locks=locks)
+            finally:
+                trace('request', request_start_time, status_code=request_info.get('status_code'),
+                    bytes=request_info.get('bytes'))
+                engine_latency += time.time() - request_start_time
+                if governor is not None:
+                    governor.record(engine, time.time() - request_start_time,
+                        objects is None or request_info.get('status_code', 200) >= 500)
+            response_info['bytes'] = response_info.get('bytes', 0) + (request_info.get('bytes') or 0)
+            if objects is None:
+                engine_objects = None
+                break
+            if encoded:
+                engine_objects = objects
+            else:
+                engine_objects.extend(objects)
+        if encoded and engine_objects is not None:
+            raw = engine_objects
+            decode_start_time = time.time()
+            batch = decoder_pool.submit(encode_csv_batch, raw, query.delimiter).result()
+            trace('decode (worker process)', decode_start_time, rows=batch['rows'])
+    except Exception as exc:
+        logger.error('{0} - {1} Unexpected error while running Query "{2}": {3!r}'.format(func_name, eng_name, query.name, exc))
+        engine_objects = None
+    query_cpu = thread_cpu()
+    if engine_objects is None:
+        for target in targets:
+            msg = '{0} Unable to retrieve Objects from this Engine for Query "{1}".'.format(eng_name, target['query'].name)
+            config.add_to_email(msg)
+            print(msg)
+            target['sink'].fail(engine, 'Unable to retrieve results')
+            if stats is not None:
+                stats.record(engine, target['query'], engine_start_time, engine_latency,
+                    0, response_info.get('bytes'), 'failed')
+            if checkpoint is not None:
+                checkpoint.mark(target['query'], engine, 'failed')
+            account(target['query'], 0)
+        trace('Query "{0}" on Engine "{1}"'.format(query.name, engine.name), process_start_time, status='failed')
+        return dict((target['query'].name, None) for target in targets)
+    if health is not None and requests:
+        health.record_duration(engine, engine_latency)
+
+    results = {}
+    for target in targets:
+        target_cpu_start = thread_cpu()
+        target_query, sink, dispatcher = target['query'], target['sink'], target['dispatcher']
+        if not encoded:
+            objects = project_rows(engine_objects, query, target_query)
+            if target['post'] is not None:
+                post_start_time = time.time()
+                objects = target['post'].apply(objects)
+                trace('post-process', post_start_time, target=target_query.name, rows=len(objects))
+        rows = batch['rows'] if encoded else len(objects)
+        if stats is not None:
+            stats.record(engine, target_query, engine_start_time, engine_latency, rows, response_info.get('bytes'), 'ok')
+        msg = '{0} Retrieved {1} Object{2} to save from this Engine for Query "{3}".'.format(
+            eng_name, rows, 's' if rows != 1 else '', target_query.name)
+        config.add_to_email(msg)
+        print(msg)
+        if config.debug_engine:
+            logger.debug('{0} - {1}'.format(func_name, msg))
+
+        # 5. Save the query results to the output
+        if rows == 0 and config.debug_engine:
+            logger.debug(
+                '{0} - Skipping write of output file for Engine "{1}", no rows were returned for Query "{2}".'.format(
+                    func_name, eng_name, target_query.name))
+        write_start_time = time.time()
+        if encoded:
+            written_ok = sink.write_encoded(engine, raw, batch)
+        else:
+            written_ok = sink.write(engine, objects)
+        trace('write', write_start_time, target=target_query.name, rows=rows, ok=written_ok)
+        if checkpoint is not None:
+            checkpoint_start_time = time.time()
+            if written_ok:
+                checkpoint.save_results(target_query, engine, raw if encoded else objects, rows)
+            else:
+                checkpoint.mark(target_query, engine, 'failed')
+            trace('checkpoint', checkpoint_start_time, target=target_query.name)
+
+        # 6. Queue the devices found for the query's Remote Action
+        if dispatcher is not None:
+            dispatcher.add(engine, objects)
+        if keep_results:
+            results[target_query.name] = objects if written_ok else None
+        account(target_query, rows, target_cpu_start)
+    trace('Query "{0}" on Engine "{1}"'.format(query.name, engine.name), process_start_time, status='ok',
+        rows=batch['rows'] if encoded else len(engine_objects))
+    return results
+
+def get_engine_list(logger, config, portals, tracer=None):
+    """ Retrieves the connected Engines of the Portals, at the same time, and
+    merges them into a single list. With several Portals, the Engine names are
+    prefixed with the name of their Portal, and an Engine listed by several
+    Portals is only queried once (through the first of them).
+
+    Arguments:
+    logger: Initialized logger instance
+    config: Initialized MultiEngineQueryConfig object
+    portals: list of PortalAppliance instances
+    tracer: Optional RunTracer recording the Portal requests in the run's timeline
+
+    Returns:
+    list of EngineAppliance instances
+    """
+    func_name = inspect.currentframe().f_code.co_name
+    federated = len(portals) > 1
+
+    def list_engines(portal):
+        portal_start_time = time.time()
+        try:
+            portal_engines = portal.get_engine_list(config.engine_port, only_connected=True, qualify_names=federated)
+        except Exception as exc:
+            logger.error('{0} - Unable to retrieve the Engines of Portal "{1}": {2!r}'.format(func_name, portal.name, exc))
+            portal_engines = None
+        if tracer is not None:
+            tracer.add('Portal "{0}" Engine list'.format(portal.name), 'portal', portal_start_time, time.time(),
+                {'portal': portal.name, 'engines': None if portal_engines is None else len(portal_engines)})
+        return portal_engines, portal_start_time, time.time()
+
+    with ThreadPoolExecutor(max_workers=len(portals)) as executor:
+        listed = list(executor.map(list_engines, portals))
+
+    engine_list = []
+    hostnames = {}
+    for portal, (portal_engines, portal_start_time, portal_end_time) in zip(portals, listed):
+        if portal_engines is None:
+            msg = 'Unable to retrieve the Engines of Portal "{0}"{1}.'.format(
+                portal.name, ', so skipping its Engines' if federated else '')
+            portal_engines = []
+        else:
+            msg = 'Retrieved {0} connected Engine{1} from Portal "{2}" in {3}.'.format(
+                len(portal_engines), 's' if len(portal_engines) != 1 else '', portal.name,
+                timer(portal_start_time, portal_end_time))
+        config.add_to_email(msg)
+        print(msg)
+        if config.verbose: logger.info("{0} - {1}".format(func_name, msg))
+        for engine in portal_engines:
+            if engine.hostname_fqdn in hostnames:
+                logger.warning('{0} - Engine "{1}" ({2}) is also listed by Portal "{3}", so querying it once, as "{4}".'.format(
+                    func_name, engine.name, engine.hostname_fqdn, hostnames[engine.hostname_fqdn].portal,
+                    hostnames[engine.hostname_fqdn].name))
+                continue
+            hostnames[engine.hostname_fqdn] = engine
+            engine_list.append(engine)
+    if federated:
+        msg = 'Querying {0} Engine{1} from {2} Portals.'.format(
+            len(engine_list), 's' if len(engine_list) != 1 else '', len(portals))
+        config.add_to_email(msg)
+        print(msg)
+        if config.verbose: logger.info("{0} - {1}".format(func_name, msg))
+    return engine_list
+
+def plan_waves(logger, config, units, together):
+    """ Splits the queries into waves of queries that run together.
+
+    Arguments:
+    logger: Initialized logger instance
+    config: Initialized MultiEngineQueryConfig object
+    units: list of (NXQLQuery to run, list of NXQLQuery instances it answers),
+        see query_optimizer.merge_queries
+    together: If False, every unit is a wave of its own (the queries run
+        one after the other, apart from merged queries, and from a query
+        depending on the previous one, which starts on each Engine as soon
+        as the previous query is done with it). Otherwise the units
+        are kept together, in order, until a query writes to the same output
+        file as a query of the wave (e.g. the same SQLite database), which
+        starts a new wave.
+
+    Returns:
+    list of lists of units
+    """
+    if not together:
+        waves = []
+        for unit in units:
+            if waves and unit[0].depends_on in [query.name for query in waves[-1][-1][1]]:
+                waves[-1].append(unit)
+            else:
+                waves.append([unit])
+        return waves
+    waves = []
+    fnames = set()
+    for unit in units:
+        unit_fnames = [get_output_file_name(logger, config, query) for query in unit[1]]
+        if not waves or fnames.intersection(unit_fnames):
+            waves.append([])
+            fnames = set()
+        waves[-1].append(unit)
+        fnames.update(unit_fnames)
+    return waves
+
+def dependency_values(logger, config, query, engine, results, checkpoint=None):
+    """ Returns the values of query.depends_field in the results of engine for
+    the query that query depends on, deduplicated, in order.
+
+    Arguments:
+    logger: Initialized logger instance
+    config: Initialized MultiEngineQueryConfig object
+    query: NXQLQuery instance depending on another query
+    engine: Initialized Engine instance
+    results: dict of (query name, Engine name): list of dict objects (None if
+        the Engine failed), see run_wave
+    checkpoint: Optional RunCheckpoint holding the results of a resumed run
+
+    Returns:
+    list of values, or None if the query it depends on failed on the Engine
+    """
+    key = (query.depends_on, engine.name)
+    if key not in results:
+        # Not run against the Engine in this run: done in the resumed run, or failed
+        objects = None
+        dependency = [q for q in config.queries if q.name == query.depends_on][0]
+        if checkpoint is not None and engine.name in [e.name for e in checkpoint.done_engines(dependency)]:
+            objects = checkpoint.load_results(dependency, engine)
+        results[key] = objects
+    if results[key] is None:
+        return None
+    values = []
+    seen = set()
+    for obj in results[key]:
+        value = obj.get(query.depends_field)
+        if value is None or value == '' or value in seen:
+            continue
+        seen.add(value)
+        values.append(value)
+    return values
+
+def run_wave(logger, config, started, engine_list, results, decoder_pool=None, health=None, stats=None,
+             checkpoint=None, governor=None, locks=None, accounting=None, tracer=None):
+    """ Runs the queries of a wave against every Engine and saves the results
+    (4. to 6.). A query depending on another query starts on an Engine as
+    soon as the Engine's results of the query it depends on are available.
+    With a governor, a query is only submitted once the governor has a slot
+    for its Engine (the others are kept, in order, until a query completes),
+    so that the worker threads never wait for one.
+
+    Arguments:
+    logger: Initialized logger instance
+    config: Initialized MultiEngineQueryConfig object
+    started: list of (NXQLQuery to run, list of dicts returned by open_query)
+    engine_list: list of Engine instances
+    results: dict of (query name, Engine name): list of dict objects (None if
+        the Engine failed), for the queries other queries depend on. Updated
+        with the results of the wave.
+    decoder_pool, health, stats, checkpoint, governor, locks, accounting, tracer: see process_engine
+    """
+    func_name = inspect.currentframe().f_code.co_name
+    needed = set(query.depends_on for query in config.queries if query.depends_on)
+    waiting = []
+    queued = []
+    pending = {}
+    produced = set()
+    with ThreadPoolExecutor(max_workers=config.engine_max_workers) as executor:
+        def submit(run_query, targets, engine, values=None, queued_time=None):
+            if governor is not None and not governor.try_acquire(engine):
+                queued.append((run_query, targets, engine, values, queued_time or time.time()))
+                return
+            if queued_time is not None and tracer is not None:
+                tracer.add('wait for a slot', 'engine', queued_time, time.time(),
+                    {'engine': engine.name, 'query': run_query.name})
+            keep_results = any(target['query'].name in needed for target in targets)
+            future = executor.submit(process_engine, logger, config, engine, run_query, targets,
+                decoder_pool, health, stats, checkpoint, governor, values, keep_results, locks, accounting, tracer)
+            pending[future] = (engine, targets)
+
+        def submit_queued():
+            # In order, skipping the Engines that have no free slot yet
+            for item in list(queued):
+                queued.remove(item)
+                submit(*item)
+
+        def submit_ready():
+            for item in list(waiting):
+                run_query, targets, engine = item
+                # Ready once the Engine's results are in, or if the wave does not produce them
+                key = (run_query.depends_on, engine.name)
+                if key in results or key not in produced:
+                    waiting.remove(item)
+                    submit(run_query, targets, engine,
+                        dependency_values(logger, config, run_query, engine, results, checkpoint))
+
+        # Submitted query by query, so that the queries of an Engine are spread over the wave
+        for run_query, opened_members in started:
+            for engine in engine_list:
+                targets = [o for o in opened_members if engine in o['engines']]
+                if not targets:
+                    continue
+                produced.update((target['query'].name, engine.name) for target in targets)
+                if run_query.depends_on:
+                    waiting.append((run_query, targets, engine))
+                else:
+                    submit(run_query, targets, engine)
+        submit_ready()
+        while pending:
+            done, _ = wait(list(pending), return_when=FIRST_COMPLETED)
+            for future in done:
+                engine, targets = pending.pop(future)
+                if governor is not None:
+                    governor.release(engine)
+                try:
+                    returned = future.result()
+                except Exception as exc:
+                    logger.error('{0} - Unexpected error while processing Engine "{1}": {2!r}'.format(
+                        func_name, engine.name, exc))
+                    returned = dict((target['query'].name, None) for target in targets)
+                for name, objects in returned.items():
+                    if name in needed:
+                        results[(name, engine.name)] = objects
+            submit_queued()
+            submit_ready()
+
+def open_query(logger, config, portals, query, engine_list, unreachable, stats=None, checkpoint=None):
+    """ Creates the output of a query, and works out which Engines to run it against.
+
+    Arguments:
+    logger: Initialized logger instance
+    config: Initialized MultiEngineQueryConfig object
+    portals: The PortalAppliance instances, for the query's Remote Action
+    query: Initialized NXQLQuery instance
+    engine_list: list of reachable EngineAppliance
+    unreachable: list of (EngineAppliance, probe result) that are unreachable
+    stats: Optional RunStatsStore recording the run's statistics
+    checkpoint: Optional RunCheckpoint saving the run's progress
+
+    Returns:
+    dict with query, sink, dispatcher, post (its PostProcessor), engines (to
+    run the query against) and start_time; None if the query is skipped; False if the output could not
+    be created
+    """
+    func_name = inspect.currentframe().f_code.co_name
+    query_start_time = time.time()
+
+    if config.verbose:
+        msg = 'Processing Query "{0}".'.format(query.name)
+        print(msg)
+        config.add_to_email(msg)
+        logger.info('{} - {}'.format(func_name, msg))
+
+    if checkpoint is not None and checkpoint.query_done(query):
+        msg = 'Query "{0}" was already completed by the run being resumed, so skipping it.'.format(query.name)
+        print(msg)
+        config.add_to_email(msg)
+        if config.verbose: logger.info('{0} - {1}'.format(func_name, msg))
+        return None
+
+    sink = OutputSink.create(logger, config, query)
+    if not sink.open():
+        msg = 'Unable to create the output file ("{0}") for Query "{1}", so exiting.'.format(sink.fname, query.name)
+        print(msg)
+        config.add_to_email(msg)
+        return False
+
+    dispatcher = None
+    if query.remote_action_id:
+        dispatcher = RemoteActionDispatcher(logger, config, portals, query)
+
+    post = PostProcessor.from_query(logger, query)
+    if post is not None and config.verbose:
+        logger.info('{0} - Post-processing the results of Query "{1}" {2}.'.format(
+            func_name, query.name, 'with pandas' if post.vectorized else 'row by row (pandas is not installed)'))
+
+    # Write the results saved by the run being resumed, instead of querying those Engines again
+    query_engines = engine_list
+    query_unreachable = unreachable
+    if checkpoint is not None and checkpoint.resumed:
+        resumed = []
+        for engine in checkpoint.done_engines(query):
+            engine_objects = checkpoint.load_results(query, engine)
+            if engine_objects is not None and sink.write(engine, engine_objects):
+                resumed.append(engine.name)
+        query_engines = [e for e in engine_list if e.name not in resumed]
+        query_unreachable = [(e, p) for e, p in unreachable if e.name not in resumed]
+        msg = 'Resumed Query "{0}" with the saved results of {1} Engine{2}; querying the {3} other Engine{4}.'.format(
+            query.name, len(resumed), 's' if len(resumed) != 1 else '',
+            len(query_engines), 's' if len(query_engines) != 1 else '')
+        print(msg)
+        config.add_to_email(msg)
+        if config.verbose: logger.info('{0} - {1}'.format(func_name, msg))
+
+    for engine, probe in query_unreachable:
+        sink.fail(engine, 'Unreachable: {}'.format(probe['error']))
+        if stats is not None:
+            stats.record(engine, query, time.time(), 0, 0, 0, 'unreachable')
+        if checkpoint is not None:
+            checkpoint.mark(query, engine, 'unreachable')
+    return {
+        'query': query,
+        'sink': sink,
+        'dispatcher': dispatcher,
+        'post': post,
+        'engines': query_engines,
+        'start_time': query_start_time}
+
+def close_query(logger, config, opened, checkpoint=None):
+    """ Completes the output of a query once all of its Engines are done, and
+    reports on its Remote Action.
+
+    Arguments:
+    logger: Initialized logger instance
+    config: Initialized MultiEngineQueryConfig object
+    opened: The dict returned by open_query
+    checkpoint: Optional RunCheckpoint saving the run's progress
+    """
+    func_name = inspect.currentframe().f_code.co_name
+    query, sink, dispatcher = opened['query'], opened['sink'], opened['dispatcher']
+    finalized = sink.close()
+    if not finalized:
+        msg = 'Unable to complete the output file ("{0}") for Query "{1}".'.format(sink.fname, query.name)
+        print(msg)
+        config.add_to_email(msg)
+    if finalized and query.output_mode == 'delta':
+        changes = sink.changes
+        msg = 'Delta of Query "{0}" against the previous run: {1} added, {2} changed, {3} removed row{4}{5}.'.format(
+            query.name, changes['added'], changes['changed'], changes['removed'],
+            's' if changes['removed'] != 1 else '',
+            '' if any(changes.values()) else ' (no output file was written)')
+        print(msg)
+        config.add_to_email(msg)
+        if config.verbose: logger.info('{0} - {1}'.format(func_name, msg))
+    if checkpoint is not None:
+        checkpoint.finish_query(query, finalized)
+    output_fname = sink.fname
+    if dispatcher is not None:
+        outcomes = dispatcher.close()
+        failed = [o for o in outcomes if o['status'] != 'ok']
+        msg = 'Remote Action "{0}" for Query "{1}": {2} device{3} sent in {4} batch{5}, {6} failed.'.format(
+            query.remote_action_id, query.name, dispatcher.devices, 's' if dispatcher.devices != 1 else '',
+            len(outcomes), 'es' if len(outcomes) != 1 else '', len(failed))
+        config.add_to_email(msg)
+        print(msg)
+        if config.verbose: logger.info('{0} - {1}'.format(func_name, msg))
+        for outcome in failed:
+            msg = 'Remote Action "{0}" batch {1} ({2} devices) failed.'.format(
+                query.remote_action_id, outcome['batch'], outcome['devices'])
+            config.add_to_email(msg)
+            logger.error('{0} - {1}'.format(func_name, msg))
+
+    query_end_time = time.time()
+    if config.verbose:
+        msg = 'Completed collecting and writing results for "{0}" to "{1}" in {2}.'.format(
+            query.name, output_fname, timer(opened['start_time'], query_end_time))
+        logger.info('{0} - {1}'.format(func_name, msg))
+        print(msg)
+
+def abort_query(logger, config, opened):
+    """ Releases the output of a query that was opened but not run, when the
+    run stops before its Engines are queried. Nothing is recorded in the
+    checkpoint, so that a resumed run runs the query.
+
+    Arguments:
+    logger: Initialized logger instance
+    config: Initialized MultiEngineQueryConfig object
+    opened: The dict returned by open_query
+    """
+    func_name = inspect.currentframe().f_code.co_name
+    opened['sink'].abort()
+    if opened['dispatcher'] is not None:
+        opened['dispatcher'].close()
+    if config.verbose:
+        logger.info('{0} - Released the output ("{1}") of Query "{2}" without running it.'.format(
+            func_name, opened['sink'].fname, opened['query'].name))
+
+def run_preview(config, count=None):
+    """ Previews the queries: runs them on a sample of the Engines (see
+    preview.sample_engines), at the same time, with at most
+    config.preview_rows rows per Engine, saves the results next to the log
+    file, and estimates the size and duration of a full run. Nothing is
+    written to the query outputs, and no Remote Action is sent.
+
+    Arguments:
+    config: Initialized MultiEngineQueryConfig object
+    count: The number of Engines to sample (default config.preview_engines)
+    """
+    func_name = inspect.currentframe().f_code.co_name
+    logger = init(config)
+    start_time = time.time()
+    count = count or config.preview_engines
+
+    portals = PortalAppliance.create_all(config)
+    engine_list = get_engine_list(logger, config, portals)
+    history = RunStatsStore(logger, config)
+    health = None
+    if config.engine_probe and engine_list:
+        health = EngineHealth(logger, config, history)
+        engine_list, unreachable = health.schedule(engine_list)
+        health.save()
+    if len(engine_list) == 0:
+        print('No Engine Appliances are connected or reachable, so there is nothing to preview.')
+        return
+    latencies = history.engine_latencies(HISTORY_DAYS)
+    if health is not None:
+        latencies = dict((e.hostname_fqdn, health.history(e)) for e in engine_list)
+    sample = sample_engines(engine_list, latencies, history.engine_rows(HISTORY_DAYS), count)
+    print('Previewing {0} quer{1} on {2} of the {3} Engine{4}, at most {5} rows per Engine: {6}.'.format(
+        len(config.queries), 'ies' if len(config.queries) != 1 else 'y', len(sample), len(engine_list),
+        's' if len(engine_list) != 1 else '', config.preview_rows,
+        ', '.join('{0} ({1})'.format(e.name, reason) for e, reason in sample)))
+
+    def preview_engine(engine):
+        # The queries run in order on the Engine, for the queries depending on others
+        results = {}
+        samples = {}
+        for query in config.queries:
+            request = query.limited(config.preview_rows)
+            if query.depends_on:
+                values = dependency_values(logger, config, query, engine, results)
+                if values is None:
+                    results[(query.name, engine.name)] = None
+                    continue
+                request = request.bind(values[:query.depends_chunk_size])
+            request_start_time = time.time()
+            response_info = {}
+            objects = run_query_on_engine(logger, config, engine, request, response_info=response_info)
+            latency = time.time() - request_start_time
+            if objects is not None:
+                samples[query.name] = {'rows': len(objects), 'bytes': response_info.get('bytes') or 0,
+                    'latency': latency, 'capped': len(objects) >= config.preview_rows}
+                post = PostProcessor.from_query(logger, query)
+                if post is not None:
+                    objects = post.apply(objects)
+            results[(query.name, engine.name)] = objects
+        return results, samples
+
+    outcomes = {}
+    with ThreadPoolExecutor(max_workers=max(1, min(len(sample), config.engine_max_workers))) as executor:
+        futures = dict((executor.submit(preview_engine, engine), engine) for engine, reason in sample)
+        for future in futures:
+            try:
+                outcomes[futures[future].name] = future.result()
+            except Exception as exc:
+                logger.error('{0} - Unexpected error previewing Engine "{1}": {2!r}'.format(
+                    func_name, futures[future].name, exc))
+
+    for query in config.queries:
+        print('')
+        objects = []
+        samples = {}
+        for engine, reason in sample:
+            results, engine_samples = outcomes.get(engine.name, ({}, {}))
+            engine_objects = results.get((query.name, engine.name))
+            if engine_objects is None:
+                print('Query "{0}": no results from Engine "{1}".'.format(query.name, engine.name))
+                continue
+            samples[engine.name] = engine_samples[query.name]
+            objects.extend(dict(obj, engine_name=engine.name) for obj in engine_objects)
+        fname = '{0}.preview.{1}.csv'.format(os.path.splitext(config.log_path)[0], query.name)
+        if objects:
+            field_names = ['engine_name'] + [k for k in objects[0].keys() if k != 'engine_name']
+            write_to_output_file(logger, config, query, fname, objects, field_names, True)
+        print('Query "{0}": {1} row{2} from {3} Engine{4}{5}.'.format(
+            query.name, len(objects), 's' if len(objects) != 1 else '', len(samples),
+            's' if len(samples) != 1 else '', ', saved to "{}"'.format(fname) if objects else ''))
+        for obj in objects[:5]:
+            print('  {}'.format(obj))
+        estimate = estimate_run(engine_list, samples, history.query_history(query.name, HISTORY_DAYS),
+            config.engine_max_workers)
+        if estimate is not None:
+            msg = 'Query "{0}": a full run would return {1}{2} rows ({3}) from {4} Engine{5} in about {6}{7}.'.format(
+                query.name, 'at least ' if estimate['lower_bound'] else '', estimate['rows'],
+                format_size(estimate['bytes']), len(engine_list), 's' if len(engine_list) != 1 else '',
+                timer(0, estimate['duration']),
+                ' ({} Engines estimated from their previous runs)'.format(estimate['from_history'])
+                    if estimate['from_history'] else '')
+            print(msg)
+            logger.info('{0} - {1}'.format(func_name, msg))
+    print('')
+    print('Preview completed in {0}.'.format(timer(start_time, time.time())))
+
+def report_resources(logger, config, accounting, engine_list):
+    """ Adds the resources used by the run to the email, and saves them next
+    to the log file (see ResourceAccounting.summary)
+
+    Arguments:
+    logger: Initialized logger instance
+    config: Initialized MultiEngineQueryConfig object
+    accounting: The ResourceAccounting of the run
+    engine_list: list of the EngineAppliance instances of the run
+    """
+    func_name = inspect.currentframe().f_code.co_name
+    summary = accounting.summary(engine_list)
+    lines = ['Resources: {0} CPU user, {1} CPU system ({2} and {3} in the decoder processes), '
+        'peak RSS {4}; {5} received, {6} written; {7} rows in {8} ({9:,.0f} rows/s).'.format(
+        timer(0, summary['cpu_user']), timer(0, summary['cpu_system']),
+        timer(0, summary['children_cpu_user']), timer(0, summary['children_cpu_system']),
+        'unknown' if summary['peak_rss'] is None else format_size(summary['peak_rss']),
+        format_size(summary['bytes_received']), format_size(summary['bytes_written']),
+        summary['rows'], timer(0, summary['duration']), summary['rows_per_second'] or 0)]
+    for name in sorted(summary['queries']):
+        query = summary['queries'][name]
+        lines.append('Resources of Query "{0}": {1} CPU user, {2} CPU system, peak RSS {3} (+{4}); '
+            '{5} received, {6} written; {7} rows in {8} ({9:,.0f} rows/s).'.format(
+            name, timer(0, query['cpu_user']), timer(0, query['cpu_system']),
+            'unknown' if query['peak_rss'] is None else format_size(query['peak_rss']),
+            format_size(query['peak_rss_growth'] or 0), format_size(query['bytes_received']),
+            format_size(query['bytes_written']), query['rows'], timer(0, query['duration']),
+            query['rows_per_second'] or 0))
+    for name in sorted(summary['engines']):
+        engine = summary['engines'][name]
+        lines.append('Resources of Engine "{0}": {1} received in {2} response{3} ({4} transferred).'.format(
+            name, format_size(engine['bytes']), engine['responses'], 's' if engine['responses'] != 1 else '',
+            format_size(engine['wire_bytes'])))
+    for position, msg in enumerate(lines):
+        config.add_to_email(msg)
+        if position == 0:
+            print(msg)
+        if config.verbose: logger.info('{0} - {1}'.format(func_name, msg))
+    if accounting.save(config.resource_summary_path, summary) and config.verbose:
+        logger.info('{0} - Saved the resource summary to "{1}".'.format(func_name, config.resource_summary_path))
+
+def run_multi_engine_query(config, stats=None, checkpoint=None, tracer=None):
     """ Based on the specified named query, collect all engines, and run the query against
     all engines and put the output in a single .csv file.
 
     High-level logic:
     1. Create a Portal object instance
     2. Get the list of Engines from the Portal
+       (and, if configured, probe them to skip the unreachable ones and
+       order them slowest first)
     3. Create the output file
-    For each Engine:
+    For each Engine (config.engine_max_workers at a time, and, when several
+    queries may run against an Engine at once, for the queries of a wave
+    together, as many at once as the ConcurrencyGovernor allows):
         4. Run the query against that engine
-        5. Append the results to the output file
+        5. Append the results to the output file (or its own shard)
+        6. Send the devices found to the query's Remote Action, if any
 
     Arguments:
     config: Initialized MultiEngineQueryConfig object
+    stats: Optional RunStatsStore recording the run's statistics
+    checkpoint: Optional RunCheckpoint saving the run's progress. When it
+        was resumed, the queries it completed are skipped, and the saved
+        results of the other queries are written again instead of querying
+        their Engines (the Remote Actions are not sent again for them).
+    tracer: Optional RunTracer recording the run's timeline
     """
     func_name = inspect.currentframe().f_code.co_name
 
     # Create the logger, and enable Class-level debugging
     logger = init(config)
+    Appliance.set_tracer(tracer)
 
     start_time = time.time()
     if config.verbose:
         logger.info('{} - Starting'.format(func_name))
 
-    # 1. Create a Portal object instance
-    portal = PortalAppliance.create(config)
-
-    # 2. Get the list of Connected Engines from the Portal
-    portal_start_time = time.time()
-    engine_list = portal.get_engine_list(config.engine_port, only_connected=True)
-    portal_end_time = time.time()
-    msg = 'Retrieved {0} connected Engine{1} from Portal "{2}" in {3}.'.format(
-        len(engine_list), 's' if len(engine_list) != 1 else '', portal.name,
-        timer(portal_start_time, portal_end_time))
-    config.add_to_email(msg)
-    print(msg)
-    if config.verbose: logger.info("{0} - {1}".format(func_name, msg))
+    # Account for the resources used by the run, if configured
+    accounting = None
+    if config.resource_summary:
+        accounting = ResourceAccounting(logger, config)
+
+    # 1. Create a Portal object instance (one per Portal, if several are configured)
+    portals = PortalAppliance.create_all(config)
+
+    # 2. Get the list of Connected Engines from the Portals
+    engine_list = get_engine_list(logger, config, portals, tracer)
     # If there are no Enigne Appliances, just note the fact and exit.
     if len(engine_list) == 0:
         msg = 'No Engine Appliances are connected or available, so exiting.'
@@ -71,56 +790,215 @@ def run_multi_engine_query(config):
         config.add_to_email(msg)
         return finish_process(func_name, logger, config, start_time, finished=True)
 
-    # For each query
-    for query in config.queries:
-        query_start_time = time.time()
-
+    # Probe the Engines: skip the unreachable ones, and start the slowest first
+    health = None
+    unreachable = []
+    if config.engine_probe:
+        health = EngineHealth(logger, config, stats)
+        probe_start_time = time.time()
+        engine_list, unreachable = health.schedule(engine_list)
+        if tracer is not None:
+            tracer.add('probe Engines', 'portal', probe_start_time, time.time(),
+                {'reachable': len(engine_list), 'unreachable': len(unreachable)})
+        for engine, probe in unreachable:
+            msg = '[{0} ({1})] Skipping this Engine, it did not answer the probe{2}: {3}'.format(
+                engine.name, engine.hostname_fqdn, ' (cached)' if probe['cached'] else '', probe['error'])
+            config.add_to_email(msg)
+            print(msg)
+            logger.warning('{0} - {1}'.format(func_name, msg))
         if config.verbose:
-            msg = 'Processing Query "{0}".'.format(query.name)
+            logger.info('{0} - Engine order: {1}'.format(func_name, ', '.join(e.name for e in engine_list)))
+        if len(engine_list) == 0:
+            msg = 'No Engine Appliances are reachable, so exiting.'
             print(msg)
             config.add_to_email(msg)
-            logger.info('{} - {}'.format(func_name, msg))
+            health.save()
+            return finish_process(func_name, logger, config, start_time, finished=True)
 
-        # 3. Create the output file
-        output_fname, output_created = create_output_file(logger, config, query)
-        if not output_created:
-            msg = 'Unable to create the output file ("{0}") for Query "{1}", so exiting.'.format(output_fname, query.name)
+    # Send the Engine queries to the worker instances, if configured
+    coordinator = None
+    if config.workers:
+        coordinator = WorkerCoordinator(logger, config)
+        if not config.worker_authkey or not coordinator.connect():
+            msg = 'None of the workers ({0}) are available{1}, so exiting.'.format(
+                ', '.join(config.workers), '' if config.worker_authkey else ' without a worker_authkey')
             print(msg)
             config.add_to_email(msg)
+            logger.error('{0} - {1}'.format(func_name, msg))
+            if health is not None:
+                health.save()
             return finish_process(func_name, logger, config, start_time, finished=True)
+        engine_list = coordinator.assign(engine_list)
+        live = [link for link in coordinator.links if link.alive]
+        msg = 'Querying the {0} Engine{1} through {2} of {3} worker{4}.'.format(
+            len(engine_list), 's' if len(engine_list) != 1 else '', len(live),
+            len(coordinator.links), 's' if len(coordinator.links) != 1 else '')
+        config.add_to_email(msg)
+        print(msg)
+        if config.verbose: logger.info('{0} - {1}'.format(func_name, msg))
 
-        # For each Engine
-        first_engine = True
-        for engine in engine_list:
-            eng_name = '[{0} ({1})]'.format(engine.name, engine.hostname_fqdn)
+    # Worker processes decoding and encoding the results, if configured
+    decoder_pool = None
+    if config.engine_decode_processes > 0:
+        decoder_pool = ProcessPoolExecutor(max_workers=config.engine_decode_processes)
 
-            # 4. Run the query
-            engine_objects = run_query_on_engine(logger, config, engine, query)
-            msg = '{0} Retrieved {1} Object{2} to save from this Engine for Query "{3}".'.format(
-                eng_name, len(engine_objects), 's' if len(engine_objects) != 1 else '', query.name)
-            config.add_to_email(msg)
-            print(msg)
-            if config.debug_engine:
-                logger.debug('{0} - {1}'.format(func_name, msg))
-
-            # 5. Save the query results to the output file
-            if len(engine_objects) > 0:
-                if first_engine:
-                    field_names = engine_objects[0].keys()
-                written_ok = write_to_output_file(logger, config, query, output_fname, engine_objects, field_names, first_engine)
-                first_engine = False
-            elif config.debug_engine:
-                logger.debug(
-                    '{0} - Skipping write of output file for Engine "{1}", no rows were returned for Query "{2}".'.format(
-                        func_name, eng_name, query.name))
-
-        query_end_time = time.time()
+    # Adapt the number of queries sent to each Engine at once, if several are allowed
+    governor = None
+    if config.engine_max_requests_per_engine > 1:
+        governor = ConcurrencyGovernor(logger, config)
+
+    # Coordinate the queries with the other instances on this host, if configured
+    # (the workers coordinate the queries on their own hosts)
+    locks = None
+    if config.engine_host_max_requests > 0 and coordinator is None:
+        if not HostEngineLocks.available():
+            logger.warning('{0} - engine_host_max_requests is not supported on this platform, ignoring it.'.format(func_name))
+        else:
+            locks = HostEngineLocks(logger, config)
+            if not locks.open():
+                locks = None
+
+    # Queries that only differ by their fields share a single query to each Engine, if configured
+    if config.merge_queries:
+        units = merge_queries(logger, config.queries)
+    else:
+        units = [(query, [query]) for query in config.queries]
+
+    # Results of the queries other queries depend on, by (query name, Engine name)
+    results = {}
+    # Set when the output of a query could not be created, which stops the run
+    stopped = False
+    # For each query (or each wave of queries run together, see plan_waves)
+    for wave in plan_waves(logger, config, units, together=governor is not None):
+        started = []
+        for run_query, members in wave:
+            # 3. Create the output files
+            opened_members = []
+            for query in members:
+                open_start_time = time.time()
+                opened = open_query(logger, config, portals, query, engine_list, unreachable, stats, checkpoint)
+                if tracer is not None:
+                    tracer.add('open Query "{0}"'.format(query.name), 'output', open_start_time, time.time(),
+                        {'query': query.name})
+                if opened is False:
+                    stopped = True
+                    break
+                if opened is not None:
+                    opened_members.append(opened)
+                    if accounting is not None:
+                        accounting.start_query(query, opened['sink'])
+            if len(opened_members) == 1:
+                run_query = opened_members[0]['query']
+            if opened_members:
+                started.append((run_query, opened_members))
+            if stopped:
+                break
+
+        # Release the outputs the wave already opened, and skip to the end of the run
+        if stopped:
+            for run_query, opened_members in started:
+                for opened in opened_members:
+                    abort_query(logger, config, opened)
+                    if accounting is not None:
+                        accounting.finish_query(opened['query'], opened['sink'])
+            break
+
+        # For each Engine, run the queries and save the results (4. to 6.)
+        wave_start_time = time.time()
+        run_wave(logger, config, started, engine_list, results, decoder_pool, health, stats, checkpoint, governor,
+            locks, accounting, tracer)
+        if tracer is not None:
+            tracer.add('wait for the Engines', 'wave', wave_start_time, time.time(),
+                {'queries': [run_query.name for run_query, opened_members in started]})
+        for run_query, opened_members in started:
+            for opened in opened_members:
+                close_start_time = time.time()
+                close_query(logger, config, opened, checkpoint)
+                if tracer is not None:
+                    tracer.add('close Query "{0}"'.format(opened['query'].name), 'output', close_start_time, time.time(),
+                        {'query': opened['query'].name, 'output': opened['sink'].fname})
+                if accounting is not None:
+                    accounting.finish_query(opened['query'], opened['sink'])
+
+    if governor is not None and governor.summary():
+        summary = governor.summary()
+        msg = 'Adaptive concurrency: up to {0} queries at once per Engine; {1} of {2} Engine{3} backed off ({4} failed request{5}).'.format(
+            max([s['peak'] for s in summary.values()] or [0]),
+            len([s for s in summary.values() if s['backoffs'] > 0]), len(summary), 's' if len(summary) != 1 else '',
+            sum(s['errors'] for s in summary.values()), 's' if sum(s['errors'] for s in summary.values()) != 1 else '')
+        config.add_to_email(msg)
+        print(msg)
         if config.verbose:
-            msg = 'Completed collecting and writing results for "{0}" to "{1}" in {2}.'.format(
-                query.name, output_fname, timer(query_start_time, query_end_time))
             logger.info('{0} - {1}'.format(func_name, msg))
+            for name in sorted(summary):
+                logger.info('{0} - Engine "{1}": {2}'.format(func_name, name, summary[name]))
+
+    if locks is not None and locks.shared > 0:
+        msg = 'Reused {0} Engine response{1} of other instances running the same queries.'.format(
+            locks.shared, 's' if locks.shared != 1 else '')
+        config.add_to_email(msg)
+        print(msg)
+        if config.verbose: logger.info('{0} - {1}'.format(func_name, msg))
+
+    # Report how much the compression of the Engine responses saved
+    total_bytes = 0
+    total_wire_bytes = 0
+    for engine in engine_list:
+        transfer = engine.transfer
+        if transfer['responses'] == 0:
+            continue
+        total_bytes += transfer['bytes']
+        total_wire_bytes += transfer['wire_bytes']
+        msg = '[{0} ({1})] Received {2} as {3} ({4}): compression ratio {5:.1f}, {6} saved.'.format(
+            engine.name, engine.hostname_fqdn, format_size(transfer['bytes']), format_size(transfer['wire_bytes']),
+            ', '.join(transfer['encodings']), float(transfer['bytes']) / max(1, transfer['wire_bytes']),
+            format_size(max(0, transfer['bytes'] - transfer['wire_bytes'])))
+        config.add_to_email(msg)
+        if config.verbose:
             print(msg)
+            logger.info('{0} - {1}'.format(func_name, msg))
+    if total_bytes > 0:
+        msg = 'Received {0} of results as {1}: compression ratio {2:.1f}, {3} saved.'.format(
+            format_size(total_bytes), format_size(total_wire_bytes), float(total_bytes) / max(1, total_wire_bytes),
+            format_size(max(0, total_bytes - total_wire_bytes)))
+        config.add_to_email(msg)
+        print(msg)
+        if config.verbose: logger.info('{0} - {1}'.format(func_name, msg))
 
+    # Report the responses recorded or replayed, if requested
+    recorder = Appliance.get_recorder()
+    if recorder is not None:
+        counts = recorder.counts
+        if recorder.mode == 'record':
+            msg = 'Recorded {0} response{1} to "{2}".'.format(
+                counts['recorded'], 's' if counts['recorded'] != 1 else '', recorder.path)
+        else:
+            msg = 'Replayed {0} response{1} from "{2}"{3}{4}.'.format(
+                counts['replayed'], 's' if counts['replayed'] != 1 else '', recorder.path,
+                ' with their original latencies' if recorder.latency else '',
+                ', {0} not recorded'.format(counts['missing']) if counts['missing'] else '')
+        config.add_to_email(msg)
+        print(msg)
+        if config.verbose: logger.info('{0} - {1}'.format(func_name, msg))
+
+    if coordinator is not None:
+        for link in coordinator.links:
+            msg = 'Worker {0}:{1}: {2} request{3}, {4} of results received{5}.'.format(
+                link.address[0], link.address[1], link.requests, 's' if link.requests != 1 else '',
+                format_size(link.link_bytes), '' if link.alive else ' (unavailable)')
+            config.add_to_email(msg)
+            print(msg)
+            if config.verbose: logger.info('{0} - {1}'.format(func_name, msg))
+        coordinator.close()
+    if decoder_pool is not None:
+        decoder_pool.shutdown()
+    if health is not None:
+        health.save()
+    if accounting is not None:
+        report_start_time = time.time()
+        report_resources(logger, config, accounting, engine_list)
+        if tracer is not None:
+            tracer.add('report resources', 'report', report_start_time, time.time())
     return finish_process(func_name, logger, config, start_time)
 
 def main():
@@ -134,20 +1012,88 @@ def main():
     # Get a logger instance
     logger = logging.getLogger('logger')
 
+    # Run as a worker instance of a coordinator instead of running the query, if requested
+    if args.worker is not None:
+        if not config.worker_authkey:
+            print('ERROR: A worker_authkey is required to run as a worker.')
+            exit(1)
+        logger = init(config)
+        try:
+            serve_worker(logger, config, parse_address(args.worker or config.worker_address))
+        except KeyboardInterrupt:
+            logger.info('Worker stopped.')
+        return
+
+    # Report on the recorded run statistics instead of running the query, if requested
+    if args.report is not None:
+        for line in RunStatsStore(logger, config).report(config.queries, args.report):
+            print(line)
+        return
+
+    # Preview the queries on a sample of the Engines instead of running them, if requested
+    if args.preview is not None:
+        run_preview(config, args.preview)
+        return
+
+    # Save the run's progress, resuming an interrupted run if requested
+    checkpoint = None
+    if args.resume is not None or config.checkpoint:
+        rundate = None
+        if args.resume == 'latest':
+            rundate = RunCheckpoint.latest(logger, config)
+        elif args.resume is not None:
+            rundate = args.resume
+        if args.resume is not None and rundate is None:
+            print('There is no interrupted run of "{0}" to resume, so starting a new run.'.format(config.query_name))
+        elif rundate is not None:
+            config.rundate = rundate
+        checkpoint = RunCheckpoint(logger, config)
+        if not checkpoint.start():
+            checkpoint = None
+        elif checkpoint.resumed:
+            msg = 'Resuming the run of "{0}" started at {1}.'.format(config.query_name, config.rundate)
+            print(msg)
+            config.add_to_email(msg)
+
     start_time = time.time()
     logger.info('================ Starting Multi-Engine Query script ================')
 
+    # Record the run statistics, if configured (a replayed run would skew them)
+    stats = None
+    if config.run_stats and config.replay_path is None:
+        stats = RunStatsStore(logger, config)
+        stats.start_run()
+    elif config.run_stats and config.verbose:
+        logger.info('Not recording the statistics of a replayed run.')
+
+    # Record the run's timeline, if configured
+    tracer = None
+    if config.run_trace:
+        tracer = RunTracer(logger, config)
+
     # Start the process
-    finished = run_multi_engine_query(config)
+    finished = run_multi_engine_query(config, stats, checkpoint, tracer)
+    if checkpoint is not None and finished:
+        checkpoint.finish(config.queries)
  
     end_time = time.time()
+    if stats is not None:
+        stats.finish_run(end_time - start_time, 'completed' if finished else 'failed')
     total = timer(start_time, end_time)
     logger.info('================ Multi-Engine Query script execution completed in {0} ================'.format(total))
 
     # Send the email if finished completely, or if no Connected Engine Appliacnes were found..
     # Otherwise we had no active metris to process, so ignore.
     if finished:
+        email_start_time = time.time()
         send_mail(logger, config)
+        if tracer is not None and config.email_results:
+            tracer.add('email', 'email', email_start_time, time.time(), {'async': config.email_async})
+
+    if tracer is not None:
+        tracer.add('run', 'run', start_time, end_time, {'query_name': config.query_name, 'finished': finished})
+        if tracer.save(config.run_trace_path):
+            logger.info('Saved the timeline of the run to "{0}".'.format(config.run_trace_path))
 
 if __name__ == '__main__':
     main()
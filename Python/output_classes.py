@@ -0,0 +1,963 @@
+"""Output classes for multi_engine_query"""
+
+# Native modules
+from abc import ABCMeta, abstractmethod
+import hashlib
+import inspect
+import json
+import locale
+import logging
+import os
+import queue
+import re
+import sqlite3
+import threading
+import time
+import zlib
+
+# Optional 3rd-party modules
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Application specific modules
+from base_classes import DebugableObject
+from delta_index import DeltaIndex, row_hash
+from helpers import create_output_file, get_output_file_name, write_to_output_file
+from result_encoding import decode_json, format_csv_rows
+from timer import timer
+
+# Create the logger
+logger = logging.getLogger('logger')
+
+def copy_file_range(src_fd, dst_fd, offset, count):
+    """ Appends count bytes starting at offset of src_fd to the current position of dst_fd.
+        The copy is done by the kernel (copy_file_range, then sendfile) when the
+        platform supports it, and falls back to a plain read/write loop otherwise.
+
+    Arguments:
+        src_fd: file descriptor to copy from
+        dst_fd: file descriptor to copy to
+        offset: position in src_fd to start copying from
+        count: number of bytes to copy
+    Returns:
+        int: number of bytes copied
+    """
+    copied = 0
+    for method in ['copy_file_range', 'sendfile']:
+        if copied >= count or not hasattr(os, method):
+            continue
+        try:
+            while copied < count:
+                if method == 'copy_file_range':
+                    n = os.copy_file_range(src_fd, dst_fd, count - copied, offset + copied)
+                else:
+                    n = os.sendfile(dst_fd, src_fd, offset + copied, count - copied)
+                if n == 0:
+                    break
+                copied += n
+        except OSError:
+            # Not supported for these files (e.g. across file systems); try the next method
+            continue
+    # Whatever is left is copied through user space
+    if copied < count:
+        os.lseek(src_fd, offset + copied, os.SEEK_SET)
+        while copied < count:
+            chunk = os.read(src_fd, min(1024 * 1024, count - copied))
+            if not chunk:
+                break
+            os.write(dst_fd, chunk)
+            copied += len(chunk)
+    return copied
+
+def compression_available(compression):
+    """ Returns True if the modules needed for the compression are installed """
+    return compression != 'zstd' or zstandard is not None
+
+def new_compressor(compression):
+    """ Returns a streaming compressor object (with compress() and flush()
+        methods) producing a single gzip member or zstd frame """
+    if compression == 'gzip':
+        return zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return zstandard.ZstdCompressor().compressobj()
+
+def compress_member(data, compression):
+    """ Compresses data into a single gzip member or zstd frame.
+        Concatenated members/frames decompress as one stream. """
+    compressor = new_compressor(compression)
+    return compressor.compress(data) + compressor.flush()
+
+class BackgroundCompressor(object):
+    """A write-only binary file object that compresses the data written to it
+    in a background thread before writing it to fileobj, so compression
+    overlaps with fetching and formatting the results. At most max_pending
+    chunks are queued; write() blocks beyond that.
+
+    Attributes:
+        member_sizes: The compressed size of each completed member/frame
+    """
+
+    _END_MEMBER = object()
+
+    def __init__(self, fileobj, compression, max_pending=64):
+        self._fileobj = fileobj
+        self._compression = compression
+        self._queue = queue.Queue(max_pending)
+        self._error = None
+        self._closed = False
+        self._member_sizes = []
+        self._thread = threading.Thread(target=self._run, name='compressor')
+        self._thread.daemon = True
+        self._thread.start()
+
+    @property
+    def member_sizes(self):
+        return self._member_sizes
+
+    def _run(self):
+        compressor = None
+        size = 0
+        while True:
+            item = self._queue.get()
+            if self._error is not None:
+                # Keep draining so that writers are never blocked
+                if item is None:
+                    break
+                continue
+            try:
+                if item is None or item is self._END_MEMBER:
+                    if compressor is not None:
+                        data = compressor.flush()
+                        self._fileobj.write(data)
+                        self._member_sizes.append(size + len(data))
+                        compressor = None
+                        size = 0
+                    if item is None:
+                        break
+                else:
+                    if compressor is None:
+                        compressor = new_compressor(self._compression)
+                    data = compressor.compress(item)
+                    if data:
+                        self._fileobj.write(data)
+                        size += len(data)
+            except Exception as exc:
+                self._error = exc
+
+    def write(self, data):
+        if self._error is not None:
+            raise IOError('Compression failed: {!r}'.format(self._error))
+        self._queue.put(bytes(data))
+        return len(data)
+
+    def end_member(self):
+        """Completes the current gzip member/zstd frame; the next write starts a new one"""
+        self._queue.put(self._END_MEMBER)
+
+    def close(self):
+        """Flushes everything to fileobj and closes it; raises IOError if compression failed"""
+        if self._closed:
+            return
+        self._closed = True
+        self._queue.put(None)
+        self._thread.join()
+        self._fileobj.close()
+        if self._error is not None:
+            raise IOError('Compression failed: {!r}'.format(self._error))
+
+class OutputSink(DebugableObject):
+    """The destination for the results of a single NXQL Query across all Engines.
+    This is an Abstract Base Class; use OutputSink.create() to get the sink
+    matching the query's output_format and output_mode.
+    All OutputSinks have the following Properties:
+
+    Attributes:
+        fname: The output file name (available once open() has been called)
+        rows: The number of rows written so far
+        accepts_encoded: True if the sink can save batches already encoded by
+            result_encoding.encode_csv_batch (see write_encoded())
+    """
+
+    __metaclass__ = ABCMeta
+
+    @classmethod
+    def create(cls, logger, config, query):
+        if query.output_format == 'parquet':
+            return ParquetOutputSink(logger, config, query)
+        if query.output_format == 'sqlite':
+            return SqliteOutputSink(logger, config, query)
+        if query.output_mode == 'sharded':
+            return ShardedCsvOutputSink(logger, config, query)
+        if query.output_mode == 'delta':
+            return DeltaCsvOutputSink(logger, config, query)
+        return CsvOutputSink(logger, config, query)
+
+    def __init__(self, logger, config, query):
+        self._logger = logger
+        self._config = config
+        self._query = query
+        self._fname = None
+        self._rows = 0
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return '{}(query={!r}, fname={!r})'.format(
+            self.__class__.__name__, self._query.name, self._fname)
+
+    @property
+    def fname(self):
+        return self._fname
+
+    @property
+    def rows(self):
+        return self._rows
+
+    @abstractmethod
+    def open(self):
+        """Creates the output. Returns True if successful."""
+        pass
+
+    @abstractmethod
+    def write(self, engine, objects):
+        """Saves the objects retrieved from engine. May be called from several
+        threads at once. Returns True if successful."""
+        pass
+
+    accepts_encoded = False
+
+    def write_encoded(self, engine, raw, batch):
+        """Saves the raw JSON results retrieved from engine, already encoded as
+        batch by result_encoding.encode_csv_batch. Returns True if successful."""
+        return self.write(engine, decode_json(raw))
+
+    def fail(self, engine, reason):
+        """Records that no results could be retrieved from engine."""
+        pass
+
+    def abort(self):
+        """Releases the output without completing it, when the run stops
+        before the query is run."""
+        pass
+
+    @abstractmethod
+    def close(self):
+        """Completes the output once all Engines are done. Returns True if successful."""
+        pass
+
+class CsvOutputSink(OutputSink):
+    """Appends the results of every Engine to a single CSV file, in the order
+    the Engines complete. When the query is compressed, the rows are formatted
+    by the calling thread and compressed by a BackgroundCompressor.
+    """
+
+    accepts_encoded = True
+
+    def open(self):
+        func_name = self.__class__.__name__ + '.' + inspect.currentframe().f_code.co_name
+        self._field_names = None
+        self._stream = None
+        self._encoding = locale.getpreferredencoding(False)
+        # Checked before creating the file, so that no empty output is left behind
+        if not compression_available(self._query.compression):
+            self._logger.error('{0} - compression "zstd" requires the zstandard module, which is not installed.'.format(func_name))
+            self._fname = get_output_file_name(self._logger, self._config, self._query)
+            return False
+        self._fname, created = create_output_file(self._logger, self._config, self._query)
+        if created and self._query.compression != 'none':
+            self._stream = BackgroundCompressor(open(self._fname, 'wb'), self._query.compression)
+        return created
+
+    def write(self, engine, objects):
+        func_name = self.__class__.__name__ + '.' + inspect.currentframe().f_code.co_name
+        if len(objects) == 0:
+            return True
+        # Only one Engine may append to the file at a time
+        with self._lock:
+            need_headers = self._field_names is None
+            if need_headers:
+                self._field_names = objects[0].keys()
+            if self._stream is None:
+                written_ok = write_to_output_file(self._logger, self._config, self._query,
+                    self._fname, objects, self._field_names, need_headers)
+            else:
+                start_time = time.time()
+                try:
+                    self._stream.write(format_csv_rows(objects, self._field_names,
+                        self._query.delimiter, need_headers).encode(self._encoding))
+                    written_ok = True
+                except IOError as io_err:
+                    self._logger.error('{0} - {1}'.format(func_name, io_err))
+                    written_ok = False
+                if self._config.verbose:
+                    self._logger.info('{} - Queued {} result rows for compression in {}'.format(
+                        func_name, len(objects), timer(start_time, time.time())))
+            if written_ok:
+                self._rows += len(objects)
+        return written_ok
+
+    def write_encoded(self, engine, raw, batch):
+        func_name = self.__class__.__name__ + '.' + inspect.currentframe().f_code.co_name
+        if batch['rows'] == 0:
+            return True
+        start_time = time.time()
+        # Only one Engine may append to the file at a time
+        with self._lock:
+            need_headers = self._field_names is None
+            if need_headers:
+                self._field_names = batch['field_names']
+            if list(self._field_names) == batch['field_names']:
+                data = (batch['header'] if need_headers else b'') + batch['body']
+            else:
+                # This Engine returned the fields in another order than the first one
+                data = format_csv_rows(decode_json(raw), self._field_names,
+                    self._query.delimiter, False).encode(self._encoding)
+            try:
+                if self._stream is None:
+                    with open(self._fname, 'ab') as write_obj:
+                        write_obj.write(data)
+                else:
+                    self._stream.write(data)
+            except IOError as io_err:
+                self._logger.error('{0} - I/O error writing "{1}": {2}'.format(func_name, self._fname, io_err))
+                return False
+            self._rows += batch['rows']
+        if self._config.verbose:
+            self._logger.info('{} - Wrote {} encoded result rows in {}'.format(
+                func_name, batch['rows'], timer(start_time, time.time())))
+        return True
+
+    def close(self):
+        func_name = self.__class__.__name__ + '.' + inspect.currentframe().f_code.co_name
+        if self._stream is not None:
+            try:
+                self._stream.close()
+            except IOError as io_err:
+                self._logger.error('{0} - Unable to complete "{1}": {2}'.format(func_name, self._fname, io_err))
+                return False
+        return True
+
+    def abort(self):
+        if self._stream is not None:
+            try:
+                self._stream.close()
+            except IOError:
+                pass
+
+class ShardedCsvOutputSink(OutputSink):
+    """Writes the results of each Engine to its own shard file, in parallel,
+    then assembles the shards into the output file with kernel-side copies.
+    The shards are kept in a "<output file>.shards" folder next to the output
+    file, and are described (engine, status, rows, bytes, sha256) in a
+    "<output file>.manifest.json" file.
+    When the query is compressed, each shard holds its header and its rows in
+    two separate gzip members/zstd frames, so the shards can still be
+    assembled without decompressing them.
+
+    Attributes:
+        shard_path: The folder holding the shard files
+        manifest_path: The manifest file name
+    """
+
+    accepts_encoded = True
+
+    def __init__(self, logger, config, query):
+        super(ShardedCsvOutputSink, self).__init__(logger, config, query)
+        self._field_names = None
+        self._shards = {}
+        self._encoding = locale.getpreferredencoding(False)
+
+    @property
+    def shard_path(self):
+        return self._fname + '.shards'
+
+    @property
+    def manifest_path(self):
+        return self._fname + '.manifest.json'
+
+    def _shard_fname(self, engine):
+        extension = {'gzip': '.csv.gz', 'zstd': '.csv.zst'}.get(self._query.compression, '.csv')
+        return os.path.join(self.shard_path,
+            re.sub(r'[^\w.-]', '_', engine.name) + extension)
+
+    def open(self):
+        func_name = self.__class__.__name__ + '.' + inspect.currentframe().f_code.co_name
+        if not compression_available(self._query.compression):
+            self._logger.error('{0} - compression "zstd" requires the zstandard module, which is not installed.'.format(func_name))
+            self._fname = get_output_file_name(self._logger, self._config, self._query)
+            return False
+        self._fname, created = create_output_file(self._logger, self._config, self._query)
+        if not created:
+            return False
+        try:
+            if not os.path.exists(self.shard_path):
+                os.makedirs(self.shard_path)
+        except OSError as e:
+            self._logger.error('{0} - Unable to create shard folder "{1}": {2}'.format(func_name, self.shard_path, e))
+            return False
+        return True
+
+    def _save_shard(self, engine, rows, header, body):
+        """Writes (compressing if needed) the encoded header and rows of engine to its shard"""
+        func_name = self.__class__.__name__ + '.' + inspect.currentframe().f_code.co_name
+        shard = {
+            'engine': engine.name,
+            'hostname': engine.hostname_fqdn,
+            'file': None,
+            'status': 'empty',
+            'rows': rows,
+            'bytes': 0,
+            'header_bytes': 0,
+            'sha256': None}
+        if rows > 0:
+            start_time = time.time()
+            if self._query.compression != 'none':
+                header = compress_member(header, self._query.compression)
+                body = compress_member(body, self._query.compression)
+            checksum = hashlib.sha256(header)
+            checksum.update(body)
+            shard_fname = self._shard_fname(engine)
+            # Write to a temporary name so an interrupted write never looks complete
+            try:
+                with open(shard_fname + '.part', 'wb') as f:
+                    f.write(header)
+                    f.write(body)
+                os.replace(shard_fname + '.part', shard_fname)
+            except (IOError, OSError) as e:
+                self._logger.error('{0} - Unable to write shard "{1}": {2}'.format(func_name, shard_fname, e))
+                self.fail(engine, str(e))
+                return False
+            shard.update({
+                'file': os.path.basename(shard_fname),
+                'status': 'ok',
+                'bytes': len(header) + len(body),
+                'header_bytes': len(header),
+                'sha256': checksum.hexdigest()})
+            if self._config.verbose:
+                self._logger.info('{} - Wrote {} result rows to "{}" in {}'.format(
+                    func_name, rows, shard_fname, timer(start_time, time.time())))
+        with self._lock:
+            self._shards[engine.name] = shard
+        return True
+
+    def _shard_field_names(self, field_names):
+        """Returns the field names shared by all shards: those of the first Engine to return rows"""
+        with self._lock:
+            if self._field_names is None:
+                self._field_names = list(field_names)
+            return self._field_names
+
+    def write(self, engine, objects):
+        if len(objects) == 0:
+            return self._save_shard(engine, 0, b'', b'')
+        field_names = self._shard_field_names(objects[0].keys())
+        header = format_csv_rows([], field_names, self._query.delimiter, True).encode(self._encoding)
+        body = format_csv_rows(objects, field_names, self._query.delimiter, False).encode(self._encoding)
+        return self._save_shard(engine, len(objects), header, body)
+
+    def write_encoded(self, engine, raw, batch):
+        if batch['rows'] == 0:
+            return self._save_shard(engine, 0, b'', b'')
+        field_names = self._shard_field_names(batch['field_names'])
+        if field_names != batch['field_names']:
+            # This Engine returned the fields in another order than the first one
+            return self.write(engine, decode_json(raw))
+        return self._save_shard(engine, batch['rows'], batch['header'], batch['body'])
+
+    def fail(self, engine, reason):
+        with self._lock:
+            self._shards[engine.name] = {
+                'engine': engine.name,
+                'hostname': engine.hostname_fqdn,
+                'file': None,
+                'status': 'failed',
+                'error': reason,
+                'rows': 0,
+                'bytes': 0,
+                'header_bytes': 0,
+                'sha256': None}
+
+    def close(self):
+        func_name = self.__class__.__name__ + '.' + inspect.currentframe().f_code.co_name
+        start_time = time.time()
+        shards = [self._shards[name] for name in sorted(self._shards)]
+        # Assemble the shards in a temporary file, skipping the header of all but the first one
+        try:
+            with open(self._fname + '.part', 'wb') as dst:
+                first = True
+                for shard in shards:
+                    if shard['status'] != 'ok':
+                        continue
+                    offset = 0 if first else shard['header_bytes']
+                    with open(os.path.join(self.shard_path, shard['file']), 'rb') as src:
+                        copy_file_range(src.fileno(), dst.fileno(), offset, shard['bytes'] - offset)
+                    first = False
+            os.replace(self._fname + '.part', self._fname)
+        except (IOError, OSError) as e:
+            self._logger.error('{0} - Unable to assemble "{1}" from its shards: {2}'.format(func_name, self._fname, e))
+            return False
+        self._rows = sum(shard['rows'] for shard in shards if shard['status'] == 'ok')
+        manifest = {
+            'query': self._query.name,
+            'rundate': self._config.rundate,
+            'output_file': os.path.basename(self._fname),
+            'field_names': self._field_names,
+            'rows': self._rows,
+            'shards': shards}
+        try:
+            with open(self.manifest_path + '.part', 'w') as f:
+                json.dump(manifest, f, indent=2)
+            os.replace(self.manifest_path + '.part', self.manifest_path)
+        except (IOError, OSError) as e:
+            self._logger.error('{0} - Unable to write manifest "{1}": {2}'.format(func_name, self.manifest_path, e))
+            return False
+        if self._config.verbose:
+            self._logger.info('{} - Assembled {} shards ({} rows) into "{}" in {}'.format(
+                func_name, len([s for s in shards if s['status'] == 'ok']), self._rows,
+                self._fname, timer(start_time, time.time())))
+        return True
+
+class DeltaCsvOutputSink(OutputSink):
+    """Writes only the rows that were added, changed or removed since the
+    previous run to the CSV output file, with a leading "change" column.
+    Rows are identified by the query's delta_key fields, and compared by a
+    hash of their content with the DeltaIndex of the previous run (a
+    ".<query>.delta.idx" file next to the output file), which is replaced
+    by the rows of this run once the output is complete.
+    Removed rows only hold the delta_key fields. The rows of an Engine that
+    failed are kept as they were, not reported as removed. No output file is
+    written when nothing changed.
+
+    Attributes:
+        index_path: The index file name
+        changes: The number of rows by change ("added", "changed", "removed")
+    """
+
+    def __init__(self, logger, config, query):
+        super(DeltaCsvOutputSink, self).__init__(logger, config, query)
+        self._index = None
+        self._current = {}
+        self._changes = []
+        self._counts = {'added': 0, 'changed': 0, 'removed': 0}
+        self._failed = set()
+        self._duplicates = 0
+        self._field_names = None
+        self._encoding = locale.getpreferredencoding(False)
+
+    @property
+    def index_path(self):
+        return os.path.join(os.path.dirname(self._fname),
+            '.{}.delta.idx'.format(re.sub(r'[^\w.-]', '_', self._query.name)))
+
+    @property
+    def changes(self):
+        return self._counts
+
+    def open(self):
+        func_name = self.__class__.__name__ + '.' + inspect.currentframe().f_code.co_name
+        self._fname = get_output_file_name(self._logger, self._config, self._query)
+        if not compression_available(self._query.compression):
+            self._logger.error('{0} - compression "zstd" requires the zstandard module, which is not installed.'.format(func_name))
+            return False
+        self._index = DeltaIndex(self._logger, self.index_path)
+        if not self._index.open() and self._config.verbose:
+            self._logger.info('{0} - No previous run of Query "{1}", all rows are added.'.format(func_name, self._query.name))
+        return True
+
+    def write(self, engine, objects):
+        if len(objects) == 0:
+            return True
+        key_fields = self._query.delta_key
+        # Hash outside of the lock, so that several Engines can be hashed at once
+        hashed = []
+        for obj in objects:
+            key = [obj.get(field) for field in key_fields]
+            hashed.append((row_hash(key), row_hash(obj), key, obj))
+        with self._lock:
+            if self._field_names is None:
+                self._field_names = list(objects[0].keys())
+            for key_hash, content_hash, key, obj in hashed:
+                if key_hash in self._current:
+                    self._duplicates += 1
+                    continue
+                self._current[key_hash] = (content_hash, [engine.name] + key)
+                previous = self._index.lookup(key_hash)
+                if previous == content_hash:
+                    continue
+                change = 'added' if previous is None else 'changed'
+                self._changes.append((change, obj))
+                self._counts[change] += 1
+            self._rows += len(objects)
+        return True
+
+    def fail(self, engine, reason):
+        with self._lock:
+            self._failed.add(engine.name)
+
+    def close(self):
+        func_name = self.__class__.__name__ + '.' + inspect.currentframe().f_code.co_name
+        start_time = time.time()
+        key_fields = self._query.delta_key
+        for key_hash, content_hash, entry in self._index.rows():
+            if key_hash in self._current:
+                continue
+            if entry[0] in self._failed:
+                self._current[key_hash] = (content_hash, entry)
+            else:
+                self._changes.append(('removed', dict(zip(key_fields, entry[1:]))))
+                self._counts['removed'] += 1
+        self._index.close()
+        if self._duplicates:
+            self._logger.warning('{0} - {1} rows of Query "{2}" have the same delta_key ({3}) as an earlier row, and were ignored.'.format(
+                func_name, self._duplicates, self._query.name, ', '.join(key_fields)))
+        try:
+            if self._changes:
+                rows = []
+                for change, obj in self._changes:
+                    row = {'change': change}
+                    row.update(obj)
+                    rows.append(row)
+                data = format_csv_rows(rows, ['change'] + (self._field_names or key_fields),
+                    self._query.delimiter, True).encode(self._encoding)
+                if self._query.compression != 'none':
+                    data = compress_member(data, self._query.compression)
+                with open(self._fname + '.part', 'wb') as f:
+                    f.write(data)
+                os.replace(self._fname + '.part', self._fname)
+            DeltaIndex.write(self.index_path, self._current)
+        except (IOError, OSError) as e:
+            self._logger.error('{0} - Unable to write the delta of Query "{1}": {2}'.format(func_name, self._query.name, e))
+            return False
+        if self._config.verbose:
+            self._logger.info('{} - {} added, {} changed and {} removed rows{} for Query "{}" in {}'.format(
+                func_name, self._counts['added'], self._counts['changed'], self._counts['removed'],
+                ' written to "{}"'.format(self._fname) if self._changes else '', self._query.name,
+                timer(start_time, time.time())))
+        return True
+
+    def abort(self):
+        # The index of the previous run is kept, so that the next run is compared with it
+        if self._index is not None:
+            self._index.close()
+
+class ParquetOutputSink(OutputSink):
+    """Writes the results of every Engine to a single Parquet file, one row
+    group per Engine batch, in the order the Engines complete.
+    Requires the optional pyarrow module.
+
+    The schema is built from the NXQL field list of the query (falling back on
+    the fields of the first batch if they do not match), with the column types
+    inferred from the values of the first batch: integer, floating point,
+    boolean, or string. Columns that have no values in the first batch, and
+    all columns when no Engine returns rows, are written as strings.
+    When a later batch has values a column's type can not hold, the column
+    is widened (integer to floating point, anything else to string) and the
+    rows already written are rewritten with the widened schema, so that no
+    value is truncated and no batch is dropped.
+    """
+
+    def __init__(self, logger, config, query):
+        super(ParquetOutputSink, self).__init__(logger, config, query)
+        self._schema = None
+        self._writer = None
+
+    def open(self):
+        func_name = self.__class__.__name__ + '.' + inspect.currentframe().f_code.co_name
+        if pyarrow is None:
+            self._logger.error('{0} - output_format "parquet" requires the pyarrow module, which is not installed.'.format(func_name))
+            self._fname = self._query.filename
+            return False
+        self._fname, created = create_output_file(self._logger, self._config, self._query)
+        return created
+
+    @staticmethod
+    def _infer_type(values):
+        """Returns the pyarrow type best matching the (non-null) values"""
+        values = [v for v in values if v is not None]
+        if len(values) == 0:
+            return pyarrow.string()
+        if all(isinstance(v, bool) for v in values):
+            return pyarrow.bool_()
+        if all(isinstance(v, int) and not isinstance(v, bool) for v in values):
+            return pyarrow.int64()
+        if all(isinstance(v, (int, float)) and not isinstance(v, bool) for v in values):
+            return pyarrow.float64()
+        return pyarrow.string()
+
+    @classmethod
+    def _widen_type(cls, current, values):
+        """Returns the type of a column holding both values of the current type
+        and the values: integer widens to floating point, anything else to string"""
+        if all(v is None for v in values):
+            return current
+        inferred = cls._infer_type(values)
+        if inferred == current or current == pyarrow.string():
+            return current
+        if {inferred, current} == {pyarrow.int64(), pyarrow.float64()}:
+            return pyarrow.float64()
+        return pyarrow.string()
+
+    def _build_schema(self, objects):
+        """Builds the schema from the NXQL field list and the first batch"""
+        names = self._query.fields
+        if len(objects) > 0 and set(names) != set(objects[0].keys()):
+            names = list(objects[0].keys())
+        return pyarrow.schema([
+            pyarrow.field(name, self._infer_type([obj.get(name) for obj in objects]))
+            for name in names])
+
+    def _to_table(self, objects):
+        """Converts a batch of dict objects to a table matching the schema"""
+        columns = []
+        for field in self._schema:
+            values = [obj.get(field.name) for obj in objects]
+            if field.type == pyarrow.string():
+                values = [v if v is None or isinstance(v, str) else str(v) for v in values]
+            columns.append(pyarrow.array(values, type=field.type))
+        return pyarrow.Table.from_arrays(columns, schema=self._schema)
+
+    def _widen_schema(self, objects):
+        """Rewrites the rows already written if the batch needs a wider schema"""
+        func_name = self.__class__.__name__ + '.' + inspect.currentframe().f_code.co_name
+        fields = []
+        for field in self._schema:
+            widened = self._widen_type(field.type, [obj.get(field.name) for obj in objects])
+            if widened != field.type:
+                self._logger.warning('{0} - Widening column "{1}" of Query "{2}" from {3} to {4}, and rewriting "{5}".'.format(
+                    func_name, field.name, self._query.name, field.type, widened, self._fname))
+            fields.append(pyarrow.field(field.name, widened))
+        schema = pyarrow.schema(fields)
+        if schema.equals(self._schema):
+            return
+        self._writer.close()
+        # Converted back through Python values, so that the widened string
+        # columns hold the same text as the values written after them
+        written = pyarrow.parquet.read_table(self._fname).to_pylist()
+        self._schema = schema
+        self._writer = self._new_writer()
+        if len(written) > 0:
+            self._writer.write_table(self._to_table(written))
+
+    def _new_writer(self):
+        """Opens the Parquet writer; gzip and zstd compression select the Parquet codec"""
+        if self._query.compression == 'none':
+            return pyarrow.parquet.ParquetWriter(self._fname, self._schema)
+        return pyarrow.parquet.ParquetWriter(self._fname, self._schema,
+            compression=self._query.compression)
+
+    def write(self, engine, objects):
+        func_name = self.__class__.__name__ + '.' + inspect.currentframe().f_code.co_name
+        if len(objects) == 0:
+            return True
+        start_time = time.time()
+        with self._lock:
+            try:
+                if self._writer is None:
+                    self._schema = self._build_schema(objects)
+                    self._writer = self._new_writer()
+                else:
+                    self._widen_schema(objects)
+                self._writer.write_table(self._to_table(objects))
+            except (pyarrow.ArrowException, IOError, OSError) as exc:
+                self._logger.error('{0} - Unable to write the results of Engine "{1}" to "{2}": {3!r}'.format(
+                    func_name, engine.name, self._fname, exc))
+                return False
+            self._rows += len(objects)
+        if self._config.verbose:
+            self._logger.info('{} - Wrote {} result rows in {}'.format(
+                func_name, len(objects), timer(start_time, time.time())))
+        return True
+
+    def close(self):
+        func_name = self.__class__.__name__ + '.' + inspect.currentframe().f_code.co_name
+        try:
+            # Without any rows, still produce a valid file with the query's fields
+            if self._writer is None:
+                self._schema = self._build_schema([])
+                self._writer = self._new_writer()
+            self._writer.close()
+        except (pyarrow.ArrowException, IOError, OSError) as exc:
+            self._logger.error('{0} - Unable to complete "{1}": {2!r}'.format(func_name, self._fname, exc))
+            return False
+        return True
+
+    def abort(self):
+        if self._writer is not None:
+            try:
+                self._writer.close()
+            except (pyarrow.ArrowException, IOError, OSError):
+                pass
+
+class SqliteOutputSink(OutputSink):
+    """Loads the results of every Engine into a table of an SQLite database,
+    tagging each row with the engine_name and rundate columns.
+    The database (the output file) is appended to by every run, so that
+    historical lookups are a local, indexed query.
+
+    The table is named after the query, with a suffix taken from the rundate
+    when the query is partitioned (e.g. test_202010 for a monthly partition);
+    partitioned tables are combined in a <query>_all view. Rows already
+    loaded with the same rundate (by a run that is being resumed) are
+    replaced. Engine batches are
+    bulk inserted with executemany in a single transaction that is committed
+    once all Engines are done, and the configured indexes are built after
+    the rows are loaded.
+
+    Attributes:
+        table: The name of the table the rows are loaded into
+    """
+
+    _PARTITION_LENGTHS = {'year': 4, 'month': 6, 'day': 8}
+
+    def __init__(self, logger, config, query):
+        super(SqliteOutputSink, self).__init__(logger, config, query)
+        self._connection = None
+        self._columns = None
+        self._insert = None
+
+    @staticmethod
+    def _quote(identifier):
+        return '"' + identifier.replace('"', '""') + '"'
+
+    @staticmethod
+    def _value(value):
+        """Converts values SQLite can not store (e.g. nested objects) to JSON text"""
+        if isinstance(value, (dict, list)):
+            return json.dumps(value)
+        return value
+
+    @property
+    def table(self):
+        partition = self._query.sqlite_partition
+        if partition == 'none':
+            return self._query.name
+        if partition == 'run':
+            return '{}_{}'.format(self._query.name, self._config.rundate.replace('-', '_'))
+        return '{}_{}'.format(self._query.name, self._config.rundate[:self._PARTITION_LENGTHS[partition]])
+
+    def open(self):
+        func_name = self.__class__.__name__ + '.' + inspect.currentframe().f_code.co_name
+        self._fname = get_output_file_name(self._logger, self._config, self._query)
+        try:
+            # Worker threads share the connection; every use is serialized by self._lock
+            self._connection = sqlite3.connect(self._fname, check_same_thread=False)
+            self._connection.execute('PRAGMA synchronous = NORMAL')
+            self._connection.execute('BEGIN')
+        except sqlite3.Error as exc:
+            self._logger.error('{0} - Unable to open database "{1}": {2!r}'.format(func_name, self._fname, exc))
+            return False
+        return True
+
+    def _prepare_table(self, objects):
+        """Creates the table (or adds the new columns to it) from the first batch.
+        SQLite column names are case insensitive, so fields differing only by
+        case from an earlier field are not loaded."""
+        func_name = self.__class__.__name__ + '.' + inspect.currentframe().f_code.co_name
+        table = self._quote(self.table)
+        columns = []
+        for column in objects[0].keys():
+            if column.lower() in [c.lower() for c in columns + ['engine_name', 'rundate']]:
+                self._logger.warning('{0} - Field "{1}" of Query "{2}" duplicates another column name, and will not be loaded.'.format(
+                    func_name, column, self._query.name))
+            else:
+                columns.append(column)
+        self._connection.execute('CREATE TABLE IF NOT EXISTS {} (engine_name, rundate)'.format(table))
+        existing = [row[1].lower() for row in self._connection.execute('PRAGMA table_info({})'.format(table))]
+        for column in columns:
+            if column.lower() not in existing:
+                self._connection.execute('ALTER TABLE {} ADD COLUMN {}'.format(table, self._quote(column)))
+        self._connection.execute('DELETE FROM {} WHERE rundate = ?'.format(table), (self._config.rundate,))
+        self._insert = 'INSERT INTO {} (engine_name, rundate, {}) VALUES ({})'.format(
+            table, ', '.join(self._quote(c) for c in columns),
+            ', '.join(['?'] * (len(columns) + 2)))
+        self._columns = columns
+
+    def write(self, engine, objects):
+        func_name = self.__class__.__name__ + '.' + inspect.currentframe().f_code.co_name
+        if len(objects) == 0:
+            return True
+        start_time = time.time()
+        rundate = self._config.rundate
+        with self._lock:
+            try:
+                if self._columns is None:
+                    self._prepare_table(objects)
+                self._connection.executemany(self._insert,
+                    [(engine.name, rundate) + tuple(self._value(obj.get(c)) for c in self._columns)
+                     for obj in objects])
+            except sqlite3.Error as exc:
+                self._logger.error('{0} - Unable to insert the results of Engine "{1}" into "{2}": {3!r}'.format(
+                    func_name, engine.name, self._fname, exc))
+                return False
+            self._rows += len(objects)
+        if self._config.verbose:
+            self._logger.info('{} - Inserted {} result rows into table "{}" in {}'.format(
+                func_name, len(objects), self.table, timer(start_time, time.time())))
+        return True
+
+    def _create_view(self):
+        """(Re)creates the <query>_all view over all of the query's partitions.
+        The partitions gain columns as the query changes, so the view has the
+        columns of all of them, in the order they first appear; a partition
+        without a column selects NULL for it."""
+        view = self._query.name + '_all'
+        prefix = self._query.name + '_'
+        tables = [row[0] for row in self._connection.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'table' ORDER BY name")
+            if row[0].startswith(prefix) and row[0][len(prefix):].replace('_', '').isdigit()]
+        table_columns = {}
+        columns = []
+        for table in tables:
+            names = [row[1] for row in self._connection.execute('PRAGMA table_info({})'.format(self._quote(table)))]
+            # SQLite column names are case insensitive
+            table_columns[table] = [name.lower() for name in names]
+            for name in names:
+                if name.lower() not in [c.lower() for c in columns]:
+                    columns.append(name)
+        selects = []
+        for table in tables:
+            selects.append('SELECT {} FROM {}'.format(', '.join(
+                self._quote(c) if c.lower() in table_columns[table] else 'NULL AS {}'.format(self._quote(c))
+                for c in columns), self._quote(table)))
+        self._connection.execute('DROP VIEW IF EXISTS {}'.format(self._quote(view)))
+        self._connection.execute('CREATE VIEW {} AS {}'.format(self._quote(view), ' UNION ALL '.join(selects)))
+
+    def close(self):
+        func_name = self.__class__.__name__ + '.' + inspect.currentframe().f_code.co_name
+        start_time = time.time()
+        with self._lock:
+            try:
+                if self._columns is not None:
+                    for columns in self._query.sqlite_indexes:
+                        index = re.sub(r'\W', '_', 'ix_{}_{}'.format(self.table, '_'.join(columns)))
+                        self._connection.execute('CREATE INDEX IF NOT EXISTS {} ON {} ({})'.format(
+                            self._quote(index), self._quote(self.table),
+                            ', '.join(self._quote(c) for c in columns)))
+                    if self._query.sqlite_partition != 'none':
+                        self._create_view()
+                self._connection.commit()
+            except sqlite3.Error as exc:
+                self._logger.error('{0} - Unable to complete loading "{1}": {2!r}'.format(func_name, self._fname, exc))
+                self._connection.rollback()
+                return False
+            finally:
+                self._connection.close()
+        if self._config.verbose:
+            self._logger.info('{} - Committed {} rows to table "{}" in {}'.format(
+                func_name, self._rows, self.table, timer(start_time, time.time())))
+        return True
+
+    def abort(self):
+        # Nothing of this run is loaded: the rows of the previous runs are kept as they were
+        with self._lock:
+            try:
+                self._connection.rollback()
+            except sqlite3.Error:
+                pass
+            finally:
+                self._connection.close()
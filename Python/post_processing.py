@@ -0,0 +1,408 @@
+"""Client-side post-processing of query results for multi_engine_query"""
+
+# Native modules
+import ast
+import inspect
+import logging
+import operator
+import re
+import sys
+
+# Optional 3rd-party modules
+try:
+    import pandas
+except ImportError:
+    pandas = None
+
+# Create the logger
+logger = logging.getLogger('logger')
+
+_BINARY_OPERATORS = {
+    ast.Add: operator.add,
+    ast.Sub: operator.sub,
+    ast.Mult: operator.mul,
+    ast.Div: operator.truediv,
+    ast.FloorDiv: operator.floordiv,
+    ast.Mod: operator.mod,
+    ast.Pow: operator.pow}
+_COMPARE_OPERATORS = {
+    ast.Eq: operator.eq,
+    ast.NotEq: operator.ne,
+    ast.Lt: operator.lt,
+    ast.LtE: operator.le,
+    ast.Gt: operator.gt,
+    ast.GtE: operator.ge}
+_FUNCTIONS = {
+    'abs': 1,
+    'round': 2,
+    'number': 1,
+    'str': 1,
+    'lower': 1,
+    'upper': 1,
+    'contains': 2}
+# Literal nodes: ast.Constant from Python 3.8, ast.Num, ast.Str and ast.NameConstant before
+if sys.version_info >= (3, 8):
+    _LITERAL_NODES = (ast.Constant,)
+else:
+    _LITERAL_NODES = (ast.Num, ast.Str, ast.NameConstant)
+
+# Evaluation errors of a row, which make the value of the expression None
+_ROW_ERRORS = (TypeError, ValueError, ZeroDivisionError, AttributeError, OverflowError)
+
+def _literal(node):
+    """Returns the value of a literal node"""
+    if hasattr(node, 'value'):
+        return node.value
+    return node.n if hasattr(node, 'n') else node.s
+
+class Expression(object):
+    """A post-processing expression, such as size / 1024 or
+    `#OS Name` == "Windows 10" and cpu > 2.
+
+    Expressions use the Python syntax, limited to field names (between
+    backquotes if they are not identifiers), numbers, strings, arithmetic
+    (+ - * / // % **), comparisons (including "in" a list of values), "and",
+    "or", "not", and the functions abs(x), round(x, digits), number(x),
+    str(x), lower(x), upper(x) and contains(x, text).
+
+    Attributes:
+        text: The expression as written
+        fields: The field names the expression uses
+    """
+
+    def __init__(self, text):
+        """Parses text. Raises ValueError if it is not a valid expression."""
+        self._text = text
+        self._names = {}
+        # Backquoted field names become identifiers _f0, _f1...
+        def quote(match):
+            name = '_f{}'.format(len(self._names))
+            self._names[name] = match.group(1)
+            return name
+        source = re.sub(r'`([^`]*)`', quote, text.strip())
+        try:
+            self._tree = ast.parse(source, mode='eval').body
+        except SyntaxError as e:
+            raise ValueError('invalid expression "{}": {}'.format(text, e.msg))
+        self._check(self._tree)
+
+    def __repr__(self):
+        return 'Expression(text={!r})'.format(self._text)
+
+    @property
+    def text(self):
+        return self._text
+
+    @property
+    def fields(self):
+        return [self._names.get(node.id, node.id) for node in ast.walk(self._tree) if isinstance(node, ast.Name)]
+
+    def _check(self, node):
+        """Raises ValueError if node uses anything but the supported syntax"""
+        if isinstance(node, _LITERAL_NODES) or isinstance(node, ast.Name):
+            return
+        if isinstance(node, ast.BinOp) and type(node.op) in _BINARY_OPERATORS:
+            children = [node.left, node.right]
+        elif isinstance(node, ast.UnaryOp) and isinstance(node.op, (ast.Not, ast.USub, ast.UAdd)):
+            children = [node.operand]
+        elif isinstance(node, ast.BoolOp):
+            children = node.values
+        elif isinstance(node, ast.Compare):
+            children = [node.left]
+            for op, comparator in zip(node.ops, node.comparators):
+                if isinstance(op, (ast.In, ast.NotIn)):
+                    if not isinstance(comparator, (ast.List, ast.Tuple)) or \
+                       not all(isinstance(e, _LITERAL_NODES) for e in comparator.elts):
+                        raise ValueError('"in" needs a list of values, in "{}"'.format(self._text))
+                elif type(op) in _COMPARE_OPERATORS:
+                    children.append(comparator)
+                else:
+                    raise ValueError('unsupported comparison in "{}"'.format(self._text))
+        elif isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and node.func.id in _FUNCTIONS \
+                and not node.keywords and 1 <= len(node.args) <= _FUNCTIONS[node.func.id]:
+            children = node.args
+        else:
+            raise ValueError('unsupported syntax "{}" in "{}"'.format(type(node).__name__, self._text))
+        for child in children:
+            self._check(child)
+
+    def evaluate(self, lookup, vectorized):
+        """ Evaluates the expression
+
+        Arguments:
+            lookup: function returning the value of a field name: the value
+                of a row, or a pandas Series of the values of a batch
+            vectorized: True if lookup returns pandas Series
+        Returns:
+            The value (or Series) of the expression
+        """
+        return self._evaluate(self._tree, lookup, vectorized)
+
+    def _evaluate(self, node, lookup, vectorized):
+        if isinstance(node, _LITERAL_NODES):
+            return _literal(node)
+        if isinstance(node, ast.Name):
+            return lookup(self._names.get(node.id, node.id))
+        if isinstance(node, ast.BinOp):
+            left = self._evaluate(node.left, lookup, vectorized)
+            right = self._evaluate(node.right, lookup, vectorized)
+            if not vectorized:
+                # As with pandas, arithmetic that fails (e.g. on a missing value) gives a missing value
+                try:
+                    return _BINARY_OPERATORS[type(node.op)](left, right)
+                except _ROW_ERRORS:
+                    return None
+            result = _BINARY_OPERATORS[type(node.op)](left, right)
+            if vectorized and isinstance(node.op, (ast.Div, ast.FloorDiv, ast.Mod)) and isinstance(result, pandas.Series):
+                # As row by row (ZeroDivisionError), dividing by zero gives a missing value, not inf
+                if isinstance(right, pandas.Series):
+                    result = result.mask(self._boolean(right == 0))
+                elif right == 0:
+                    result = pandas.Series([None] * len(result), index=result.index, dtype=object)
+            return result
+        if isinstance(node, ast.UnaryOp):
+            operand = self._evaluate(node.operand, lookup, vectorized)
+            if isinstance(node.op, ast.Not):
+                return ~self._boolean(operand) if vectorized else not operand
+            if operand is None:
+                return None
+            return -operand if isinstance(node.op, ast.USub) else +operand
+        if isinstance(node, ast.BoolOp):
+            values = [self._evaluate(value, lookup, vectorized) for value in node.values]
+            if vectorized:
+                combine = operator.and_ if isinstance(node.op, ast.And) else operator.or_
+                result = self._boolean(values[0])
+                for value in values[1:]:
+                    result = combine(result, self._boolean(value))
+                return result
+            return all(values) if isinstance(node.op, ast.And) else any(values)
+        if isinstance(node, ast.Compare):
+            left = self._evaluate(node.left, lookup, vectorized)
+            result = True
+            for op, comparator in zip(node.ops, node.comparators):
+                if isinstance(op, (ast.In, ast.NotIn)):
+                    choices = [_literal(e) for e in comparator.elts]
+                    value = left.isin(choices) if vectorized else left in choices
+                    if isinstance(op, ast.NotIn):
+                        value = ~value if vectorized else not value
+                else:
+                    right = self._evaluate(comparator, lookup, vectorized)
+                    if vectorized:
+                        value = _COMPARE_OPERATORS[type(op)](left, right)
+                    else:
+                        # As with pandas, comparing a missing value (or values
+                        # that can not be compared) is False
+                        try:
+                            value = _COMPARE_OPERATORS[type(op)](left, right)
+                        except TypeError:
+                            value = False
+                    left = right
+                result = (result & self._boolean(value)) if vectorized else (result and value)
+            return result
+        # Functions
+        args = [self._evaluate(arg, lookup, vectorized) for arg in node.args]
+        if vectorized:
+            return self._call(node.func.id, args, vectorized)
+        try:
+            return self._call(node.func.id, args, vectorized)
+        except _ROW_ERRORS:
+            return None
+
+    @staticmethod
+    def _boolean(value):
+        """Returns a boolean Series, missing values being False"""
+        if isinstance(value, pandas.Series):
+            return value.fillna(False).astype(bool)
+        return bool(value)
+
+    @staticmethod
+    def _call(name, args, vectorized):
+        value = args[0]
+        series = vectorized and isinstance(value, pandas.Series)
+        if name == 'abs':
+            return abs(value)
+        if name == 'round':
+            digits = args[1] if len(args) > 1 else 0
+            return value.round(digits) if series else round(value, digits)
+        if name == 'number':
+            if series:
+                return pandas.to_numeric(value, errors='coerce')
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                return value
+            text = str(value).strip()
+            return int(text) if re.match(r'^[-+]?\d+$', text) else float(text)
+        if name == 'str':
+            if series:
+                return value.astype(str).where(value.notnull(), None)
+            return None if value is None else str(value)
+        if name == 'lower':
+            return value.str.lower() if series else value.lower()
+        if name == 'upper':
+            return value.str.upper() if series else value.upper()
+        # contains
+        return value.str.contains(str(args[1]), regex=False) if series else str(args[1]) in value
+
+def parse_derive(text):
+    """ Parses a list of derived fields, one "name = expression" per line
+        (names that are not identifiers between backquotes).
+
+    Arguments:
+        text: The derived fields
+    Returns:
+        list of (field name, Expression)
+    Raises:
+        ValueError: if a line is not a valid derived field
+    """
+    derived = []
+    for line in (text or '').splitlines():
+        if not line.strip():
+            continue
+        match = re.match(r'^\s*(`[^`]+`|[\w#]+)\s*=(?!=)(.*)$', line)
+        if not match:
+            raise ValueError('invalid derived field "{}", expected "name = expression"'.format(line.strip()))
+        derived.append((match.group(1).strip('`'), Expression(match.group(2))))
+    return derived
+
+class PostProcessor(object):
+    """Post-processes the results of a query, batch by batch (the results of
+    an Engine), before they are written: adds derived fields, filters the
+    rows, then keeps and orders the given fields.
+
+    With pandas installed, the expressions are evaluated on whole columns of
+    the batch; otherwise (or if a batch does not lend itself to it, e.g.
+    arithmetic on a column mixing numbers and strings), row by row, with the
+    same results: arithmetic or a function that fails on a row (e.g. on a
+    missing value, or a division by zero) gives a missing value (None in a
+    derived field), and comparing a missing value is False.
+
+    Attributes:
+        derive: list of (field name, Expression) to add to every row
+        row_filter: Optional Expression a row must match to be kept
+        columns: Optional list of the fields to keep, in order
+        vectorized: True if pandas is used
+    """
+
+    @classmethod
+    def from_query(cls, logger, query):
+        """Returns the PostProcessor of query, or None if it has no post-processing"""
+        if not (query.post_derive or query.post_filter or query.post_columns):
+            return None
+        return cls(logger, query.post_derive, query.post_filter, query.post_columns)
+
+    def __init__(self, logger, derive='', row_filter='', columns=None):
+        """Raises ValueError if an expression is invalid"""
+        self._logger = logger
+        self._derive = parse_derive(derive)
+        self._filter = Expression(row_filter) if (row_filter or '').strip() else None
+        self._columns = columns or None
+        self._vectorized = pandas is not None
+
+    def __repr__(self):
+        return 'PostProcessor(derive={!r}, row_filter={!r}, columns={!r}, vectorized={!r})'.format(
+            self._derive, self._filter, self._columns, self._vectorized)
+
+    @property
+    def derive(self):
+        return self._derive
+
+    @property
+    def row_filter(self):
+        return self._filter
+
+    @property
+    def columns(self):
+        return self._columns
+
+    @property
+    def vectorized(self):
+        return self._vectorized
+
+    def apply(self, objects):
+        """ Returns the post-processed rows
+
+        Arguments:
+            objects: list of dict objects (the results of an Engine)
+        Returns:
+            list of dict objects
+        """
+        func_name = self.__class__.__name__ + '.' + inspect.currentframe().f_code.co_name
+        if len(objects) == 0:
+            return objects
+        if self._vectorized and (self._derive or self._filter):
+            try:
+                return self._apply_vectorized(objects)
+            except Exception as exc:
+                self._logger.debug('{0} - Evaluating the batch row by row: {1!r}'.format(func_name, exc))
+        return self._apply_rows(objects)
+
+    def _project(self, row):
+        if self._columns is None:
+            return row
+        return dict((column, row.get(column)) for column in self._columns)
+
+    @staticmethod
+    def _column(values):
+        """Returns the Series of the values of a field. Integer, floating point
+        and boolean fields get a nullable dtype, so that a missing value does
+        not turn the integers of a field into floats (1.0 instead of 1)."""
+        present = [v for v in values if v is not None]
+        if present and all(isinstance(v, bool) for v in present):
+            dtype = 'boolean'
+        elif present and all(isinstance(v, int) and not isinstance(v, bool) for v in present):
+            dtype = 'Int64'
+        elif present and all(isinstance(v, float) for v in present):
+            dtype = 'Float64'
+        else:
+            dtype = object
+        return pandas.Series(values, dtype=dtype)
+
+    def _apply_vectorized(self, objects):
+        names = []
+        for obj in objects:
+            names.extend(name for name in obj if name not in names)
+        frame = pandas.DataFrame(dict((name, self._column([obj.get(name) for obj in objects])) for name in names))
+        missing = pandas.Series([None] * len(frame), index=frame.index, dtype=object)
+        lookup = lambda name: frame[name] if name in frame.columns else missing
+        derived = []
+        for name, expression in self._derive:
+            value = expression.evaluate(lookup, True)
+            if not isinstance(value, pandas.Series):
+                value = pandas.Series([value] * len(frame), index=frame.index, dtype=object)
+            frame[name] = value
+            # Back to Python values (e.g. numpy.int64 to int), missing values (NaN) to None
+            derived.append((name, value.astype(object).where(value.notnull(), None).tolist()))
+        if self._filter is not None:
+            keep = Expression._boolean(self._filter.evaluate(lookup, True))
+            if not isinstance(keep, pandas.Series):
+                keep = [keep] * len(frame)
+            else:
+                keep = keep.tolist()
+        else:
+            keep = [True] * len(frame)
+        rows = []
+        for position, obj in enumerate(objects):
+            if not keep[position]:
+                continue
+            row = dict(obj)
+            for name, values in derived:
+                row[name] = values[position]
+            rows.append(self._project(row))
+        return rows
+
+    def _apply_rows(self, objects):
+        rows = []
+        for obj in objects:
+            row = dict(obj)
+            for name, expression in self._derive:
+                try:
+                    row[name] = expression.evaluate(row.get, False)
+                except _ROW_ERRORS:
+                    row[name] = None
+            if self._filter is not None:
+                try:
+                    if not self._filter.evaluate(row.get, False):
+                        continue
+                except _ROW_ERRORS:
+                    continue
+            rows.append(self._project(row))
+        return rows
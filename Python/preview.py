@@ -0,0 +1,98 @@
+"""Preview of the queries of multi_engine_query on a sample of the Engines"""
+
+# Native modules
+import logging
+
+# Create the logger
+logger = logging.getLogger('logger')
+
+# Days of run statistics used to sample the Engines and to estimate a full run
+HISTORY_DAYS = 30
+
+def sample_engines(engines, latencies, sizes, count):
+    """ Picks a small sample of the Engines, representative of a full run and
+        quick to answer: the Engine returning the most rows, then the fastest
+        Engines (Engines without history come last, in their order).
+
+    Arguments:
+        engines: list of reachable EngineAppliance
+        latencies: dict of hostname: usual seconds the Engine takes to answer
+            a query (None or missing if unknown)
+        sizes: dict of hostname: usual rows the Engine returns (see
+            RunStatsStore.engine_rows)
+        count: The number of Engines to pick
+    Returns:
+        list of (EngineAppliance, reason it was picked)
+    """
+    sample = []
+    remaining = list(engines)
+    sized = [e for e in remaining if sizes.get(e.hostname_fqdn) is not None]
+    if sized:
+        largest = max(sized, key=lambda e: sizes[e.hostname_fqdn])
+        sample.append((largest, 'largest, {:.0f} rows'.format(sizes[largest.hostname_fqdn])))
+        remaining.remove(largest)
+    timed = sorted([e for e in remaining if latencies.get(e.hostname_fqdn) is not None],
+        key=lambda e: latencies[e.hostname_fqdn])
+    for engine in timed:
+        if len(sample) >= count:
+            break
+        sample.append((engine, 'fast, {:.2f} s'.format(latencies[engine.hostname_fqdn])))
+    for engine in remaining:
+        if len(sample) >= count:
+            break
+        if engine not in timed:
+            sample.append((engine, 'no history'))
+    return sample
+
+def estimate_run(engines, samples, history, max_workers):
+    """ Extrapolates the size and duration of the full run of a query from its
+        preview. An Engine is expected to return what it usually returns for
+        the query, if it was run before; otherwise what it returned in the
+        preview, or the average of the sampled Engines. The bytes per row are
+        those of the preview, and the Engines are queried max_workers at a
+        time.
+
+    Arguments:
+        engines: list of the EngineAppliance of the full run
+        samples: dict of Engine name: {'rows', 'bytes', 'latency', 'capped'}
+            for the sampled Engines that answered (capped if they returned
+            as many rows as the preview allowed)
+        history: dict of Engine name: {'rows', 'bytes', 'latency'}, the
+            medians of the previous runs of the query (see
+            RunStatsStore.query_history)
+        max_workers: The number of Engines queried at once
+    Returns:
+        dict with rows, bytes, duration (seconds), from_history (number of
+        Engines estimated from their history) and lower_bound (True if some
+        Engines may return more rows than the preview allowed); None if no
+        sampled Engine answered
+    """
+    if not samples:
+        return None
+    sampled_rows = sum(s['rows'] for s in samples.values())
+    bytes_per_row = float(sum(s['bytes'] for s in samples.values())) / sampled_rows if sampled_rows else 0.0
+    average_rows = float(sampled_rows) / len(samples)
+    average_latency = sum(s['latency'] for s in samples.values()) / len(samples)
+    capped = any(s['capped'] for s in samples.values())
+    rows = 0.0
+    latencies = []
+    from_history = 0
+    lower_bound = False
+    for engine in engines:
+        past = history.get(engine.name)
+        sample = samples.get(engine.name)
+        if past is not None and past['rows'] is not None:
+            rows += past['rows']
+            latencies.append(past['latency'])
+            from_history += 1
+        elif sample is not None:
+            rows += sample['rows']
+            latencies.append(sample['latency'])
+            lower_bound = lower_bound or sample['capped']
+        else:
+            rows += average_rows
+            latencies.append(average_latency)
+            lower_bound = lower_bound or capped
+    duration = max(max(latencies), sum(latencies) / max(1, max_workers)) if latencies else 0.0
+    return {'rows': int(round(rows)), 'bytes': int(round(rows * bytes_per_row)), 'duration': duration,
+        'from_history': from_history, 'lower_bound': lower_bound}
@@ -0,0 +1,120 @@
+"""Query merging for multi_engine_query"""
+
+# Native modules
+import logging
+import re
+
+# Application specific modules
+from config import NXQLQuery
+
+# Create the logger
+logger = logging.getLogger('logger')
+
+def split_select(nxql):
+    """ Splits an NXQL query into the fields of its (select ...) clause and
+        the rest of the query.
+
+    Arguments:
+        nxql: The NXQL query
+    Returns:
+        list of strings: the fields as written (e.g. #"OS Name")
+        string: the rest of the query, with its whitespace normalized
+        or None, None if the fields can not be determined (e.g. the query
+        selects from several tables)
+    """
+    match = re.search(r'\(\s*select\s*\(', nxql, re.IGNORECASE)
+    if not match:
+        return None, None
+    tokens = []
+    token = ''
+    in_quotes = False
+    for position in range(match.end(), len(nxql)):
+        ch = nxql[position]
+        if ch == '"':
+            in_quotes = not in_quotes
+            token += ch
+        elif in_quotes:
+            token += ch
+        elif ch == '(':
+            return None, None
+        elif ch == ')' or ch.isspace():
+            if token:
+                tokens.append(token)
+                token = ''
+            if ch == ')':
+                return tokens, ' '.join(nxql[position + 1:].split())
+        else:
+            token += ch
+    return None, None
+
+def merge_queries(logger, queries):
+    """ Groups the queries that can share a single round trip to each Engine:
+        those selecting from the same table, for the same platforms, with
+        the same where clause (and the same limit, order, etc.), i.e. the
+        queries that only differ by the fields they select.
+
+    Arguments:
+        logger: Initialized logger instance
+        queries: list of NXQLQuery instances
+    Returns:
+        list of (NXQLQuery to run, list of NXQLQuery instances it answers),
+        in the order of the queries. A group of several queries runs a
+        combined query, selecting the union of their fields.
+    """
+    groups = []
+    by_signature = {}
+    for query in queries:
+        tokens, remainder = split_select(query.query)
+        # Queries depending on another query run with their own values
+        if tokens is None or query.depends_on:
+            groups.append([query])
+            continue
+        signature = (remainder, tuple(sorted(query.platforms)))
+        if signature in by_signature:
+            by_signature[signature].append(query)
+        else:
+            by_signature[signature] = [query]
+            groups.append(by_signature[signature])
+    units = []
+    for members in groups:
+        if len(members) == 1:
+            units.append((members[0], members))
+            continue
+        fields = []
+        for member in members:
+            tokens, remainder = split_select(member.query)
+            for token in tokens:
+                if token not in fields:
+                    fields.append(token)
+        combined = NXQLQuery('+'.join(m.name for m in members),
+            '(select ({}) {}'.format(' '.join(fields), remainder),
+            members[0].output_path, None, members[0].filename, members[0].delimiter,
+            ','.join(members[0].platforms))
+        logger.info('merge_queries - Queries {} share a single query to each Engine: {}'.format(
+            ', '.join('"{}"'.format(m.name) for m in members), combined.query))
+        units.append((combined, members))
+    return units
+
+def project_rows(objects, combined, member):
+    """ Returns the rows of a combined query holding only the fields of one
+        of the queries it answers, in that query's order.
+
+    Arguments:
+        objects: list of dict objects returned for the combined query
+        combined: The combined NXQLQuery
+        member: The NXQLQuery whose fields to keep
+    Returns:
+        list of dict objects
+    """
+    if len(objects) == 0 or combined is member:
+        return objects
+    combined_fields = combined.fields
+    keys = list(objects[0].keys())
+    if len(keys) == len(combined_fields):
+        # The Engine returns the fields in the order they were selected; map
+        # them by position, in case it names them differently than the query
+        names = dict(zip(combined_fields, keys))
+    else:
+        names = dict((field, field) for field in combined_fields)
+    selected = [names.get(field, field) for field in member.fields]
+    return [dict((key, obj.get(key)) for key in selected) for obj in objects]
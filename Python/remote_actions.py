@@ -0,0 +1,167 @@
+"""Remote Action dispatch classes for multi_engine_query"""
+
+# Native modules
+from concurrent.futures import ThreadPoolExecutor
+import inspect
+import logging
+import threading
+import time
+
+# Application specific modules
+from base_classes import DebugableObject
+from timer import timer
+
+# Create the logger
+logger = logging.getLogger('logger')
+
+class TokenBucket(object):
+    """A thread-safe token bucket limiting how often an operation may happen.
+
+    Attributes:
+        rate: Number of tokens added per second (0 or less disables the limit)
+        capacity: Maximum number of tokens that can accumulate (the burst size)
+    """
+
+    def __init__(self, rate, capacity):
+        self._rate = rate
+        self._capacity = max(1, capacity)
+        self._tokens = self._capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return 'TokenBucket(rate={!r}, capacity={!r})'.format(self._rate, self._capacity)
+
+    @property
+    def rate(self):
+        return self._rate
+
+    @property
+    def capacity(self):
+        return self._capacity
+
+    def acquire(self):
+        """Takes a token, waiting for one to be available if needed"""
+        if self._rate <= 0:
+            return
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self._capacity, self._tokens + (now - self._updated) * self._rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self._rate
+            time.sleep(wait)
+
+class RemoteActionDispatcher(DebugableObject):
+    """Triggers a query's Remote Action on the devices found in its results.
+    Device UIDs are collected from the result rows of each Engine as they
+    arrive, deduplicated, and sent to the Portal in batches of
+    config.portal_remote_action_batch_size devices, with at most
+    config.portal_remote_action_max_workers batches in flight, and at most
+    config.portal_remote_action_rate batches started per second.
+    When several Portals are queried, the devices of an Engine are sent to
+    the Portal the Engine belongs to.
+
+    Attributes:
+        query: The NXQLQuery whose results feed the Remote Action
+        devices: Number of distinct devices collected so far
+        outcomes: One dict per batch sent (batch, portal, devices, status, response, elapsed)
+    """
+
+    def __init__(self, logger, config, portals, query):
+        self._logger = logger
+        self._config = config
+        self._portals = dict((portal.name, portal) for portal in portals)
+        self._default_portal = portals[0]
+        self._query = query
+        self._batch_size = config.portal_remote_action_batch_size
+        self._bucket = TokenBucket(config.portal_remote_action_rate, config.portal_remote_action_burst)
+        self._executor = ThreadPoolExecutor(max_workers=config.portal_remote_action_max_workers)
+        self._lock = threading.Lock()
+        self._seen = set()
+        self._pending = {}
+        self._futures = []
+        self._outcomes = []
+
+    def __repr__(self):
+        return 'RemoteActionDispatcher(query={!r}, remote_action_id={!r}, batch_size={!r}, bucket={!r})'.format(
+            self._query.name, self._query.remote_action_id, self._batch_size, self._bucket)
+
+    @property
+    def query(self):
+        return self._query
+
+    @property
+    def devices(self):
+        return len(self._seen)
+
+    @property
+    def outcomes(self):
+        return self._outcomes
+
+    def _send(self, batch_number, portal, device_uids):
+        """Sends one batch to the Portal, once the rate limit allows it"""
+        func_name = self.__class__.__name__ + '.' + inspect.currentframe().f_code.co_name
+        self._bucket.acquire()
+        start_time = time.time()
+        try:
+            response = portal.execute_remote_action(self._query.remote_action_id, device_uids)
+        except Exception as exc:
+            self._logger.error('{0} - Batch {1} of Remote Action "{2}" failed: {3!r}'.format(
+                func_name, batch_number, self._query.remote_action_id, exc))
+            response = None
+        outcome = {
+            'batch': batch_number,
+            'portal': portal.name,
+            'devices': len(device_uids),
+            'status': 'ok' if response is not None else 'failed',
+            'response': response,
+            'elapsed': time.time() - start_time}
+        with self._lock:
+            self._outcomes.append(outcome)
+        if self._config.verbose:
+            self._logger.info('{0} - Batch {1} of Remote Action "{2}" ({3} devices): {4} in {5}'.format(
+                func_name, batch_number, self._query.remote_action_id, len(device_uids),
+                outcome['status'], timer(start_time, time.time())))
+        return outcome
+
+    def _submit(self, portal, device_uids):
+        """Queues a batch for sending; called with self._lock held"""
+        self._futures.append(self._executor.submit(self._send, len(self._futures) + 1, portal, device_uids))
+
+    def add(self, engine, objects):
+        """Collects the device UIDs of the result rows of engine, sending every full batch"""
+        func_name = self.__class__.__name__ + '.' + inspect.currentframe().f_code.co_name
+        field = self._query.remote_action_uid_field
+        portal = self._portals.get(engine.portal, self._default_portal)
+        missing = 0
+        with self._lock:
+            pending = self._pending.setdefault(portal.name, [])
+            for obj in objects:
+                uid = obj.get(field)
+                if not uid:
+                    missing += 1
+                elif (portal.name, uid) not in self._seen:
+                    self._seen.add((portal.name, uid))
+                    pending.append(uid)
+                    if len(pending) >= self._batch_size:
+                        self._submit(portal, pending)
+                        pending = self._pending[portal.name] = []
+        if missing:
+            self._logger.warning('{0} - {1} result rows from Engine "{2}" have no "{3}" field; they are not targeted by the Remote Action.'.format(
+                func_name, missing, engine.name, field))
+
+    def close(self):
+        """Sends the last partial batch and waits for all of the batches to complete.
+        Returns the list of batch outcomes."""
+        with self._lock:
+            for name, pending in sorted(self._pending.items()):
+                if pending:
+                    self._submit(self._portals[name], pending)
+            self._pending = {}
+        self._executor.shutdown(wait=True)
+        self._outcomes.sort(key=lambda outcome: outcome['batch'])
+        return self._outcomes
@@ -0,0 +1,180 @@
+"""Resource accounting of the multi_engine_query runs"""
+
+# Native modules
+import inspect
+import json
+import logging
+import os
+import socket
+import sys
+import threading
+import time
+try:
+    import resource
+except ImportError:
+    # Not available on Windows
+    resource = None
+
+# Create the logger
+logger = logging.getLogger('logger')
+
+def thread_cpu():
+    """Returns the (user, system) CPU seconds used by the calling thread so far"""
+    if resource is not None and hasattr(resource, 'RUSAGE_THREAD'):
+        usage = resource.getrusage(resource.RUSAGE_THREAD)
+        return usage.ru_utime, usage.ru_stime
+    # The platform does not tell them apart
+    return time.thread_time(), 0.0
+
+def peak_rss(who='self'):
+    """Returns the peak resident set size in bytes of the process ('self') or
+    of its largest child process ('children'), or None if unknown"""
+    if resource is None:
+        return None
+    usage = resource.getrusage(resource.RUSAGE_SELF if who == 'self' else resource.RUSAGE_CHILDREN)
+    # Bytes on macOS, kilobytes elsewhere
+    return usage.ru_maxrss if sys.platform == 'darwin' else usage.ru_maxrss * 1024
+
+def output_size(fname):
+    """Returns the size of the output file fname, 0 if there is none"""
+    try:
+        return os.path.getsize(fname) if fname else 0
+    except OSError:
+        return 0
+
+class ResourceAccounting(object):
+    """Accounts for the resources a run uses, for the whole run and per query:
+    user and system CPU time, peak RSS, bytes received from every Engine,
+    bytes written to every output, and rows per second. The CPU time of a
+    query is the time of the threads querying the Engines and writing its
+    results; the CPU time of the run also includes the main thread and the
+    processes decoding the results.
+
+    Attributes:
+        queries: dict of query name: its accounting (see summary)
+    """
+
+    def __init__(self, logger, config):
+        self._logger = logger
+        self._config = config
+        self._lock = threading.Lock()
+        self._start_time = time.time()
+        self._start_times = os.times()
+        self._queries = {}
+
+    def __repr__(self):
+        return 'ResourceAccounting(queries={!r})'.format(sorted(self._queries))
+
+    @property
+    def queries(self):
+        with self._lock:
+            return dict((name, dict(query)) for name, query in self._queries.items())
+
+    def _query(self, query):
+        """Returns the accounting of query; called with self._lock held"""
+        return self._queries.setdefault(query.name, {
+            'start_time': time.time(),
+            'duration': 0.0,
+            'cpu_user': 0.0,
+            'cpu_system': 0.0,
+            'rows': 0,
+            'bytes_received': 0,
+            'output': None,
+            'bytes_written': 0,
+            'output_size_at_start': 0,
+            'peak_rss_at_start': None,
+            'peak_rss': None})
+
+    def start_query(self, query, sink):
+        """Starts accounting for query, whose output sink has just been opened"""
+        with self._lock:
+            accounting = self._query(query)
+            accounting['start_time'] = time.time()
+            accounting['output'] = sink.fname
+            accounting['output_size_at_start'] = output_size(sink.fname)
+            accounting['peak_rss_at_start'] = peak_rss()
+
+    def add_engine(self, query, cpu, bytes_received, rows):
+        """ Accounts for the results of an Engine for query
+
+        Arguments:
+            query: The NXQLQuery the results are for
+            cpu: (user, system) CPU seconds spent on them
+            bytes_received: Bytes of the Engine's responses
+            rows: Rows retrieved
+        """
+        with self._lock:
+            accounting = self._query(query)
+            accounting['cpu_user'] += cpu[0]
+            accounting['cpu_system'] += cpu[1]
+            accounting['bytes_received'] += bytes_received or 0
+            accounting['rows'] += rows
+
+    def finish_query(self, query, sink):
+        """Completes the accounting of query, once its output sink is closed"""
+        with self._lock:
+            accounting = self._query(query)
+            accounting['duration'] = time.time() - accounting['start_time']
+            accounting['output'] = sink.fname
+            accounting['bytes_written'] = max(0, output_size(sink.fname) - accounting['output_size_at_start'])
+            accounting['peak_rss'] = peak_rss()
+
+    def summary(self, engine_list):
+        """ Returns the accounting of the run so far, as a dict
+
+        Arguments:
+            engine_list: The EngineAppliance instances of the run, for the
+                bytes received from each of them
+        """
+        end_times = os.times()
+        duration = time.time() - self._start_time
+        engines = {}
+        for engine in engine_list:
+            transfer = engine.transfer
+            engines[engine.name] = {'responses': transfer['responses'], 'bytes': transfer['bytes'],
+                'wire_bytes': transfer['wire_bytes']}
+        queries = {}
+        for name, accounting in self.queries.items():
+            peak_before = accounting['peak_rss_at_start']
+            queries[name] = {
+                'duration': round(accounting['duration'], 3),
+                'cpu_user': round(accounting['cpu_user'], 3),
+                'cpu_system': round(accounting['cpu_system'], 3),
+                'rows': accounting['rows'],
+                'rows_per_second': round(accounting['rows'] / accounting['duration'], 1) if accounting['duration'] else None,
+                'bytes_received': accounting['bytes_received'],
+                'output': accounting['output'],
+                'bytes_written': accounting['bytes_written'],
+                'peak_rss': accounting['peak_rss'],
+                'peak_rss_growth': accounting['peak_rss'] - peak_before
+                    if accounting['peak_rss'] is not None and peak_before is not None else None}
+        rows = sum(q['rows'] for q in queries.values())
+        return {
+            'query_name': self._config.query_name,
+            'rundate': self._config.rundate,
+            'host': socket.gethostname(),
+            'duration': round(duration, 3),
+            'cpu_user': round(end_times[0] - self._start_times[0], 3),
+            'cpu_system': round(end_times[1] - self._start_times[1], 3),
+            'children_cpu_user': round(end_times[2] - self._start_times[2], 3),
+            'children_cpu_system': round(end_times[3] - self._start_times[3], 3),
+            'peak_rss': peak_rss(),
+            'children_peak_rss': peak_rss('children'),
+            'rows': rows,
+            'rows_per_second': round(rows / duration, 1) if duration else None,
+            'bytes_received': sum(e['bytes'] for e in engines.values()),
+            'wire_bytes_received': sum(e['wire_bytes'] for e in engines.values()),
+            'bytes_written': sum(q['bytes_written'] for q in queries.values()),
+            'engines': engines,
+            'queries': queries}
+
+    def save(self, fname, summary):
+        """Writes summary to fname as JSON. Returns True if successful."""
+        func_name = self.__class__.__name__ + '.' + inspect.currentframe().f_code.co_name
+        try:
+            with open(fname, 'w') as f:
+                json.dump(summary, f, indent=2, sort_keys=True)
+        except (IOError, OSError) as e:
+            self._logger.error('{0} - Unable to save the resource summary to "{1}": {2}'.format(func_name, fname, e))
+            return False
+        return True
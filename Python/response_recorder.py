@@ -0,0 +1,203 @@
+"""Recording and replay of the Appliance responses for multi_engine_query"""
+
+# Native modules
+import gzip
+import hashlib
+import inspect
+import json
+import logging
+import os
+import threading
+import time
+import urllib.parse
+
+# 3rd-party modules
+import requests
+from requests.adapters import HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+
+# Create the logger
+logger = logging.getLogger('logger')
+
+def normalize_url(method, url, body=None):
+    """ Returns the key identifying a request in the recordings: the method,
+        and the URL with its scheme and host in lower case, its whitespace
+        collapsed and its parameters sorted, followed by a hash of the body
+        of the request, if any (e.g. the devices of a Remote Action).
+
+    Arguments:
+        method: The HTTP method of the request
+        url: The URL of the request
+        body: Optional body of the request (bytes or str)
+    Returns:
+        string: the normalized request
+    """
+    parts = urllib.parse.urlsplit(url)
+    path = ' '.join(urllib.parse.unquote(parts.path).split())
+    params = sorted((name, ' '.join(value.split()))
+        for name, value in urllib.parse.parse_qsl(parts.query, keep_blank_values=True))
+    key = '{} {}://{}{}'.format(method.upper(), parts.scheme.lower(), parts.netloc.lower(), path)
+    if params:
+        key += '?' + urllib.parse.urlencode(params)
+    if body:
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+        key += ' #' + hashlib.sha1(body).hexdigest()
+    return key
+
+class _ReplayedRaw(object):
+    """Stands for the urllib3 response of a replayed response, whose body is already read"""
+
+    def __init__(self, wire_bytes):
+        self._wire_bytes = wire_bytes
+
+    def tell(self):
+        return self._wire_bytes
+
+    def read(self, *args, **kwargs):
+        return b''
+
+    def close(self):
+        pass
+
+class ResponseRecorder(object):
+    """Records the responses of the Appliances to disk, or replays them from
+    disk instead of sending the requests, e.g. to measure changes to the
+    parsing and writing of the results against production-shaped data,
+    offline.
+
+    Every response is saved to <path>/<hash of the normalized request>.gz (see
+    normalize_url): a line of JSON holding the request, the status, the
+    headers, the bytes transferred and the seconds the response took,
+    followed by the (decompressed) body. A request answered several times
+    keeps its latest response.
+
+    Attributes:
+        mode: "record" or "replay"
+        path: The folder holding the recordings
+        latency: When replaying, wait for the seconds each response
+            originally took, instead of answering at once
+        counts: dict of recorded, replayed and missing responses
+    """
+
+    def __init__(self, logger, mode, path, latency=False):
+        self._logger = logger
+        self._mode = mode
+        self._path = path
+        self._latency = latency
+        self._counts_lock = threading.Lock()
+        self._counts = {'recorded': 0, 'replayed': 0, 'missing': 0}
+
+    def __repr__(self):
+        return 'ResponseRecorder(mode={!r}, path={!r}, latency={!r})'.format(self._mode, self._path, self._latency)
+
+    @classmethod
+    def create(cls, logger, config):
+        """Returns the ResponseRecorder requested on the command line, or None"""
+        if config.record_path:
+            return cls(logger, 'record', config.record_path)
+        if config.replay_path:
+            return cls(logger, 'replay', config.replay_path, config.replay_latency)
+        return None
+
+    @property
+    def mode(self):
+        return self._mode
+
+    @property
+    def path(self):
+        return self._path
+
+    @property
+    def latency(self):
+        return self._latency
+
+    @property
+    def counts(self):
+        with self._counts_lock:
+            return dict(self._counts)
+
+    def _count(self, name):
+        with self._counts_lock:
+            self._counts[name] += 1
+
+    def _fname(self, key):
+        return os.path.join(self._path, hashlib.sha1(key.encode('utf-8')).hexdigest() + '.gz')
+
+    def adapter(self):
+        """Returns the transport adapter to mount on the Appliance sessions"""
+        return RecordingAdapter(self)
+
+    def save(self, key, response, elapsed):
+        """Saves response, whose body has been read, as the response to the request key"""
+        func_name = self.__class__.__name__ + '.' + inspect.currentframe().f_code.co_name
+        header = {
+            'request': key,
+            'status_code': response.status_code,
+            'reason': response.reason,
+            'headers': dict((name, value) for name, value in response.headers.items() if name.lower() != 'set-cookie'),
+            'wire_bytes': (response.raw.tell() if response.raw is not None else 0) or len(response.content),
+            'elapsed': elapsed,
+            'recorded': time.time()}
+        fname = self._fname(key)
+        part = '{}.{}.{}.part'.format(fname, os.getpid(), threading.get_ident())
+        try:
+            os.makedirs(self._path, exist_ok=True)
+            with gzip.open(part, 'wb', compresslevel=6) as f:
+                f.write(json.dumps(header).encode('utf-8') + b'\n')
+                f.write(response.content)
+            os.replace(part, fname)
+        except (IOError, OSError) as e:
+            self._logger.error('{0} - Unable to record the response to "{1}": {2}'.format(func_name, key, e))
+            return
+        self._count('recorded')
+
+    def load(self, key, request):
+        """Returns the recorded response to the request key as a requests.Response,
+        after its original latency if self.latency, or None if it was not recorded"""
+        func_name = self.__class__.__name__ + '.' + inspect.currentframe().f_code.co_name
+        try:
+            with gzip.open(self._fname(key), 'rb') as f:
+                data = f.read()
+            line, _, body = data.partition(b'\n')
+            header = json.loads(line.decode('utf-8'))
+        except (IOError, OSError, EOFError, ValueError) as e:
+            self._count('missing')
+            self._logger.error('{0} - No recorded response to "{1}": {2}'.format(func_name, key, e))
+            return None
+        if self._latency:
+            time.sleep(header['elapsed'])
+        response = requests.Response()
+        response.status_code = header['status_code']
+        response.reason = header['reason']
+        response.headers = CaseInsensitiveDict(header['headers'])
+        response.encoding = requests.utils.get_encoding_from_headers(response.headers)
+        response.raw = _ReplayedRaw(header['wire_bytes'])
+        response._content = body
+        response._content_consumed = True
+        response.url = request.url
+        response.request = request
+        self._count('replayed')
+        return response
+
+class RecordingAdapter(HTTPAdapter):
+    """Transport adapter recording the responses of an Appliance session, or
+    replaying them instead of sending the requests (see ResponseRecorder)"""
+
+    def __init__(self, recorder, *args, **kwargs):
+        super(RecordingAdapter, self).__init__(*args, **kwargs)
+        self._recorder = recorder
+
+    def send(self, request, **kwargs):
+        key = normalize_url(request.method, request.url, request.body)
+        if self._recorder.mode == 'replay':
+            response = self._recorder.load(key, request)
+            if response is None:
+                raise requests.exceptions.ConnectionError('No recorded response to {}'.format(key), request=request)
+            return response
+        start_time = time.time()
+        response = super(RecordingAdapter, self).send(request, **kwargs)
+        # Read the body (decompressing it) so that it can be saved; the caller reads it from memory
+        response.content
+        self._recorder.save(key, response, time.time() - start_time)
+        return response
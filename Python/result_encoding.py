@@ -0,0 +1,73 @@
+"""Result decoding and encoding functions for multi_engine_query
+
+The functions in this module only use their arguments, so that they can be
+run in worker processes (see engine_decode_processes).
+"""
+
+# Native modules
+import csv
+import io
+import json
+import locale
+
+# Optional 3rd-party modules
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+def decode_json(raw):
+    """ Decodes a JSON document (bytes or str), with orjson when it is installed
+
+    Arguments:
+        raw: The JSON document
+    Returns:
+        The decoded object
+    """
+    if orjson is not None:
+        return orjson.loads(raw)
+    return json.loads(raw)
+
+def format_csv_rows(objects, field_names, delimiter, need_headers):
+    """ Formats the objects exactly as write_to_output_file would, and returns
+        the resulting text instead of writing it to a file.
+
+    Arguments:
+        objects: list of dict objects to format
+        field_names: list of strings to use as field names for the dict
+        delimiter: The delimiter to use between fields
+        need_headers: bool if True include the header row
+    Returns:
+        string: the formatted rows
+    """
+    buffer = io.StringIO(newline='')
+    dict_writer = csv.DictWriter(buffer, extrasaction='ignore',
+        fieldnames=field_names, delimiter=delimiter,
+        quoting=csv.QUOTE_NONNUMERIC)
+    if need_headers:
+        dict_writer.writeheader()
+    dict_writer.writerows(objects)
+    return buffer.getvalue()
+
+def encode_csv_batch(raw, delimiter, encoding=None):
+    """ Decodes the raw JSON results of an Engine and encodes them as csv
+
+    Arguments:
+        raw: The JSON response body (a list of objects) returned by the Engine
+        delimiter: The delimiter to use between fields
+        encoding: The output encoding (defaults to the locale's preferred encoding)
+    Returns:
+        dict with:
+            field_names: list of field names, from the first object
+            header: the encoded header row
+            body: the encoded data rows
+            rows: the number of data rows
+    """
+    encoding = encoding or locale.getpreferredencoding(False)
+    objects = decode_json(raw)
+    field_names = list(objects[0].keys()) if len(objects) > 0 else []
+    return {
+        'field_names': field_names,
+        'header': format_csv_rows([], field_names, delimiter, True).encode(encoding),
+        'body': format_csv_rows(objects, field_names, delimiter, False).encode(encoding),
+        'rows': len(objects)}
@@ -0,0 +1,243 @@
+"""Run statistics store for multi_engine_query"""
+
+# Native modules
+import inspect
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+# Create the logger
+logger = logging.getLogger('logger')
+
+def percentile(values, pct):
+    """ Returns the pct (0-100) percentile of values, interpolating between
+        the closest ranks, or None if there are no values """
+    values = sorted(values)
+    if len(values) == 0:
+        return None
+    rank = (len(values) - 1) * pct / 100.0
+    low = int(rank)
+    high = min(low + 1, len(values) - 1)
+    return values[low] + (values[high] - values[low]) * (rank - low)
+
+class RunStatsStore(object):
+    """A small SQLite database recording, for every run, how each Engine did
+    for each query: latency, rows, bytes received and status.
+
+    Attributes:
+        path: The database file name
+        run_id: The id of the current run (once start_run() has been called)
+    """
+
+    _SCHEMA = [
+        '''CREATE TABLE IF NOT EXISTS runs (
+            run_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            rundate TEXT, name TEXT, is_group INTEGER, host TEXT,
+            started REAL, duration REAL, status TEXT)''',
+        '''CREATE TABLE IF NOT EXISTS engine_query_stats (
+            run_id INTEGER, rundate TEXT, query TEXT, engine TEXT, hostname TEXT,
+            started REAL, latency REAL, rows INTEGER, bytes INTEGER, status TEXT)''',
+        '''CREATE INDEX IF NOT EXISTS ix_engine_query_stats_query_started
+            ON engine_query_stats (query, started)''',
+        '''CREATE INDEX IF NOT EXISTS ix_engine_query_stats_hostname_started
+            ON engine_query_stats (hostname, started)''']
+
+    def __init__(self, logger, config):
+        self._logger = logger
+        self._config = config
+        self._path = config.stats_database
+        self._run_id = None
+        self._pending = []
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return 'RunStatsStore(path={!r}, run_id={!r})'.format(self._path, self._run_id)
+
+    @property
+    def path(self):
+        return self._path
+
+    @property
+    def run_id(self):
+        return self._run_id
+
+    def _connect(self):
+        if not os.path.exists(os.path.dirname(os.path.abspath(self._path))):
+            os.makedirs(os.path.dirname(os.path.abspath(self._path)))
+        connection = sqlite3.connect(self._path)
+        for statement in self._SCHEMA:
+            connection.execute(statement)
+        return connection
+
+    def start_run(self):
+        """Records the start of the current run"""
+        func_name = self.__class__.__name__ + '.' + inspect.currentframe().f_code.co_name
+        try:
+            connection = self._connect()
+            with connection:
+                cursor = connection.execute(
+                    'INSERT INTO runs (rundate, name, is_group, host, started, status) VALUES (?, ?, ?, ?, ?, ?)',
+                    (self._config.rundate, self._config.query_name, int(self._config.query_is_group),
+                     self._config.full_hostname, time.time(), 'running'))
+                self._run_id = cursor.lastrowid
+            connection.close()
+        except sqlite3.Error as exc:
+            self._logger.error('{0} - Unable to record the run in "{1}": {2!r}'.format(func_name, self._path, exc))
+
+    def record(self, engine, query, started, latency, rows, nbytes, status):
+        """Records how engine did for query; kept in memory until finish_run()"""
+        with self._lock:
+            self._pending.append((self._run_id, self._config.rundate, query.name, engine.name,
+                engine.hostname_fqdn, started, latency, rows, nbytes, status))
+
+    def finish_run(self, duration, status='completed'):
+        """Writes the recorded statistics, and the run's duration and status"""
+        func_name = self.__class__.__name__ + '.' + inspect.currentframe().f_code.co_name
+        with self._lock:
+            pending, self._pending = self._pending, []
+        try:
+            connection = self._connect()
+            with connection:
+                connection.executemany(
+                    'INSERT INTO engine_query_stats VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', pending)
+                connection.execute('UPDATE runs SET duration = ?, status = ? WHERE run_id = ?',
+                    (duration, status, self._run_id))
+            connection.close()
+        except sqlite3.Error as exc:
+            self._logger.error('{0} - Unable to save the run statistics in "{1}": {2!r}'.format(func_name, self._path, exc))
+
+    def engine_latencies(self, days):
+        """Returns the median latency of every Engine (by hostname) over the last days,
+        across all queries"""
+        func_name = self.__class__.__name__ + '.' + inspect.currentframe().f_code.co_name
+        if not os.path.exists(self._path):
+            return {}
+        latencies = {}
+        try:
+            connection = self._connect()
+            for hostname, latency in connection.execute(
+                    "SELECT hostname, latency FROM engine_query_stats WHERE status = 'ok' AND started >= ?",
+                    (time.time() - days * 86400,)):
+                latencies.setdefault(hostname, []).append(latency)
+            connection.close()
+        except sqlite3.Error as exc:
+            self._logger.error('{0} - Unable to read the run statistics in "{1}": {2!r}'.format(func_name, self._path, exc))
+            return {}
+        return dict((hostname, percentile(values, 50)) for hostname, values in latencies.items())
+
+    def engine_rows(self, days):
+        """Returns the median rows returned by every Engine (by hostname) over the last days,
+        across all queries"""
+        func_name = self.__class__.__name__ + '.' + inspect.currentframe().f_code.co_name
+        if not os.path.exists(self._path):
+            return {}
+        rows = {}
+        try:
+            connection = self._connect()
+            for hostname, count in connection.execute(
+                    "SELECT hostname, rows FROM engine_query_stats WHERE status = 'ok' AND started >= ?",
+                    (time.time() - days * 86400,)):
+                rows.setdefault(hostname, []).append(count)
+            connection.close()
+        except sqlite3.Error as exc:
+            self._logger.error('{0} - Unable to read the run statistics in "{1}": {2!r}'.format(func_name, self._path, exc))
+            return {}
+        return dict((hostname, percentile(values, 50)) for hostname, values in rows.items())
+
+    def query_history(self, query_name, days):
+        """Returns {engine: {'latency', 'rows', 'bytes'}}, the medians of the runs
+        of the query over the last days"""
+        func_name = self.__class__.__name__ + '.' + inspect.currentframe().f_code.co_name
+        if not os.path.exists(self._path):
+            return {}
+        try:
+            connection = self._connect()
+            now = time.time()
+            stats = self._window(connection, query_name, now - days * 86400, now)
+            connection.close()
+        except sqlite3.Error as exc:
+            self._logger.error('{0} - Unable to read the run statistics in "{1}": {2!r}'.format(func_name, self._path, exc))
+            return {}
+        return dict((engine, {
+            'latency': percentile(entry['latency'], 50),
+            'rows': percentile(entry['rows'], 50),
+            'bytes': percentile(entry['bytes'], 50)}) for engine, entry in stats.items() if entry['latency'])
+
+    def _window(self, connection, query_name, start, end):
+        """Returns {engine: {'latency': [...], 'rows': [...], 'bytes': [...], 'failed': n}}
+        for the query between start and end"""
+        stats = {}
+        for engine, latency, rows, nbytes, status in connection.execute(
+                'SELECT engine, latency, rows, bytes, status FROM engine_query_stats '
+                'WHERE query = ? AND started >= ? AND started < ?', (query_name, start, end)):
+            entry = stats.setdefault(engine, {'latency': [], 'rows': [], 'bytes': [], 'failed': 0})
+            if status == 'ok':
+                entry['latency'].append(latency)
+                entry['rows'].append(rows)
+                entry['bytes'].append(nbytes or 0)
+            else:
+                entry['failed'] += 1
+        return stats
+
+    def report(self, queries, days, threshold=2.0):
+        """Builds a report of the last days for the queries, comparing every
+        Engine with the previous period of the same length.
+
+        Arguments:
+            queries: list of NXQLQuery instances to report on
+            days: The length of the period, in days
+            threshold: Latency ratio (current / previous median) flagged as a regression
+        Returns:
+            list of strings: the report lines
+        """
+        lines = []
+        if not os.path.exists(self._path):
+            return ['No run statistics recorded yet in "{}".'.format(self._path)]
+        connection = self._connect()
+        now = time.time()
+        start = now - days * 86400
+        regressions = []
+        for query in queries:
+            current = self._window(connection, query.name, start, now)
+            previous = self._window(connection, query.name, start - days * 86400, start)
+            lines.append('')
+            lines.append('Query "{0}", last {1} day{2} (previous period in brackets):'.format(
+                query.name, days, 's' if days != 1 else ''))
+            if len(current) == 0:
+                lines.append('  No runs recorded.')
+                continue
+            lines.append('  {:<24} {:>5} {:>6} {:>9} {:>9} {:>9} {:>19} {:>11}'.format(
+                'Engine', 'Runs', 'Failed', 'p50 (s)', 'p90 (s)', 'max (s)', 'p50 prev (s)', 'Rows p50'))
+            for engine in sorted(current):
+                entry = current[engine]
+                before = previous.get(engine, {'latency': [], 'rows': [], 'failed': 0})
+                p50 = percentile(entry['latency'], 50)
+                p50_before = percentile(before['latency'], 50)
+                lines.append('  {:<24} {:>5} {:>6} {:>9} {:>9} {:>9} {:>19} {:>11}'.format(
+                    engine[:24], len(entry['latency']) + entry['failed'], entry['failed'],
+                    self._format(p50), self._format(percentile(entry['latency'], 90)),
+                    self._format(max(entry['latency']) if entry['latency'] else None),
+                    '[{}]'.format(self._format(p50_before)),
+                    self._format(percentile(entry['rows'], 50), '{:.0f}')))
+                if p50 and p50_before and p50 / p50_before >= threshold:
+                    regressions.append('Engine "{0}" got {1:.1f}x slower for Query "{2}" (p50 {3:.2f} s, was {4:.2f} s).'.format(
+                        engine, p50 / p50_before, query.name, p50, p50_before))
+                rows_before = percentile(before['rows'], 50)
+                rows_now = percentile(entry['rows'], 50)
+                if rows_before and rows_now is not None and rows_now < rows_before / threshold:
+                    regressions.append('Engine "{0}" returns {1:.0f}% fewer rows for Query "{2}" (p50 {3:.0f}, was {4:.0f}).'.format(
+                        engine, 100 * (1 - rows_now / rows_before), query.name, rows_now, rows_before))
+                if entry['failed'] > before['failed'] and entry['failed'] > 0:
+                    regressions.append('Engine "{0}" failed {1} time{2} for Query "{3}" (was {4}).'.format(
+                        engine, entry['failed'], 's' if entry['failed'] != 1 else '', query.name, before['failed']))
+        connection.close()
+        lines.append('')
+        lines.append('Regressions:' if regressions else 'No regressions found.')
+        lines.extend('  ' + r for r in regressions)
+        return lines
+
+    @staticmethod
+    def _format(value, fmt='{:.2f}'):
+        return '-' if value is None else fmt.format(value)
@@ -0,0 +1,75 @@
+"""Timeline tracing of the multi_engine_query runs"""
+
+# Native modules
+import inspect
+import json
+import logging
+import os
+import threading
+
+# Create the logger
+logger = logging.getLogger('logger')
+
+class RunTracer(object):
+    """Records the spans of a run (what ran, on which thread, from when to
+    when) and saves them as a Chrome trace-event file, which Perfetto
+    (https://ui.perfetto.dev) and chrome://tracing show as a timeline: one
+    track per thread, e.g. the main thread and every worker thread querying
+    the Engines, so that stragglers, idle workers and waits stand out.
+
+    Attributes:
+        events: list of the trace events recorded so far
+    """
+
+    def __init__(self, logger, config):
+        self._logger = logger
+        self._config = config
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+        self._events = [{'name': 'process_name', 'ph': 'M', 'pid': self._pid, 'tid': 0,
+            'args': {'name': 'multi-engine-query {0} ({1})'.format(config.query_name, config.rundate)}}]
+        self._threads = {}
+
+    def __repr__(self):
+        return 'RunTracer(events={!r})'.format(len(self._events))
+
+    @property
+    def events(self):
+        with self._lock:
+            return list(self._events)
+
+    def _tid(self):
+        """Returns the id of the calling thread in the trace; called with self._lock held"""
+        ident = threading.get_ident()
+        if ident not in self._threads:
+            self._threads[ident] = len(self._threads) + 1
+            self._events.append({'name': 'thread_name', 'ph': 'M', 'pid': self._pid, 'tid': self._threads[ident],
+                'args': {'name': threading.current_thread().name}})
+        return self._threads[ident]
+
+    def add(self, name, category, start_time, end_time, args=None):
+        """ Records a span of the calling thread
+
+        Arguments:
+            name: The name of the span
+            category: Its category (e.g. "engine", "http", "output")
+            start_time, end_time: When it started and ended (time.time())
+            args: Optional dict of details shown with the span
+        """
+        with self._lock:
+            self._events.append({'name': name, 'cat': category, 'ph': 'X', 'pid': self._pid, 'tid': self._tid(),
+                'ts': int(start_time * 1000000), 'dur': max(0, int((end_time - start_time) * 1000000)),
+                'args': args or {}})
+
+    def save(self, fname):
+        """Writes the trace to fname. Returns True if successful."""
+        func_name = self.__class__.__name__ + '.' + inspect.currentframe().f_code.co_name
+        with self._lock:
+            trace = {'traceEvents': list(self._events), 'displayTimeUnit': 'ms'}
+        try:
+            with open(fname, 'w') as f:
+                json.dump(trace, f)
+        except (IOError, OSError) as e:
+            self._logger.error('{0} - Unable to save the run trace to "{1}": {2}'.format(func_name, fname, e))
+            return False
+        return True